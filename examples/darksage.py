@@ -8,9 +8,73 @@ binary data into HDF5 input for TAO.
 import re, os
 import numpy as np
 import tao
+from tao.kernels import history_descendants, peak_history
+from tao.records import TransferPlan, field_block
 from collections import OrderedDict
 import time
 
+class RadialProfiles(object):
+    """(ngal x nbins) annulus arrays of one tree.
+
+    `block(family)` returns the `family_1` to `family_<nbins>` fields
+    (`DiscRadii_0` to `DiscRadii_<nbins>` for the radii) as a read-only
+    2-D view of the tree, and `profiles[family]` the same array in double
+    precision. Both are built once per tree and shared by every computed
+    field, so they must not be modified in place.
+    """
+
+    def __init__(self, tree, num_r_bins):
+        self.tree = tree
+        self.num_r_bins = num_r_bins
+        self._blocks = {}
+        self._doubles = {}
+
+    def block(self, family):
+        try:
+            return self._blocks[family]
+        except KeyError:
+            first = 0 if family == 'DiscRadii' else 1
+            names = ['{0}_{1}'.format(family, i)
+                     for i in range(first, self.num_r_bins + 1)]
+            block = field_block(self.tree, names)
+            self._blocks[family] = block
+            return block
+
+    def __getitem__(self, family):
+        try:
+            return self._doubles[family]
+        except KeyError:
+            arr = self.block(family).astype(np.float64)
+            self._doubles[family] = arr
+            return arr
+
+    def centres(self):
+        """Mid-point radius of every annulus, in double precision."""
+        try:
+            return self._doubles['centres']
+        except KeyError:
+            radii = self.block('DiscRadii')
+            arr = ((radii[:, 1:] + radii[:, :-1]) * 0.5).astype(np.float64)
+            self._doubles['centres'] = arr
+            return arr
+
+    def total(self, family):
+        """Sum over annuli of `family`, added one annulus at a time in
+        single precision, as the field-by-field sums this replaces."""
+        block = self.block(family)
+        arr = block[:, 0].copy()
+        for i in range(1, block.shape[1]):
+            arr += block[:, i]
+        return arr
+
+    def moment(self, family, weights):
+        """Sum over annuli of `family` times `weights`. The products are
+        single precision and the sum double, as for the field-by-field
+        sums this replaces."""
+        prod = self.block(family) * weights.astype(np.float32)
+        return np.sum(prod, axis=1, dtype=np.float64)
+
+
 class DARKSAGEConverter(tao.Converter):
     """Subclasses tao.Converter to perform SAGE output conversion."""
 
@@ -3390,28 +3454,17 @@ class DARKSAGEConverter(tao.Converter):
         on the snapshot ordering of the input data, the GalaxyIndex field,
         and the mergeIntoID field.
         """
-        descs = np.empty(len(tree), np.int32)
-        descs.fill(-1)
-
         """
         Now my attempt at this mapping descendants
         First, sort the entire tree into using GalaxyIndex as
         primary key and then snapshot number as secondary key.
         This sorted indices will naturally flow a galaxy from
         earlier times (lower snapshot numbers) to later times (larger
-        snapshot number)
+        snapshot number), so each galaxy is linked to the next entry
+        if it has the same GalaxyIndex.
         """
-        sorted_ind = np.argsort(tree, order=('GalaxyIndex', 'SnapNum'))
-        all_gal_idx = tree['GalaxyIndex']
-        for ii, idx in enumerate(all_gal_idx[sorted_ind]):
-            jj = ii + 1
-            if (jj < len(tree)) and (idx == all_gal_idx[sorted_ind[jj]]):
-                assert descs[sorted_ind[ii]] == -1
-                # assert tree['SnapNum'][sorted_ind[jj]] > \
-                #     tree['SnapNum'][sorted_ind[ii]]
-                # assert tree['GalaxyIndex'][sorted_ind[ii]] == \
-                #     tree['GalaxyIndex'][sorted_ind[jj]]
-                descs[sorted_ind[ii]] = sorted_ind[jj]
+        descs = history_descendants(tree['GalaxyIndex'],
+                                    tree['SnapNum']).astype(np.int32)
 
         # Run validation on descendants
         # for ii, desc in enumerate(descs):
@@ -3442,27 +3495,7 @@ class DARKSAGEConverter(tao.Converter):
         """
         Calculates the max. of Vmax during the halo history
         """
-        vpeak = np.empty(len(tree), np.float32)
-
-        # By pre-filling vpeak with Vmax, I don't have to
-        # worry about cases where there are no descendants
-        # (although the code should cover that case)
-        vpeak[:] = tree['Vmax']
-
-        sorted_ind = np.argsort(tree, order=('GalaxyIndex', 'SnapNum'))
-        all_vmax = tree['Vmax']
-        all_gal_idx = tree['GalaxyIndex']
-        vmax = []
-        curr_idx = all_gal_idx[sorted_ind[0]]
-        for ii, idx in enumerate(all_gal_idx[sorted_ind]):
-            if curr_idx != idx:
-                vmax = []
-                curr_idx = idx
-
-            vmax.append(all_vmax[sorted_ind[ii]])
-            vpeak[sorted_ind[ii]] = max(vmax)
-
-        return vpeak
+        return peak_history(tree['GalaxyIndex'], tree['SnapNum'], tree['Vmax'])
 
     def totsfr(self, tree):
         """ Calculate the total star formation rate.
@@ -3471,41 +3504,49 @@ class DARKSAGEConverter(tao.Converter):
         """
         return tree['SfrDisk'] + tree['SfrBulge']
                  
+    def radial_profiles(self, tree):
+        """
+        Returns the annulus arrays of `tree`, shared by all of the
+        computed fields of the tree. They are kept until the next tree,
+        or until the converted tree is released.
+        """
+        key = (id(tree), len(tree))
+        profiles = getattr(self, '_radial_profiles', None)
+        if profiles is None or profiles.key != key:
+            profiles = RadialProfiles(tree, self.num_r_bins)
+            profiles.key = key
+            self._radial_profiles = profiles
+        return profiles
+
+    def release_tree(self, dst_tree):
+        self._radial_profiles = None
+        super(DARKSAGEConverter, self).release_tree(dst_tree)
+
     def totHI(self, tree):
-        arr = tree['DiscHI_1']
-        for i in range(2,31): arr += tree['DiscHI_'+str(i)]
-        return arr
+        return self.radial_profiles(tree).total('DiscHI')
 
     def totH2(self, tree):
-        arr = tree['DiscH2_1']
-        for i in range(2,31): arr += tree['DiscH2_'+str(i)]
-        return arr
-                 
+        return self.radial_profiles(tree).total('DiscH2')
+
     def PseudoBulgeMass(self, tree):
-        DiscMassArr = np.zeros((len(tree),30))
-        DiscRadii = np.zeros((len(tree),30))
-        for i in range(1,31):
-            DiscMassArr[:,i-1] = tree['DiscStars_'+str(i)]
-            DiscRadii[:,i-1] = tree['DiscRadii_'+str(i)]
+        profiles = self.radial_profiles(tree)
+        DiscMassArr = profiles['DiscStars'].copy()
+        DiscRadii = profiles['DiscRadii'][:, 1:]
         DiscRadii_norm = (DiscRadii.T / (0.2*tree['DiskScaleRadius'])).T
         DiscRadii_norm[tree['InstabilityBulgeMass']==0,:] = 1
         DiscMassArr[np.where(DiscRadii_norm>=1)] = 0
         return np.sum(DiscMassArr, axis=1)
                  
     def jStarDisc(self, tree, j_bin):
-        arr = np.zeros(len(tree))
         DiscMass = tree['StellarMass'] - tree['InstabilityBulgeMass'] - tree['MergerBulgeMass']
-        for i in range(1,31): arr += tree['DiscStars_'+str(i)] * j_bin[i-1]
+        arr = self.radial_profiles(tree).moment('DiscStars', j_bin)
         arr[DiscMass>0] = arr[DiscMass>0]/DiscMass[DiscMass>0]
         return arr
                  
     def jPseudoBulge(self, tree, j_bin):
-        DiscMassArr = np.zeros((len(tree),30))
-        DiscRadii = np.zeros((len(tree),30))
-        DiscAngMom = np.zeros((len(tree),30))
-        for i in range(1,31):
-            DiscMassArr[:,i-1] = tree['DiscStars_'+str(i)]
-            DiscRadii[:,i-1] = tree['DiscRadii_'+str(i)]
+        profiles = self.radial_profiles(tree)
+        DiscMassArr = profiles['DiscStars'].copy()
+        DiscRadii = profiles['DiscRadii'][:, 1:]
         DiscRadii_norm = (DiscRadii.T / (0.2*tree['DiskScaleRadius'])).T
         DiscRadii_norm[tree['InstabilityBulgeMass']==0,:] = 1
         DiscMassArr[np.where(DiscRadii_norm>=1)] = 0
@@ -3516,37 +3557,32 @@ class DARKSAGEConverter(tao.Converter):
         return Bulge_j
                  
     def jGas(self, tree, j_bin):
-        arr = np.zeros(len(tree))
         DiscMass = 1.0*tree['ColdGas']
-        for i in range(1,31): arr += tree['DiscGas_'+str(i)] * j_bin[i-1]
+        arr = self.radial_profiles(tree).moment('DiscGas', j_bin)
         arr[DiscMass>0] = arr[DiscMass>0]/DiscMass[DiscMass>0]
         return arr
                 
     def jHI(self, tree, j_bin):
-        arr = np.zeros(len(tree))
-        DiscMass = np.zeros(len(tree))
-        for i in range(1,31):
-            arr += tree['DiscHI_'+str(i)] * j_bin[i-1]
-            DiscMass += tree['DiscHI_'+str(i)]
+        profiles = self.radial_profiles(tree)
+        arr = profiles.moment('DiscHI', j_bin)
+        DiscMass = np.sum(profiles['DiscHI'], axis=1)
         arr[DiscMass>0] = arr[DiscMass>0]/DiscMass[DiscMass>0]
         return arr
                  
     def jH2(self, tree, j_bin):
-        arr = np.zeros(len(tree))
-        DiscMass = np.zeros(len(tree))
-        for i in range(1,31):
-            arr += tree['DiscH2_'+str(i)] * j_bin[i-1]
-            DiscMass += tree['DiscH2_'+str(i)]
+        profiles = self.radial_profiles(tree)
+        arr = profiles.moment('DiscH2', j_bin)
+        DiscMass = np.sum(profiles['DiscH2'], axis=1)
         arr[DiscMass>0] = arr[DiscMass>0]/DiscMass[DiscMass>0]
         return arr
                 
     def RadiusHI(self, tree, h):
-        DiscRadii = np.zeros((len(tree),30))
-        SigmaHI = np.zeros((len(tree),30))
+        profiles = self.radial_profiles(tree)
+        edges = profiles.block('DiscRadii')
         arr = np.zeros(len(tree))
-        for i in range(1,31):
-            DiscRadii[:,i-1] = (tree['DiscRadii_'+str(i)]+tree['DiscRadii_'+str(i-1)])*0.5
-            SigmaHI[:,i-1] = tree['DiscHI_'+str(i)]/(np.pi*(tree['DiscRadii_'+str(i)]**2-tree['DiscRadii_'+str(i-1)]**2))*1e-2*h
+        DiscRadii = profiles.centres()
+        SigmaHI = profiles.block('DiscHI')/(np.pi*(edges[:, 1:]**2-edges[:, :-1]**2))*1e-2*h
+        SigmaHI = SigmaHI.astype(np.float64)
         (row, col) = np.where(SigmaHI>1.0)
         if len(row)>0:
             filt = np.append(np.diff(row)>0, True)
@@ -3557,15 +3593,14 @@ class DARKSAGEConverter(tao.Converter):
         return arr
 
     def RadiusTrans(self, tree):
+        profiles = self.radial_profiles(tree)
+        HI = profiles.block('DiscHI')
+        H2 = profiles.block('DiscH2')
         ratio = np.zeros((len(tree),30))
-        DiscRadii = np.zeros((len(tree),30))
         arr = np.zeros(len(tree))
-        for i in range(1,31):
-            HI = tree['DiscHI_'+str(i)]
-            H2 = tree['DiscH2_'+str(i)]
-            w = np.where((H2>0)&(HI>0))
-            ratio[w,i-1] = HI[w]/H2[w]
-            DiscRadii[:,i-1] = (tree['DiscRadii_'+str(i)]+tree['DiscRadii_'+str(i-1)])/2
+        w = np.where((H2>0)&(HI>0))
+        ratio[w] = HI[w]/H2[w]
+        DiscRadii = profiles.centres()
         (row, col) = np.where(ratio>1.0)
         if len(row)>0:
             ind = np.searchsorted(row, np.unique(row))
@@ -3575,140 +3610,121 @@ class DARKSAGEConverter(tao.Converter):
             arr[row] = arr[row] - np.log10(ratio[row,col])/np.log10(ratio[row,col]/ratio[row,col-1]) * (DiscRadii[row,col]-DiscRadii[row,col-1]) # This could be problematic if the ratio is identical in adjacent annuli
         return arr
     
-    def r50(self, tree):
-        DiscTot = tree['StellarMass'] - tree['InstabilityBulgeMass'] - tree['MergerBulgeMass']
-        DiscArr = np.zeros((len(tree),30))
-        DiscRadii = np.zeros((len(tree),30))
+    def enclosed_radius(self, tree, family, DiscTot, fraction):
+        """
+        Radius enclosing `fraction` of `DiscTot`, interpolated between
+        the outer edges of the annuli of `family`.
+        """
+        profiles = self.radial_profiles(tree)
+        DiscRadii = profiles['DiscRadii'][:, 1:]
         arr = np.zeros(len(tree))
-        for i in range(1,31):
-            DiscArr[:,i-1] = tree['DiscStars_'+str(i)]
-            DiscRadii[:,i-1] = tree['DiscRadii_'+str(i)]
-        ratio = np.cumsum(DiscArr, axis=1)
+        ratio = np.cumsum(profiles[family], axis=1)
         ratio[DiscTot>0] = (ratio[DiscTot>0].T/DiscTot[DiscTot>0]).T # Not actually "ratio" until this line
-        (row, col) = np.where(ratio>=0.5)
+        (row, col) = np.where(ratio>=fraction)
         if len(row)>0:
             ind = np.searchsorted(row, np.unique(row))
             row, col = row[ind], col[ind]
             arr[row] = DiscRadii[row,col]
             row, col = row[col>0], col[col>0]
-            arr[row] = arr[row] - (ratio[row,col]-0.5)/(ratio[row,col]-ratio[row,col-1]) * (DiscRadii[row,col]-DiscRadii[row,col-1])
+            arr[row] = arr[row] - (ratio[row,col]-fraction)/(ratio[row,col]-ratio[row,col-1]) * (DiscRadii[row,col]-DiscRadii[row,col-1])
         return arr
+
+    def r50(self, tree):
+        DiscTot = tree['StellarMass'] - tree['InstabilityBulgeMass'] - tree['MergerBulgeMass']
+        return self.enclosed_radius(tree, 'DiscStars', DiscTot, 0.5)
                  
     def r90(self, tree):
         DiscTot = tree['StellarMass'] - tree['InstabilityBulgeMass'] - tree['MergerBulgeMass']
-        DiscArr = np.zeros((len(tree),30))
-        DiscRadii = np.zeros((len(tree),30))
-        arr = np.zeros(len(tree))
-        for i in range(1,31):
-            DiscArr[:,i-1] = tree['DiscStars_'+str(i)]
-            DiscRadii[:,i-1] = tree['DiscRadii_'+str(i)]
-        ratio = np.cumsum(DiscArr, axis=1)
-        ratio[DiscTot>0] = (ratio[DiscTot>0].T/DiscTot[DiscTot>0]).T # Not actually "ratio" until this line
-        (row, col) = np.where(ratio>=0.9)
-        if len(row)>0:
-            ind = np.searchsorted(row, np.unique(row))
-            row, col = row[ind], col[ind]
-            arr[row] = DiscRadii[row,col]
-            row, col = row[col>0], col[col>0]
-            arr[row] = arr[row] - (ratio[row,col]-0.9)/(ratio[row,col]-ratio[row,col-1]) * (DiscRadii[row,col]-DiscRadii[row,col-1])
-        return arr
+        return self.enclosed_radius(tree, 'DiscStars', DiscTot, 0.9)
 
     def rSFR(self, tree):
-        DiscTot = tree['SfrDisk']
-        DiscArr = np.zeros((len(tree),30))
-        DiscRadii = np.zeros((len(tree),30))
-        arr = np.zeros(len(tree))
-        for i in range(1,31):
-            DiscArr[:,i-1] = tree['DiscSFR_'+str(i)]
-            DiscRadii[:,i-1] = tree['DiscRadii_'+str(i)]
-        ratio = np.cumsum(DiscArr, axis=1)
-        ratio[DiscTot>0] = (ratio[DiscTot>0].T/DiscTot[DiscTot>0]).T # Not actually "ratio" until this line
-        (row, col) = np.where(ratio>=0.5)
-        if len(row)>0:
-            ind = np.searchsorted(row, np.unique(row))
-            row, col = row[ind], col[ind]
-            arr[row] = DiscRadii[row,col]
-            row, col = row[col>0], col[col>0]
-            arr[row] = arr[row] - (ratio[row,col]-0.5)/(ratio[row,col]-ratio[row,col-1]) * (DiscRadii[row,col]-DiscRadii[row,col-1])
-        return arr
+        return self.enclosed_radius(tree, 'DiscSFR', tree['SfrDisk'], 0.5)
                  
     def StellarDiscMass(self,tree):
         return tree['StellarMass'] - tree['InstabilityBulgeMass'] - tree['MergerBulgeMass']
 
-    def dZStar(self, tree):
+    def radial_metallicity_gradient(self, tree, mass_field, metals_field,
+                                    valid):
+        """
+        Slope of log10 metallicity against annulus radius (in kpc/h) for
+        every galaxy in the tree at once.
+
+        Annuli are walked outwards while the enclosed fraction of the
+        stellar disc mass is at most 0.9, and an annulus is fitted if the
+        enclosed fraction has passed 0.5 and both its `mass_field` and
+        `metals_field` are positive. The slope is the least-squares fit
+        over the fitted annuli, and is 0 for galaxies with fewer than
+        three of them or that are not `valid`.
+        """
         ngals = len(tree)
+        nbins = self.num_r_bins
+        profiles = self.radial_profiles(tree)
+        stars = profiles['DiscStars']
+        mass = profiles.block(mass_field)
+        metals = profiles.block(metals_field)
+        radii = profiles.block('DiscRadii')
+
+        DiscMass = tree['StellarMass'] - tree['InstabilityBulgeMass'] - \
+            tree['MergerBulgeMass']
+        valid = valid & (DiscMass > 0)
+        inv_discmass = np.zeros(ngals)
+        inv_discmass[valid] = 1.0 / DiscMass[valid].astype(np.float64)
+
+        # Enclosed disc mass fraction, and whether the walk outwards
+        # reaches each annulus before the fraction exceeds 0.9.
+        frac = np.cumsum(stars * inv_discmass[:, None], axis=1)
+        reached = np.ones((ngals, nbins), dtype=bool)
+        reached[:, 1:] = np.maximum.accumulate(frac, axis=1)[:, :-1] <= 0.9
+
+        mask = reached & (frac > 0.5) & (mass > 0.0) & (metals > 0.0)
+        mask &= valid[:, None]
+
+        # The annulus radii are rounded to single precision before the
+        # fit, as the metallicities are.
+        rad = (radii[:, 1:] + radii[:, :-1]).astype(np.float64) * 0.5 * 1e3
+        rad = rad.astype(np.float32).astype(np.float64)
+        Z = np.zeros((ngals, nbins))
+        Z[mask] = np.log10(metals[mask] / mass[mask])
+
+        # Closed-form least squares on the masked annuli.
+        n = mask.sum(axis=1)
+        nn = np.maximum(n, 1)
+        x = np.where(mask, rad, 0.0)
+        y = np.where(mask, Z, 0.0)
+        xbar = x.sum(axis=1) / nn
+        ybar = y.sum(axis=1) / nn
+        dx = np.where(mask, rad - xbar[:, None], 0.0)
+        dy = np.where(mask, Z - ybar[:, None], 0.0)
+        sxx = (dx * dx).sum(axis=1)
+        sxy = (dx * dy).sum(axis=1)
+
         grad = np.zeros(ngals)
-        num_r_bins = self.num_r_bins + 1
-        for g, gal in enumerate(tree):
-            DiscMass = gal['StellarMass'] - gal['InstabilityBulgeMass'] - gal['MergerBulgeMass']
-            if DiscMass<=0: continue
-            inv_discmass = 1.0/DiscMass
-
-            val = 0
-            rad = np.zeros(num_r_bins, dtype=np.float32)
-            Z = np.zeros(num_r_bins, dtype=np.float32)
-            mask = np.zeros(num_r_bins, dtype=np.bool)
-            for i in range(1,num_r_bins):
-                val += gal['DiscStars_'+str(i)] * inv_discmass
-                if val > 0.5 and gal['DiscStars_'+str(i)] > 0.0 and gal['DiscStarsMetals_'+str(i)] > 0.0:
-                    rad[i] = (gal['DiscRadii_'+str(i)] + gal['DiscRadii_'+str(i-1)]) * 0.5 * 1e3 
-                    Z[i] = np.log10(gal['DiscStarsMetals_'+str(i)]/gal['DiscStars_'+str(i)])
-                    mask[i] = True
-                    
-                if val>0.9:
-                    break
-
-            rad = rad[mask]
-            Z = Z[mask]
-            if len(rad) > 2:
-                A = np.vstack([rad, np.ones(len(rad))]).T
-                m, c = np.linalg.lstsq(A, Z)[0]
-                grad[g] = m
-                
+        fit = (n > 2) & (sxx > 0)
+        grad[fit] = sxy[fit] / sxx[fit]
 
+        # All fitted annuli at the same radius: the minimum-norm solution
+        # that lstsq would have returned.
+        flat = (n > 2) & (sxx == 0)
+        grad[flat] = xbar[flat] * ybar[flat] / (xbar[flat]**2 + 1)
         return grad
 
+    def dZStar(self, tree):
+        valid = np.ones(len(tree), dtype=bool)
+        return self.radial_metallicity_gradient(tree, 'DiscStars',
+                                                'DiscStarsMetals', valid)
+
     def dZGas(self, tree):
-        ngals = len(tree)
-        grad = np.zeros(ngals)
-        num_r_bins = self.num_r_bins + 1
-        for g, gal in enumerate(tree):
-            DiscMass = gal['StellarMass'] - gal['InstabilityBulgeMass'] - gal['MergerBulgeMass']
-            if gal['ColdGas'] <= 0 or DiscMass <= 0: continue
-            inv_discmass = 1.0/DiscMass
-
-            val = 0
-            rad = np.zeros(num_r_bins, dtype=np.float32)
-            Z = np.zeros(num_r_bins, dtype=np.float32)
-            mask = np.zeros(num_r_bins, dtype=np.bool)
-            for i in range(1, num_r_bins):
-                val += gal['DiscStars_'+str(i)] * inv_discmass
-                if val > 0.5 and gal['DiscGas_'+str(i)] > 0.0 and gal['DiscGasMetals_'+str(i)] > 0.0:
-                    rad[i] = (gal['DiscRadii_'+str(i)] + gal['DiscRadii_'+str(i-1)]) * 0.5 * 1e3
-                    Z[i] =  np.log10(gal['DiscGasMetals_'+str(i)]/gal['DiscGas_'+str(i)])
-                    mask[i] = True
-                    
-                if val>0.9:
-                    break
-                    
-            rad = rad[mask]
-            Z = Z[mask]
-            if len(rad)>2:
-                A = np.vstack([rad, np.ones(len(rad))]).T
-                m, c = np.linalg.lstsq(A, Z)[0]
-                grad[g] = m
-                
-        return grad
+        valid = tree['ColdGas'] > 0
+        return self.radial_metallicity_gradient(tree, 'DiscGas',
+                                                'DiscGasMetals', valid)
     
     def MetalsStellarDiscMass(self, tree):
         return tree['MetalsStellarMass'] - tree['MetalsInstabilityBulgeMass'] - tree['MetalsMergerBulgeMass']
     
     def MetalsPseudoBulge(self, tree):
-        DiscMassArr = np.zeros((len(tree),30))
-        DiscRadii = np.zeros((len(tree),30))
-        for i in range(1,31):
-            DiscMassArr[:,i-1] = tree['DiscStarsMetals_'+str(i)]
-            DiscRadii[:,i-1] = tree['DiscRadii_'+str(i)]
+        profiles = self.radial_profiles(tree)
+        DiscMassArr = profiles['DiscStarsMetals'].copy()
+        DiscRadii = profiles['DiscRadii'][:, 1:]
         DiscRadii_norm = (DiscRadii.T / (0.2*tree['DiskScaleRadius'])).T
         DiscRadii_norm[tree['InstabilityBulgeMass']==0,:] = 1
         DiscMassArr[np.where(DiscRadii_norm>=1)] = 0
@@ -3718,6 +3734,15 @@ class DARKSAGEConverter(tao.Converter):
         """Convert SAGE dT values to Gyrs"""
         return tree['dT'] * 1e-3
 
+    def get_tree_census(self):
+        """Count the trees and galaxies in the SAGE output. The headers
+        are only read the first time."""
+        census = getattr(self, '_tree_census', None)
+        if census is None:
+            census = tao.SAGEReader.census(self.args.trees_dir)
+            self._tree_census = census
+        return census
+
     def iterate_trees(self):
         """Iterate over SAGE trees."""
 
@@ -3842,40 +3867,23 @@ class DARKSAGEConverter(tao.Converter):
         assert from_file_dtype.itemsize == 1544, "Size of datatypes do not match"
         ordered_dtype.extend(computed_field_list)
         src_type = np.dtype(ordered_dtype)
+        transfer = TransferPlan(from_file_dtype, src_type)
         # print("src_type = {0}".format(src_type))
 
-        entries = [e for e in os.listdir(self.args.trees_dir)
-                   if os.path.isfile(os.path.join(self.args.trees_dir, e))]
-        entries = [e for e in entries if e.startswith('model_z')]
-        redshift_strings = list(set([re.match(r'model_z(\d+\.?\d*)_\d+', e).group(1)
-                                     for e in entries]))
-        group_strings = list(set([re.match(r'model_z\d+\.?\d*_(\d+)', e).group(1)
-                                  for e in entries]))
-
-        group_strings.sort(lambda x, y: -1 if int(x) < int(y) else 1)
-        redshift_strings.sort(lambda x, y: 1 if float(x) < float(y) else -1)
+        group_strings, redshift_strings = \
+            tao.SAGEReader.find_files(self.args.trees_dir)
 
-        totntrees = 0L
-        for group in group_strings:
-            # redshift array is sorted -> pick the last redshift
-            redshift = redshift_strings[-1]
-            fn = 'model_z%s_%s' % (redshift, group)
-            with open(os.path.join(self.args.trees_dir, fn), 'rb') as f:
-                n_trees = np.fromfile(f, np.uint32, 1)[0]
-                totntrees += n_trees
+        totntrees = self.get_tree_census()[0]
 
         numtrees_processed = 0
         cumul_time = 0.0
         for group in group_strings:
-            files = []
-            for redshift in redshift_strings:
-                fn = 'model_z%s_%s' % (redshift, group)
-                files.append(open(os.path.join(self.args.trees_dir, fn), 'rb'))
-
-            n_trees = [np.fromfile(f, np.uint32, 1)[0] for f in files][0]
-            n_gals = [np.fromfile(f, np.uint32, 1)[0] for f in files]
-            chunk_sizes = [np.fromfile(f, np.uint32, n_trees) for f in files]
-            tree_sizes = sum(chunk_sizes)
+            reader = tao.SAGEReader(
+                [os.path.join(self.args.trees_dir,
+                              'model_z%s_%s' % (redshift, group))
+                 for redshift in redshift_strings], from_file_dtype)
+            n_trees = reader.n_trees
+            tree_sizes = reader.tree_sizes
             print("Working on files written by cpu #{0}".format(group))
             
             # for ii in trange(n_trees):
@@ -3884,9 +3892,8 @@ class DARKSAGEConverter(tao.Converter):
                 tree_size = tree_sizes[ii]
                 tree = np.empty(tree_size, dtype=src_type)
                 offs = 0
-                for jj in xrange(len(chunk_sizes)):
-                    chunk_size = chunk_sizes[jj][ii]
-                    data = np.fromfile(files[jj], from_file_dtype, chunk_size)
+                for data in reader.chunks(ii):
+                    chunk_size = len(data)
 
                     ## MS 13/07/2018.
                     ## from numpy 1.13, the assignment of structured arrays
@@ -3894,8 +3901,7 @@ class DARKSAGEConverter(tao.Converter):
                     ## across by default. Now, essentially the memory 
                     ## is directly copied without regard for the actual
                     ## column names. (I would argue this is a regression)
-                    for _v in data.dtype.names:
-                        tree[_v][offs:offs + chunk_size] = data[_v][:]
+                    transfer.copy(data, tree[offs:offs + chunk_size])
 
                     offs += chunk_size
 
@@ -3974,8 +3980,7 @@ class DARKSAGEConverter(tao.Converter):
                 
                 yield tree
 
-            for file in files:
-                file.close()
+            reader.close()
 
             t_file_end = time.time()
             time_this_file = t_file_end - t_file_start
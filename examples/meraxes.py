@@ -8,6 +8,7 @@ import re
 import os
 import numpy as np
 import tao
+from tao.kernels import peak_history
 from collections import OrderedDict
 from tqdm import tqdm, trange
 import h5py
@@ -503,6 +504,7 @@ class MERAXESConverter(tao.Converter):
         self.src_fields_dict = src_fields_dict
         self.sim_file = ''
         self.snapshots = []
+        self.forest_layouts = dict()
         super(MERAXESConverter, self).__init__(*args, **kwargs)
     
 
@@ -525,6 +527,9 @@ class MERAXESConverter(tao.Converter):
                             'hydro simulation')
         parser.add_argument('--model-name', help='name of the SAM. Set to '
                             'simulation name for a hydro sim')
+        parser.add_argument('--read-buffer-size', type=float, default=256,
+                            help='memory in MB used to read the snapshot '
+                            'datasets of a core in blocks (default: 256)')
 
     def read_input_params(self, fname, quiet=False):
         """ Read in the input parameters from a Meraxes hdf5 output file.
@@ -644,10 +649,10 @@ class MERAXESConverter(tao.Converter):
 
     def get_tree_counts_and_offset(self, icore):
         r"""
-        Returns an array of offsets and lengths into the h5py
-        file for each tree at each snapshot.
+        Returns the offsets and lengths into the h5py file for each
+        tree at each snapshot.
 
-        These two arrays and the snapshot fully determine the
+        These and the snapshot fully determine the
         galaxies of *any* tree -- i.e., the offset in the dataset
         for that snapshot and the number of galaxies to read in.
         
@@ -665,29 +670,15 @@ class MERAXESConverter(tao.Converter):
 
         Returns
         ---------
-        forestids : array, np.int64
-             The forestIDs at the last snapshot that the following dictionaries
-             contain as keys
-        
-        tree_counts : 2-dimensional int64 array, indexed by [forest, snapshot]
-             Gives the number of galaxies per snapshot per forest.
-
-             The forests correspond to the order returned in forestids.
-        
-        tree_offsets : 2-dimensional int64 array, indexed by [forest, snapshot]
-             Gives the starting offset per forest per snapshot within the hdf5
-             snapshot dataset for that forest. The offset is the number of
-             galaxies preceeding that forest in that snapshot. The offset is
-             the number of galaxies preceeding this tree  *AND NOT* the bytes
-             offset.
-
-             The forests correspond to the order returned in forestids.
-        
-        tree_first_snap : int32 array, indexed by [forest]
-              First snapshot (highest redshift, earliest time) that the 
-              tree is present.
-
-              The forests correspond to the order returned in forestids.
+        forest_index : tao.ForestIndex
+             The forests present at the last snapshot, in ascending order
+             of ForestID (`forest_index.forest_ids`). For every snapshot
+             at which a forest has galaxies, the index holds their number
+             and the starting offset of the forest within the hdf5
+             snapshot dataset. The offset is the number of galaxies
+             preceeding this tree *AND NOT* the bytes offset. Only those
+             snapshots are stored, so the index grows with the number of
+             galaxies rather than forests times snapshots.
 
         ngalaxies_per_snap: int64 array of length (max(snaps) + 1), so that
               the array can be directly indexed by the snapshot number
@@ -719,90 +710,125 @@ class MERAXESConverter(tao.Converter):
             else:
                 galaxies = snap_group['{0}/Galaxies'.\
                                           format(this_core_group)]
+                # Sorted, so that forests can be looked up with
+                # searchsorted.
                 last_snap_forestids = np.unique(galaxies['ForestID'])
                 last_snap_nforests = len(last_snap_forestids)
-                last_snap_forestids_to_array_index = dict()
 
-                for ii, fid in enumerate(last_snap_forestids):
-                    last_snap_forestids_to_array_index[fid] = ii
-                
-                tree_first_snap = np.empty(last_snap_nforests, dtype=np.int32)
-                tree_counts = np.zeros((last_snap_nforests, maxsnap + 1), dtype=np.int64)
-                tree_offsets = np.zeros((last_snap_nforests, maxsnap + 1), dtype=np.int64)
-
-                tree_first_snap.fill(all_snaps[0])
+                # Entries of the forest index, one array per snapshot.
+                entry_forests = []
+                entry_snaps = []
+                entry_counts = []
+                entry_offsets = []
 
                 for snap in tqdm(all_snaps):
                     this_snap_group = fin['Snap{0:03d}'.format(snap)]
                     galaxies = this_snap_group['{0}/Galaxies'.\
                                                    format(this_core_group)]
+                    if len(galaxies) == 0 or last_snap_nforests == 0:
+                        continue
                     forestids = galaxies['ForestID']
-                    nforests = len(forestids)
-                    if nforests > 0:
-                        
-                        sorted_uniq_fids, \
-                            orig_idx, \
-                            sorted_nhalos = np.unique(forestids, 
-                                                      return_index=True,
-                                                      return_counts=True)
-                            
-                        last_fid_inds = np.in1d(sorted_uniq_fids,
-                                                last_snap_forestids,
-                                                assume_unique=True)
-                        unique_last_forestids = np.intersect1d(
-                            last_snap_forestids,
-                            sorted_uniq_fids,
-                            assume_unique=True)
-                        unique_last_forestids_nhalos = sorted_nhalos[last_fid_inds]
-                        assert bool(np.all(sorted_uniq_fids[last_fid_inds] == unique_last_forestids))
-                        insertion_index = [last_snap_forestids_to_array_index[fid] for fid in unique_last_forestids]
-                        tree_counts[insertion_index, snap] = unique_last_forestids_nhalos
-
-                        # Check that all values in unique_last_forestids are in last_snap_forestids
-                        check_fid_inds = np.in1d(unique_last_forestids, last_snap_forestids)
-                        assert bool(np.all(check_fid_inds))
-
-                        ngalaxies_per_snap[snap] = unique_last_forestids_nhalos.sum()
-                        tree_first_snap[insertion_index] = snap
-
-                        # This is complicated offset manipulation
-                        # The sorted_nhalos corresponds to the sorted
-                        # unique forestids. However, what I need is the
-                        # offsets in "file order" forestids.
-
-                        # Sorting `orig_idx` gives me the order
-                        # of appearance of the forest within the file
-                        
-                        # Contains *ALL* forests at this snapshot
-                        # and is *AT LEAST* the same size as the final
-                        # snapshot forests. So the file offsets must be
-                        # computed over *ALL* forests, only computing over
-                        # forests at last snapshot will be wrong. 
-                        file_order = np.argsort(orig_idx)
-                        file_fids = sorted_uniq_fids[file_order]
-                        nhalos = sorted_nhalos[file_order]
-                        offsets = np.zeros(len(file_order), dtype=np.int64)
-
-                        # The first offset is *always* 0 since the
-                        # the first tree in file order *must* begin
-                        # at the 0'th array index. The first tree begins
-                        # offset = nhalos(first tree). Thus, the cumulative
-                        # sum is over the entire array, but the array is 
-                        # shifted by 1 during the assignment (ie., cumul[0]
-                        # goes to offset[1], cumul[1] goes to offset[2]) .
-                        offsets[1:] = (nhalos.cumsum())[0:-1]
-
-                        # Now simply pick the offsets for the trees
-                        # that are present at the last snapshot. However, it
-                        # is possible that some forests present at this
-                        # snapshot are *NOT* present at the final snapshot. 
-                        # So only assign for the ones that *ARE* present 
-                        tree_offsets[insertion_index, snap] = offsets[last_fid_inds]
+
+                    # The galaxies of a forest are stored next to each
+                    # other, so every forest at this snapshot is one run
+                    # of equal ForestIDs. The start of the run is the
+                    # file offset of the forest, and its length the
+                    # number of galaxies.
+                    run_starts = np.flatnonzero(forestids[1:] != forestids[:-1]) + 1
+                    run_starts = np.concatenate(([0], run_starts))
+                    run_fids = forestids[run_starts]
+                    run_counts = np.diff(np.append(run_starts, len(forestids)))
+                    sorted_run_fids = np.sort(run_fids)
+                    split = np.flatnonzero(sorted_run_fids[1:] ==
+                                           sorted_run_fids[:-1])
+                    if len(split) > 0:
+                        msg = "Galaxies of ForestID = {0} are not stored "\
+                            "contiguously in snapshot {1} on core {2}"\
+                            .format(sorted_run_fids[split[0]], snap, icore)
+                        raise ValueError(msg)
+
+                    # Keep only the forests that are present at the last
+                    # snapshot.
+                    index = np.searchsorted(last_snap_forestids, run_fids)
+                    index[index == last_snap_nforests] = 0
+                    present = last_snap_forestids[index] == run_fids
+                    index = index[present]
+
+                    entry_forests.append(index)
+                    entry_snaps.append(np.full(len(index), snap, dtype=np.int32))
+                    entry_counts.append(run_counts[present])
+                    entry_offsets.append(run_starts[present])
+                    ngalaxies_per_snap[snap] = run_counts[present].sum()
+
+                def entries(arrays, dtype):
+                    if arrays:
+                        return np.concatenate(arrays)
+                    return np.empty(0, dtype=dtype)
+
+                forest_index = tao.ForestIndex(
+                    last_snap_forestids,
+                    entries(entry_forests, np.int64),
+                    entries(entry_snaps, np.int32),
+                    entries(entry_counts, np.int64),
+                    entries(entry_offsets, np.int64))
                         
-        return last_snap_forestids, tree_counts, tree_offsets, tree_first_snap, ngalaxies_per_snap
+        return forest_index, ngalaxies_per_snap
 
     
     
+    def get_forest_layouts(self):
+        r"""
+        Returns the layout of every core, as computed by
+        `get_tree_counts_and_offset`, in a dictionary keyed by core.
+
+        The layouts are saved in a sidecar file next to the MERAXES
+        file, so that later runs load them instead of scanning every
+        snapshot. They are kept in `forest_layouts` until
+        `iterate_trees` is done with each core.
+        """
+        if self.forest_layouts:
+            return self.forest_layouts
+
+        sim_file = self.get_simfilename()
+        with h5py.File(sim_file, "r") as fin:
+            ncores = fin.attrs['NCores'][0]
+
+        def build():
+            arrays = dict()
+            for icore in range(ncores):
+                forest_index, ngalaxies_per_snap = \
+                    self.get_tree_counts_and_offset(icore)
+                prefix = 'core{0:d}_'.format(icore)
+                for name, values in forest_index.to_arrays().items():
+                    arrays[prefix + name] = values
+                arrays[prefix + 'ngalaxies_per_snap'] = ngalaxies_per_snap
+            return arrays
+
+        arrays = self.cached_index(sim_file + '.tao-index.npz', [sim_file],
+                                   build)
+        for icore in range(ncores):
+            prefix = 'core{0:d}_'.format(icore)
+            core_arrays = dict((k[len(prefix):], v)
+                               for k, v in arrays.items()
+                               if k.startswith(prefix))
+            ngalaxies_per_snap = core_arrays.pop('ngalaxies_per_snap')
+            self.forest_layouts[icore] = (
+                tao.ForestIndex.from_arrays(core_arrays), ngalaxies_per_snap)
+
+        return self.forest_layouts
+
+    def get_tree_census(self):
+        r"""
+        Returns the total number of forests and galaxies over all cores.
+        """
+        n_trees = 0
+        n_galaxies = 0
+        for forest_index, _ in self.get_forest_layouts().values():
+            n_trees += len(forest_index)
+            n_galaxies += forest_index.n_galaxies
+
+        return n_trees, n_galaxies
+
     def get_snapshot_redshifts(self):
         """Parse and convert the expansion factors.
 
@@ -952,27 +978,56 @@ class MERAXESConverter(tao.Converter):
         """
         Calculates the max. of Vmax during the halo history
         """
-        vpeak = np.empty(len(tree), np.float32)
+        return peak_history(tree['ID'], tree['snapnum'], tree['Vmax'])
 
-        # By pre-filling vpeak with Vmax, I don't have to
-        # worry about cases where there are no descendants
-        # (although the code should cover that case)
-        vpeak[:] = tree['Vmax']
-
-        sorted_ind = np.argsort(tree, order=('ID', 'snapnum'))
-        all_vmax = tree['Vmax']
-        all_gal_idx = tree['ID']
-        vmax = []
-        curr_idx = all_gal_idx[sorted_ind[0]]
-        for ii, idx in enumerate(all_gal_idx[sorted_ind]):
-            if curr_idx != idx:
-                vmax = []
-                curr_idx = idx
+    def classify_mergers(self, tree):
+        """
+        Fills the merger fields of galaxies that merge into another galaxy.
 
-            vmax.append(all_vmax[sorted_ind[ii]])
-            vpeak[sorted_ind[ii]] = max(vmax)
+        A galaxy whose descendant has a different ID has merged, and the
+        merging galaxy must then be the last occurrence of its ID in the
+        tree. The check is done by sorting on (ID, snapnum), which brings
+        the last snapshot of every ID to the end of its group.
+        """
+        ids = tree['ID']
+        snapnums = tree['snapnum']
+        descs = tree['Descendant']
+
+        ind = (np.where(descs != -1))[0]
+        desc_ind = descs[ind]
+        merged = ids[ind] != ids[desc_ind]
+        ind = ind[merged]
+        desc_ind = desc_ind[merged]
+        if len(ind) == 0:
+            return
+
+        # Last snapshot at which each galaxy ID is present.
+        order = np.lexsort((snapnums, ids))
+        sorted_ids = ids[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = sorted_ids[1:] != sorted_ids[:-1]
+        group = np.cumsum(last) - last
+        last_snap = np.empty(len(tree), dtype=snapnums.dtype)
+        last_snap[order] = snapnums[order][last][group]
+
+        bad = ind[snapnums[ind] < last_snap[ind]]
+        if len(bad) > 0:
+            gid = ids[bad[0]]
+            future = (np.where((snapnums > snapnums[bad[0]]) &
+                               (ids == gid)))[0]
+            msg = 'Error: Galaxy with ID = {0} '\
+                'at snapshot = {1} has descendant ID = '\
+                '{2} (which is different) but this galaxy '\
+                'exists at future snapshots. Num Tree matches '\
+                'in the future snaps = {3}. snaps = {4} with '\
+                'iD = {5}'.format(gid, snapnums[bad[0]],
+                                  ids[descs[bad[0]]], len(future),
+                                  snapnums[future], ids[future])
+            raise tao.ConversionError(msg)
 
-        return vpeak
+        tree['mergeIntoID'][ind] = ids[desc_ind]
+        tree['mergeIntoSnapNum'][ind] = snapnums[desc_ind]
+        tree['mergetype'][ind] = 2
 
     def sfrdisk(self, tree):
         """
@@ -1069,8 +1124,8 @@ class MERAXESConverter(tao.Converter):
         lt_times = lt_times[rev_sorted_ind]
         dt_values = np.ediff1d(lt_times, to_begin=lt_times[0])
         
-        ntrees = self.get_ntrees()
-        totntrees = sum(ntrees.values())
+        layouts = self.get_forest_layouts()
+        totntrees = sum(len(layout[0]) for layout in layouts.values())
 
         array_fields = []
         with h5py.File(sim_file, "r") as fin:
@@ -1098,36 +1153,55 @@ class MERAXESConverter(tao.Converter):
         with h5py.File(sim_file, "r") as fin:
 
             for icore in range(ncores):
-                ntrees_this_core = ntrees[icore]
+                forest_index, ngalaxies_per_snap = layouts.pop(icore)
+                ntrees_this_core = len(forest_index)
                 print("Working on {0} trees on core = {1}".format(ntrees_this_core, icore))
+                # Every snapshot dataset is read through a BlockReader, so
+                # that the galaxies of many forests are loaded with a
+                # single read. The memory budget is shared between all of
+                # the datasets on this core.
+                datasets = []
+                for snap in snaps:
+                    datasets.append(fin['Snap{0:03d}/Core{1:d}/Galaxies'.
+                                        format(snap, icore)])
+                    if snap != max(snaps):
+                        datasets.append(fin['Snap{0:03d}/Core{1:d}/DescendantIndices'.
+                                            format(snap, icore)])
+                buffer_size = self.args.read_buffer_size * 1024**2
+                readers = iter(tao.BlockReader.split(buffer_size, datasets))
                 fin_galaxies_per_snap = dict()
                 descendant_fin_per_snap = dict()
                 for snap in snaps:
-                    fin_galaxies_per_snap[snap] = fin['Snap{0:03d}/Core{1:d}/Galaxies'.
-                                                      format(snap, icore)]
+                    fin_galaxies_per_snap[snap] = next(readers)
                     if snap != max(snaps):
-                        descendant_fin_per_snap[snap] = fin['Snap{0:03d}/Core{1:d}/DescendantIndices'.
-                                                            format(snap, icore)]
+                        descendant_fin_per_snap[snap] = next(readers)
 
-                tree_fids, tree_counts, tree_offsets, tree_first_snap, ngalaxies_per_snap = self.get_tree_counts_and_offset(icore)
+                tree_fids = forest_index.forest_ids
                 converted_ngalaxies_per_snap = np.zeros(max(snaps) + 1, dtype=np.int64)
 
                 nforests = len(tree_fids)
 
-                # trange is shortcut for tqdm( [x]range(length))
-                for iforest in trange(nforests, total=nforests):
+                # Visit the forests in the order they are stored in the
+                # file, so that the readers only ever move forward, but
+                # yield them in ascending ForestID order. Forests read
+                # before their turn are held until then, within the same
+                # memory budget as the readers. Nothing is held when the
+                # file is stored in ForestID order.
+                read_ahead = tao.ReadAhead(forest_index.read_order(),
+                                           buffer_size)
+
+                for iforest in tqdm(read_ahead, total=nforests):
                     forest = tree_fids[iforest]
                     
-                    # number of galaxies per snapshot for this forest
-                    ngalaxies = tree_counts[iforest]
-
-                    # array offset per snapshot for this forest within the
-                    # hdf5 dataset
-                    offsets = tree_offsets[iforest]
+                    # snapshots at which this forest has galaxies, from
+                    # the latest to the earliest, with the number of
+                    # galaxies and their offset within the hdf5 dataset
+                    forest_snaps, ngalaxies, offsets = \
+                        forest_index.entries(iforest)
 
                     # total number of galaxies in the forest
                     # (the sum is over snapshots)
-                    tree_size = ngalaxies.sum()
+                    tree_size = forest_index.sizes[iforest]
                     if tree_size == 0:
                         msg = "Number of galaxies in forest # {0} with "\
                             "ForestID = {1} is 0. Bug in code"\
@@ -1139,28 +1213,24 @@ class MERAXESConverter(tao.Converter):
                     tree = np.empty(tree_size, dtype=src_type)
                     
                     offs = 0
-                    first_snap = tree_first_snap[iforest]
-                    good_snaps = np.arange(snaps[0], first_snap-1, -1)
                     ngalaxies_future_snap = 0
                     future_snap = -1
-                    for snap in good_snaps:
-                        ngalaxies_this_snap = tree_counts[iforest, snap]
-                        if ngalaxies_this_snap == 0:
-                            continue
-                        
+                    for snap, ngalaxies_this_snap, start_offset in \
+                            zip(forest_snaps.tolist(), ngalaxies.tolist(),
+                                offsets.tolist()):
                         converted_ngalaxies_per_snap[snap] += ngalaxies_this_snap
                         
                         # print("Reading from 'Snap{0:03d}/Core{1:d}/Galaxies' ngalaxies_this_snap = {2}".
                         #       format(snap, icore, ngalaxies_this_snap))
                         galaxies = fin_galaxies_per_snap[snap]
-                        start_offset = tree_offsets[iforest, snap] #(vertical_tree_offsets[forest])[snap]
                         #print("snap = {3} forest = {0} ngalaxies = {2} start_offset = {1}".format(forest, start_offset, ngalaxies_this_snap, snap))
-                        source_sel = np.s_[start_offset: start_offset + ngalaxies_this_snap]
                         dest_sel = np.s_[offs:offs + ngalaxies_this_snap]
-                        gal_data = galaxies[source_sel]
-                        if snap != max(good_snaps):
+                        gal_data = galaxies.read(start_offset,
+                                                 ngalaxies_this_snap)
+                        if snap != snaps[0]:
                             descendants = descendant_fin_per_snap[snap]
-                            descs = descendants[source_sel]
+                            descs = descendants.read(start_offset,
+                                                     ngalaxies_this_snap).copy()
                             
                             # Fix the descendant offset
                             descs[descs > -1] += (offs - prev_offset -
@@ -1195,7 +1265,7 @@ class MERAXESConverter(tao.Converter):
 
                         this_centrals = tree['CentralGal'][dest_sel]
                         centralgalind = (np.where(this_centrals >= 0))[0]
-                        prev_offset = tree_offsets[iforest, snap]
+                        prev_offset = start_offset
                         if len(centralgalind) > 0:
                             min_this_centrals = min(this_centrals[centralgalind])
                             if (min_this_centrals + offs - prev_offset) < 0:
@@ -1221,7 +1291,7 @@ class MERAXESConverter(tao.Converter):
                                     'this_centrals = {7}'\
                                     .format(snap, offs, offs+ngalaxies_this_snap,
                                             min(this_centrals[centralgalind]), max(this_centrals),
-                                            min(galaxies['CentralGal']), max(galaxies['CentralGal']),
+                                            min(galaxies.dataset['CentralGal']), max(galaxies.dataset['CentralGal']),
                                             this_centrals)
                                     
                                 raise ValueError(msg)
@@ -1287,39 +1357,7 @@ class MERAXESConverter(tao.Converter):
                     tree['mergeIntoID'] = -1
                     tree['mergeIntoSnapNum'] = -1
                     tree['mergetype'] = 0
-                    for gal in tree:
-                        gid, d = gal['ID'], gal['Descendant']
-                        # no valid descendant, nothing to verify
-                        if d == -1:
-                            continue
-
-                        if gid == tree['ID'][d]:
-                            # The galaxy continues as itself
-                            gal['mergeIntoID'] = -1
-                            gal['mergeIntoSnapNum'] = -1
-                            gal['mergetype'] = 0
-                            continue
-                        
-                        else:
-                            
-                            ind = (np.where((tree['snapnum'] > gal['snapnum']) &
-                                           (tree['ID'] == gid)))[0]
-                            if len(ind) > 0:
-                                msg = 'Error: Galaxy with ID = {0} '\
-                                     'at snapshot = {1} has descendant ID = '\
-                                     '{2} (which is different) but this galaxy '\
-                                     'exists at future snapshots. Num Tree matches '\
-                                     'in the future snaps = {3}. snaps = {4} with '\
-                                     'iD = {5}'.format(gid, gal['snapnum'],
-                                                       tree['ID'][d], len(ind),
-                                                       tree['snapnum'][ind],
-                                                       tree['ID'][ind])
-                                Tracer()()
-                                raise tao.ConversionError(msg)
-                            
-                            gal['mergeIntoID'] = tree['ID'][d]
-                            gal['mergeIntoSnapNum'] = tree['snapnum'][d]
-                            gal['mergetype'] = 2
+                    self.classify_mergers(tree)
                     
                     
                     # Populate the field with galaxy ages (required by TAO SED module) 
@@ -1356,7 +1394,8 @@ class MERAXESConverter(tao.Converter):
                                        "Central Galaxy ID must equal GalaxyID for centrals"
 
 
-                    yield tree
+                    for tree in read_ahead.put(iforest, tree):
+                        yield tree
 
                 # Now validate that *ALL* galaxies on this core
                 # were transferred
@@ -7,6 +7,8 @@ from __future__ import print_function
 import re, os
 import numpy as np
 import tao
+from tao.kernels import history_descendants, peak_history
+from tao.records import TransferPlan
 from collections import OrderedDict
 from tqdm import tqdm
 
@@ -670,28 +672,17 @@ class SAGEConverter(tao.Converter):
         on the snapshot ordering of the input data, the GalaxyIndex field,
         and the mergeIntoID field.
         """
-        descs = np.empty(len(tree), np.int32)
-        descs.fill(-1)
-
         """
         Now my attempt at this mapping descendants
         First, sort the entire tree into using GalaxyIndex as
         primary key and then snapshot number as secondary key.
         This sorted indices will naturally flow a galaxy from
         earlier times (lower snapshot numbers) to later times (larger
-        snapshot number)
+        snapshot number), so each galaxy is linked to the next entry
+        if it has the same GalaxyIndex.
         """
-        sorted_ind = np.argsort(tree, order=('GalaxyIndex', 'SnapNum'))
-        all_gal_idx = tree['GalaxyIndex']
-        for ii, idx in enumerate(all_gal_idx[sorted_ind]):
-            jj = ii + 1
-            if (jj < len(tree)) and (idx == all_gal_idx[sorted_ind[jj]]):
-                assert descs[sorted_ind[ii]] == -1
-                # assert tree['SnapNum'][sorted_ind[jj]] > \
-                #     tree['SnapNum'][sorted_ind[ii]]
-                # assert tree['GalaxyIndex'][sorted_ind[ii]] == \
-                #     tree['GalaxyIndex'][sorted_ind[jj]]
-                descs[sorted_ind[ii]] = sorted_ind[jj]
+        descs = history_descendants(tree['GalaxyIndex'],
+                                    tree['SnapNum']).astype(np.int32)
 
         # Run validation on descendants
         # for ii, desc in enumerate(descs):
@@ -722,27 +713,7 @@ class SAGEConverter(tao.Converter):
         """
         Calculates the max. of Vmax during the halo history
         """
-        vpeak = np.empty(len(tree), np.float32)
-
-        # By pre-filling vpeak with Vmax, I don't have to
-        # worry about cases where there are no descendants
-        # (although the code should cover that case)
-        vpeak[:] = tree['Vmax']
-
-        sorted_ind = np.argsort(tree, order=('GalaxyIndex', 'SnapNum'))
-        all_vmax = tree['Vmax']
-        all_gal_idx = tree['GalaxyIndex']
-        vmax = []
-        curr_idx = all_gal_idx[sorted_ind[0]]
-        for ii, idx in enumerate(all_gal_idx[sorted_ind]):
-            if curr_idx != idx:
-                vmax = []
-                curr_idx = idx
-
-            vmax.append(all_vmax[sorted_ind[ii]])
-            vpeak[sorted_ind[ii]] = max(vmax)
-
-        return vpeak
+        return peak_history(tree['GalaxyIndex'], tree['SnapNum'], tree['Vmax'])
 
     def totsfr(self, tree):
         """ Calculate the total star formation rate.
@@ -755,6 +726,10 @@ class SAGEConverter(tao.Converter):
         """Convert SAGE dT values to Gyrs"""
         return tree['dT'] * 1e-3
 
+    def get_tree_census(self):
+        """Count the trees and galaxies in the SAGE output."""
+        return tao.SAGEReader.census(self.args.trees_dir)
+
     def iterate_trees(self):
         """Iterate over SAGE trees."""
 
@@ -830,38 +805,19 @@ class SAGEConverter(tao.Converter):
         assert from_file_dtype.itemsize == 232, "Size of datatypes do not match"
         ordered_dtype.extend(computed_field_list)
         src_type = np.dtype(ordered_dtype)
+        transfer = TransferPlan(from_file_dtype, src_type)
         # print("src_type = {0}".format(src_type))
 
-        entries = [e for e in os.listdir(self.args.trees_dir)
-                   if os.path.isfile(os.path.join(self.args.trees_dir, e))]
-        entries = [e for e in entries if e.startswith('model_z')]
-        redshift_strings = list(set([re.match(r'model_z(\d+\.?\d*)_\d+', e).group(1)
-                                     for e in entries]))
-        group_strings = list(set([re.match(r'model_z\d+\.?\d*_(\d+)', e).group(1)
-                                  for e in entries]))
-
-        group_strings.sort(lambda x, y: -1 if int(x) < int(y) else 1)
-        redshift_strings.sort(lambda x, y: 1 if float(x) < float(y) else -1)
+        group_strings, redshift_strings = \
+            tao.SAGEReader.find_files(self.args.trees_dir)
 
-        totntrees = 0L
         for group in group_strings:
-            # redshift array is sorted -> pick the last redshift
-            redshift = redshift_strings[-1]
-            fn = 'model_z%s_%s' % (redshift, group)
-            with open(os.path.join(self.args.trees_dir, fn), 'rb') as f:
-                n_trees = np.fromfile(f, np.uint32, 1)[0]
-                totntrees += n_trees
-
-        for group in group_strings:
-            files = []
-            for redshift in redshift_strings:
-                fn = 'model_z%s_%s' % (redshift, group)
-                files.append(open(os.path.join(self.args.trees_dir, fn), 'rb'))
-
-            n_trees = [np.fromfile(f, np.uint32, 1)[0] for f in files][0]
-            n_gals = [np.fromfile(f, np.uint32, 1)[0] for f in files]
-            chunk_sizes = [np.fromfile(f, np.uint32, n_trees) for f in files]
-            tree_sizes = sum(chunk_sizes)
+            reader = tao.SAGEReader(
+                [os.path.join(self.args.trees_dir,
+                              'model_z%s_%s' % (redshift, group))
+                 for redshift in redshift_strings], from_file_dtype)
+            n_trees = reader.n_trees
+            tree_sizes = reader.tree_sizes
             # print("Working on ntrees = {0} in group = {1}"
             #       .format(n_trees, group))
 
@@ -869,20 +825,17 @@ class SAGEConverter(tao.Converter):
                 tree_size = tree_sizes[ii]
                 tree = np.empty(tree_size, dtype=src_type)
                 offs = 0
-                for jj in xrange(len(chunk_sizes)):
-                    chunk_size = chunk_sizes[jj][ii]
+                for data in reader.chunks(ii):
+                    chunk_size = len(data)
                     if chunk_size <= 0: continue
 
-                    data = np.fromfile(files[jj], from_file_dtype, chunk_size)
-
                     ## MS 13/07/2018.
                     ## from numpy 1.13, the assignment of structured arrays
                     ## changed. Previously, same named fields were copied
                     ## across by default. Now, essentially the memory 
                     ## is directly copied without regard for the actual
                     ## column names. (I would argue this is a regression)
-                    for _v in data.dtype.names:
-                        tree[_v][offs:offs + chunk_size] = data[_v][:]
+                    transfer.copy(data, tree[offs:offs + chunk_size])
                         
                     offs += chunk_size
 
@@ -922,5 +875,4 @@ class SAGEConverter(tao.Converter):
                               
                 yield tree
 
-            for file in files:
-                file.close()
+            reader.close()
@@ -0,0 +1,57 @@
+class BlockReader(object):
+    """Reads ranges of rows from a one-dimensional dataset in large blocks.
+
+    Horizontal tree formats store one dataset per snapshot, and a
+    vertical tree needs a short range of rows from each of them. Reading
+    those ranges one by one results in a very large number of small
+    reads. Instead, a `BlockReader` loads `buffer_size` bytes worth of
+    rows starting at the requested range and serves any following ranges
+    that fall inside that block from memory. When ranges are requested in
+    increasing order, as they are when trees are stored one after the
+    other, every row of the dataset is read exactly once.
+
+    `dataset` may be an h5py dataset or anything else that can be sliced
+    and has a `dtype` and a `len()`.
+    """
+
+    @classmethod
+    def split(cls, buffer_size, datasets):
+        """Divide a memory budget of `buffer_size` bytes between
+        `datasets`, returning a reader for each one. Every reader holds
+        the same number of rows, so readers of datasets with larger rows
+        get a larger share."""
+        row_bytes = sum(ds.dtype.itemsize for ds in datasets)
+        rows = max(1, int(buffer_size) // max(row_bytes, 1))
+        return [cls(ds, rows * ds.dtype.itemsize) for ds in datasets]
+
+    def __init__(self, dataset, buffer_size):
+        self.dataset = dataset
+        self.size = len(dataset)
+        self.block_rows = max(1, int(buffer_size) // dataset.dtype.itemsize)
+        self.block = None
+        self.block_start = 0
+        self.n_reads = 0
+
+    def read(self, start, count):
+        """Returns rows `start` to `start + count` of the dataset.
+
+        The result may be a view of the internal block, so it must be
+        copied before being modified if the same rows could be requested
+        again.
+        """
+        stop = start + count
+        if self.block is None or start < self.block_start or \
+           stop > self.block_start + len(self.block):
+            self._load(start, max(count, self.block_rows))
+        return self.block[start - self.block_start:stop - self.block_start]
+
+    def _load(self, start, count):
+        stop = min(start + count, self.size)
+        self.block = self.dataset[start:stop]
+        self.block_start = start
+        self.n_reads += 1
+
+    def clear(self):
+        """Release the current block."""
+        self.block = None
+
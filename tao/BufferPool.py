@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class BufferPool(object):
+    """Recycles the arrays used to convert one tree for the next.
+
+    Buffers are allocated with a capacity of the next power of two of
+    the requested length, and `take` returns a view of the first `n`
+    elements. Once the caller is done with the view, `give` returns the
+    buffer to a free list for its type and capacity, from which any
+    later request of the same size class is served. At most `max_bytes`
+    of free buffers are kept; anything beyond that is left to the
+    garbage collector.
+
+    If `stats` is set, every request counts as a hit or a miss under
+    `pool/hits` and `pool/misses`.
+    """
+
+    def __init__(self, max_bytes, stats=None):
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.free = {}
+        self.free_bytes = 0
+        # Views handed out, by id, along with their buffers.
+        self.taken = {}
+
+    @staticmethod
+    def capacity(n):
+        """The size class of a request for `n` elements."""
+        return 1 << max(int(n) - 1, 0).bit_length()
+
+    def take(self, n, dtype):
+        """An uninitialised array of `n` elements of type `dtype`."""
+        dtype = np.dtype(dtype)
+        key = (dtype, self.capacity(n))
+        buffers = self.free.get(key)
+        if buffers:
+            buf = buffers.pop()
+            self.free_bytes -= buf.nbytes
+            hit = True
+        else:
+            buf = np.empty(key[1], dtype)
+            hit = False
+        if self.stats is not None:
+            self.stats.count('pool/hits' if hit else 'pool/misses')
+        view = buf[:n]
+        self.taken[id(view)] = (view, buf)
+        return view
+
+    def give(self, array):
+        """Return an array obtained from `take`. Anything else is
+        ignored, so arrays of unknown origin can be passed safely."""
+        try:
+            view, buf = self.taken.pop(id(array))
+        except KeyError:
+            return
+        if self.free_bytes + buf.nbytes > self.max_bytes:
+            return
+        self.free.setdefault((buf.dtype, len(buf)), []).append(buf)
+        self.free_bytes += buf.nbytes
+
+    def reclaim(self):
+        """Return every array that has been handed out. Only safe once
+        nothing refers to any of them any more."""
+        for view, buf in self.taken.values():
+            self.give(view)
@@ -1,15 +1,27 @@
+import h5py
+import itertools
+import logging
 import numpy as np
 import time
 from .library import library
+from .BufferPool import BufferPool
 from .Exporter import Exporter
 from .Mapping import Mapping
+from .parallel import ConversionPool
+from .Segments import Segments
+from . import sidecar
+from .Statistics import Statistics
+from .validators import Fields, TreeFields
 from .xml import get_settings_xml
 # from IPython.core.debugger import Tracer
 from collections import OrderedDict
 import os
+import sys
 
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 class ConversionError(Exception):
     pass
 
@@ -22,8 +34,22 @@ class Converter(object):
         fields = self.get_extra_fields()
         self.mapping = Mapping(self, table, fields)
         self.make_datatype()
+        self.stats = None
+        interval = getattr(args, 'stats_interval', None)
+        if getattr(args, 'stats', False) or interval or \
+           getattr(args, 'stats_json', None):
+            self.stats = Statistics(interval)
         for mod in self.modules:
             mod.mapping = self.mapping
+            mod.plan = self.mapping.compile(mod.fields.keys())
+            mod.stats = self.stats
+        # Destination trees and generated fields are recycled between
+        # trees through a pool of buffers.
+        pool_size = getattr(args, 'pool_size', 0)
+        if pool_size:
+            self.buffers = BufferPool(int(pool_size * 1024**2), self.stats)
+        else:
+            self.buffers = None
 
     def combine_and_append_keys(self, old_dict, new_dict):
         # lc -> lower-case
@@ -200,22 +226,187 @@ class Converter(object):
         with open(outfilename, 'w') as f:
             f.write(get_settings_xml(self.galaxy_type, redshifts,
                                      self.metadata))
-        with Exporter(self.args.output, self) as exp:
+        # If the converter can count its trees and galaxies up front the
+        # output datasets are created at their final size.
+        census = self.get_tree_census()
+        n_trees, n_galaxies = census if census else (None, None)
+
+        # A resumed conversion carries on after the trees written as of
+        # the last checkpoint of the output file.
+        resume = getattr(self.args, 'resume', False)
+        start = (0, 0)
+        trees = self.iterate_trees()
+        if resume:
+            start = Exporter.read_checkpoint(self.args.output + '.h5')
+            self.seek(*start)
+            trees = self.skip_trees(trees, start[0])
+
+        jobs = getattr(self.args, 'jobs', 1)
+        shards = getattr(self.args, 'shards', False)
+        if shards and jobs <= 1:
+            logger.warning('Shards are written by worker processes; with '
+                           'a single job the output is one file.')
+            shards = False
+        if shards and resume:
+            raise ConversionError('A sharded conversion cannot be resumed.')
+        if shards and not hasattr(h5py, 'VirtualLayout'):
+            raise ConversionError('Sharded output needs h5py 2.9 or later '
+                                  'for virtual datasets.')
+
+        if shards:
+            # Every worker writes its own shard, and the output file only
+            # maps the shards once they are all complete.
+            with ConversionPool(self, jobs, shards=self.args.output) as pool:
+                blocks = list(pool.write_shards(trees))
+            self.export([], sim, redshifts, shards=blocks)
+        elif jobs > 1:
+            # Start the workers before the output file is opened so
+            # that they do not inherit its handle.
+            with ConversionPool(self, jobs) as pool:
+                dst_trees = pool.convert(trees, *start)
+                self.export(dst_trees, sim, redshifts, n_trees, n_galaxies,
+                            resume)
+        else:
+            dst_trees = self.convert_trees(trees)
+            self.export(dst_trees, sim, redshifts, n_trees, n_galaxies,
+                        resume)
+
+    def export(self, dst_trees, sim, redshifts, n_trees=None,
+               n_galaxies=None, resume=False, shards=None):
+        buffer_size = int(getattr(self.args, 'buffer_size', 0) * 1024**2)
+        buffer_galaxies = getattr(self.args, 'buffer_galaxies', 0)
+        checkpoint_interval = getattr(self.args, 'checkpoint_interval', 0)
+        with Exporter(self.args.output, self,
+                      buffer_size=buffer_size,
+                      buffer_galaxies=buffer_galaxies,
+                      n_trees=n_trees, n_galaxies=n_galaxies,
+                      checkpoint_interval=checkpoint_interval,
+                      resume=resume, shards=shards) as exp:
             exp.set_cosmology(sim['hubble'], sim['omega_m'], sim['omega_l'])
             exp.set_box_size(sim['box_size'])
             exp.set_redshifts(redshifts)
-            for tree in self.iterate_trees():
-                exp.add_tree(tree)
+            for dst_tree, counts in dst_trees:
+                exp.write_tree(dst_tree, counts)
+                if self.stats is not None:
+                    self.stats.tick(sys.stderr)
+
+        if self.stats is not None:
+            if getattr(self.args, 'stats', False):
+                sys.stderr.write(self.stats.report() + '\n')
+            if getattr(self.args, 'stats_json', None):
+                self.stats.save(self.args.stats_json)
+
+    def seek(self, n_trees, n_galaxies):
+        """Position the generators of every module as if `n_trees` trees
+        holding `n_galaxies` galaxies had already been converted."""
+        for mod in self.modules:
+            mod.seek(n_trees, n_galaxies)
+
+    def skip_trees(self, trees, n_trees):
+        """Returns `trees`, from `iterate_trees`, without its first
+        `n_trees` trees, which a resumed conversion has already written.
+
+        The skipped trees are still read, but not converted. Converters
+        able to start reading their input at a given tree may override
+        this to avoid reading them at all.
+        """
+        return itertools.islice(trees, n_trees, None)
+
+    def get_tree_census(self):
+        """Returns the total number of trees and galaxies to be converted.
+
+        Optional hook for converters that can cheaply count their input
+        before conversion starts. Should return a tuple of
+        `(n_trees, n_galaxies)`, or None if the counts are not known.
+        """
+        return None
+
+    def cached_index(self, filename, paths, build):
+        """The arrays describing the layout of the input files `paths`,
+        from the sidecar `filename` if it is up to date, or by calling
+        `build()` and saving its dict of arrays there otherwise."""
+        mode = getattr(self.args, 'index_cache', 'use')
+        return sidecar.cached(filename, paths, build, mode)
+
+    def convert_trees(self, trees):
+        """Convert `trees` in order, yielding `(dst_tree, counts)` pairs.
+
+        `counts` is None if `dst_tree` is a single tree. With
+        --batch-galaxies, consecutive trees smaller than that are
+        converted together by `convert_batch` in batches of about that
+        many galaxies, and `counts` then gives the size of every tree
+        in the batch. Larger trees are converted one at a time.
+        """
+        batch_galaxies = getattr(self.args, 'batch_galaxies', 0)
+        if batch_galaxies and not self.batchable():
+            logger.warning('Not all validators and generators can convert '
+                           'batches of trees; converting one tree at a '
+                           'time.')
+            batch_galaxies = 0
+        if not batch_galaxies:
+            for tree in trees:
+                yield self.convert_tree(tree), None
+            return
+
+        batch = []
+        size = 0
+        for tree in trees:
+            if len(tree) >= batch_galaxies:
+                if batch:
+                    yield self.convert_batch(batch)
+                    batch, size = [], 0
+                yield self.convert_tree(tree), None
+                continue
+            batch.append(tree)
+            size += len(tree)
+            if size >= batch_galaxies:
+                yield self.convert_batch(batch)
+                batch, size = [], 0
+        if batch:
+            yield self.convert_batch(batch)
+
+    def batchable(self):
+        """Whether every module can convert batches of trees."""
+        return all(mod.batchable() for mod in self.modules)
+
+    def convert_batch(self, src_trees):
+        """Convert several trees at once, returning `(dst_batch,
+        counts)`. The converted trees are concatenated in `dst_batch`,
+        and `counts` holds the number of galaxies in each."""
+        counts = np.array([len(tree) for tree in src_trees], dtype=np.int64)
+        if len(src_trees) == 1:
+            return self.convert_tree(src_trees[0]), None
+        src_batch = np.concatenate(src_trees)
+        return self._convert(src_batch, Segments(counts), src_trees), counts
 
     def convert_tree(self, src_tree):
+        return self._convert(src_tree)
+
+    def _convert(self, src_tree, segments=None, src_trees=None):
+        # Converts a single tree, or a batch of `src_trees` concatenated
+        # into `src_tree` and laid out as described by `segments`.
+        stats = self.stats
         tstart = time.time()
-        dst_tree = np.empty_like(src_tree,
-                                 dtype=self.galaxy_type)
+        if self.buffers is None:
+            dst_tree = np.empty_like(src_tree, dtype=self.galaxy_type)
+        else:
+            dst_tree = self.buffers.take(len(src_tree), self.galaxy_type)
         t0 = time.time()
-        # Do conversion first.
-        fields = {}
+        # Do conversion first. With --direct-write the generators write
+        # into the columns of dst_tree, and only the other fields are
+        # copied across afterwards.
+        direct = getattr(self.args, 'direct_write', False)
+        fields = TreeFields(dst_tree) if direct else Fields()
+        fields.pool = self.buffers
+        fields.segments = segments
         for mod in self.modules:
-            mod.convert_tree(src_tree, fields)
+            t1 = time.time()
+            if segments is None:
+                mod.convert_tree(src_tree, fields)
+            else:
+                mod.convert_batch(src_trees, src_tree, fields)
+            if stats is not None:
+                stats.add('convert_tree/%s' % mod, time.time() - t1)
 
         mod_time = time.time() - t0
 
@@ -234,10 +425,12 @@ class Converter(object):
         gen_time = time.time() - t0
         t0 = time.time()
         # Now we can merge the fields into the tree.
-        self._merge_fields(fields, dst_tree)
-        # iter_time=time.time() - t0
+        if direct:
+            fields.flush()
+        else:
+            self._merge_fields(fields, dst_tree)
+        fields.release()
 
-        # t0 = time.time()
         # Perform a direct transfer of fields from within the
         # mapping that are flagged.
         self._transfer_fields(src_tree, dst_tree)
@@ -247,22 +440,32 @@ class Converter(object):
         t0 = time.time()
         # Now run any post conversion routines.
         for mod in self.modules:
-            mod.post_conversion(dst_tree)
+            mod.post_conversion(dst_tree, segments)
 
         post_conv_time = time.time() - t0
         total_time = time.time() - tstart
 
-        # print "{:10.6f} {:10.6f}({:4.1f}%)  {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%)".format(total_time,
-        #                                                                                                                               mod_time,mod_time/total_time*100.0,
-        #                                                                                                                               val_time,val_time/total_time*100.0,
-        #                                                                                                                               gen_time,gen_time/total_time*100.0,
-        #                                                                                                                               iter_time,iter_time/total_time*100.0,
-        #                                                                                                                               copy_time,copy_time/total_time*100.0,
-        #                                                                                                                               post_conv_time,post_conv_time/total_time*100.0
-        #                                                                                                                               )
+        if stats is not None:
+            stats.add('convert_tree', mod_time)
+            stats.add('validate_fields', val_time)
+            stats.add('generate_fields', gen_time)
+            stats.add('copy_fields', copy_time)
+            stats.add('post_conversion', post_conv_time)
+            if segments is None:
+                stats.add('tree', total_time, len(dst_tree), dst_tree.nbytes)
+            else:
+                stats.add('batch', total_time, len(dst_tree),
+                          dst_tree.nbytes)
+                stats.count('batch/trees', segments.n_trees)
 
         return dst_tree
 
+    def release_tree(self, dst_tree):
+        """Called once a tree returned by `convert_tree` has been
+        written, so that its buffer can be reused."""
+        if self.buffers is not None:
+            self.buffers.give(dst_tree)
+
     def _merge_fields(self, fields, dst_tree):
         # print "fields in _merge_fields = {0}".format(fields)
         for name, values in fields.iteritems():
@@ -1,36 +1,105 @@
 import h5py
 import logging
 import numpy as np
+import os
+import time
 from LightCone import LightCone
+import sidecar
 
 logger = logging.getLogger(__name__)
 
 
 class Exporter(object):
+    """Writes converted trees to the TAO HDF5 file.
 
-    def __init__(self, filename, converter):
+    Converted trees are gathered in memory until either `buffer_size`
+    bytes or `buffer_galaxies` galaxies are held, and are then written
+    with a single resize and a single contiguous write per dataset. With
+    both budgets at zero every tree is flushed as soon as it is added.
+
+    If the total number of trees and galaxies are known up front the
+    datasets are created at their final size and never resized.
+
+    With a `checkpoint_interval`, the file is flushed to disk and the
+    number of trees and galaxies written so far recorded in a small
+    sidecar, `<filename>.h5.checkpoint.npz`, after the first write that
+    follows each interval of that many seconds, and again once the file
+    is done. The sidecar is replaced atomically, so it always holds a
+    complete checkpoint. With `resume`, an existing file is opened
+    instead and writing continues after the trees of its last
+    checkpoint.
+
+    Given `shards`, a list of `(filename, first_tree, n_trees,
+    first_galaxy, n_galaxies)` blocks of files written by other
+    exporters, the file is instead a master file for those blocks in
+    order: its galaxies are an HDF5 virtual dataset mapping the galaxies
+    of the shards, and only the tree counts and displacements are
+    written to it.
+    """
+
+    def __init__(self, filename, converter, buffer_size=0, buffer_galaxies=0,
+                 n_trees=None, n_galaxies=None, checkpoint_interval=0,
+                 resume=False, shards=None):
         self.converter = converter
         self.chunk_size = 10000
-        self.open_file(filename + '.h5')
+        self.buffer_size = buffer_size
+        self.buffer_galaxies = buffer_galaxies
+        self.checkpoint_interval = checkpoint_interval
+        self.n_trees = 0
+        self.n_galaxies = 0
+        self._buffer = []
+        self._buffer_counts = []
+        self._buffered_bytes = 0
+        self._buffered_galaxies = 0
+        self._last_checkpoint = time.time()
+        if resume:
+            self.reopen_file(filename + '.h5', n_trees, n_galaxies)
+        else:
+            self.open_file(filename + '.h5', n_trees, n_galaxies, shards)
+
+    @staticmethod
+    def read_checkpoint(filename):
+        """Returns the `(n_trees, n_galaxies)` written to `filename` as
+        of its last checkpoint."""
+        checkpoint = sidecar.load(filename + '.checkpoint.npz', [])
+        if checkpoint is None:
+            raise ValueError('%s has no checkpoint to resume from; '
+                             'it was not written with a checkpoint '
+                             'interval.' % filename)
+        return int(checkpoint['n_trees']), int(checkpoint['n_galaxies'])
 
-    def open_file(self, filename):
+    def open_file(self, filename, n_trees=None, n_galaxies=None,
+                  shards=None):
         self.file = h5py.File(filename, 'w')
+        # A checkpoint left by an earlier run does not apply to this one.
+        if os.path.exists(filename + '.checkpoint.npz'):
+            os.remove(filename + '.checkpoint.npz')
+        if shards is not None:
+            n_trees = sum(block[2] for block in shards)
+            n_galaxies = sum(block[4] for block in shards)
+        self.presized = n_trees is not None and n_galaxies is not None
+        if not self.presized:
+            n_trees, n_galaxies = 0, 0
+        self.expected = (n_trees, n_galaxies)
         self.tree_counts = self.file.create_dataset(
-            'tree_counts', (0,), dtype='uint32',
+            'tree_counts', (n_trees,), dtype='uint32',
             chunks=(self.chunk_size,),
             maxshape=(None,)
         )
         self.tree_displs = self.file.create_dataset(
-            'tree_displs', (1,), dtype='uint64',
+            'tree_displs', (n_trees + 1,), dtype='uint64',
             chunks=(self.chunk_size,),
             maxshape=(None,)
         )
         self.tree_displs[0] = 0
-        self.galaxies = self.file.create_dataset(
-            'galaxies', (0,), dtype=self.converter.galaxy_type,
-            chunks=(self.chunk_size,),
-            maxshape=(None,)
-        )
+        if shards is not None:
+            self.galaxies = self._map_shards(filename, shards)
+        else:
+            self.galaxies = self.file.create_dataset(
+                'galaxies', (n_galaxies,), dtype=self.converter.galaxy_type,
+                chunks=(self.chunk_size,),
+                maxshape=(None,)
+            )
         self.redshifts = self.file.create_dataset(
             'snapshot_redshifts', (0,), dtype='f',
             chunks=(100,),
@@ -45,22 +114,179 @@ class Exporter(object):
         self.omega_l = self.cosmology.create_dataset('omega_l', (1,),
                                                      dtype='f')
 
+    def reopen_file(self, filename, n_trees=None, n_galaxies=None):
+        """Open a file written by an earlier run to carry on after its
+        last checkpoint. Anything written after the checkpoint is
+        overwritten."""
+        self.n_trees, self.n_galaxies = self.read_checkpoint(filename)
+        self.file = h5py.File(filename, 'r+')
+        self.tree_counts = self.file['tree_counts']
+        self.tree_displs = self.file['tree_displs']
+        self.galaxies = self.file['galaxies']
+        if self.galaxies.dtype != self.converter.galaxy_type:
+            self.file.close()
+            raise ValueError('The galaxies in %s do not have the fields '
+                             'of this conversion; cannot resume.' % filename)
+        self.redshifts = self.file['snapshot_redshifts']
+        self.cosmology = self.file['cosmology']
+        self.box_size = self.cosmology['box_size']
+        self.hubble = self.cosmology['hubble']
+        self.omega_m = self.cosmology['omega_m']
+        self.omega_l = self.cosmology['omega_l']
+        self.presized = n_trees is not None and n_galaxies is not None
+        if self.presized:
+            self.expected = (n_trees, n_galaxies)
+            self._reserve(n_trees, n_galaxies)
+        else:
+            self.expected = (0, 0)
+        logger.info('Resuming %s after %d trees and %d galaxies.',
+                    filename, self.n_trees, self.n_galaxies)
+
+    def _map_shards(self, filename, shards):
+        n_galaxies = sum(block[4] for block in shards)
+        layout = h5py.VirtualLayout((n_galaxies,),
+                                    self.converter.galaxy_type)
+        # Consecutive blocks of the same shard are mapped together.
+        merged = []
+        for block in shards:
+            if merged and merged[-1][0] == block[0] and \
+               merged[-1][1] + merged[-1][2] == block[1]:
+                prev = merged.pop()
+                block = (prev[0], prev[1], prev[2] + block[2],
+                         prev[3], prev[4] + block[4])
+            merged.append(block)
+
+        sources = {}
+        for shard, first_tree, n_trees, first_galaxy, count in merged:
+            if shard not in sources:
+                with h5py.File(shard, 'r') as f:
+                    if f['galaxies'].dtype != self.converter.galaxy_type:
+                        raise ValueError('The galaxies in %s do not have '
+                                         'the fields of this conversion.'
+                                         % shard)
+                    counts = f['tree_counts'][...]
+                    shape = f['galaxies'].shape
+                # Shards are referred to by a path relative to the master
+                # file, so that they can be moved together.
+                path = os.path.relpath(shard,
+                                       os.path.dirname(os.path.abspath(
+                                           filename)))
+                sources[shard] = (h5py.VirtualSource(
+                    path, 'galaxies', shape,
+                    dtype=self.converter.galaxy_type), counts)
+            source, counts = sources[shard]
+            layout[self.n_galaxies:self.n_galaxies + count] = \
+                source[first_galaxy:first_galaxy + count]
+            n0, n1 = self.n_trees, self.n_trees + n_trees
+            block_counts = counts[first_tree:first_tree + n_trees]
+            self.tree_counts[n0:n1] = block_counts
+            self.tree_displs[n0 + 1:n1 + 1] = self.n_galaxies + \
+                np.cumsum(block_counts, dtype=np.uint64)
+            self.n_trees, self.n_galaxies = n1, self.n_galaxies + count
+        return self.file.create_virtual_dataset('galaxies', layout)
+
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.file.close()
+        try:
+            self.flush()
+            self.finalise()
+        finally:
+            self.file.close()
 
     def add_tree(self, tree):
-        cnt = np.uint32(len(tree))
-        displ = self.tree_displs[-1]
-        self.tree_counts.resize((self.tree_counts.shape[0] + 1,))
-        self.tree_displs.resize((self.tree_displs.shape[0] + 1,))
-        self.tree_counts[-1] = cnt
-        self.tree_displs[-1] = displ + cnt
-        self.galaxies.resize((self.galaxies.shape[0] + cnt,))
         dst_tree = self.converter.convert_tree(tree)
-        self.galaxies[displ:displ + cnt] = dst_tree
+        self.write_tree(dst_tree)
+
+    def write_tree(self, dst_tree, counts=None):
+        """Queue an already converted tree for writing. If `counts` is
+        given, `dst_tree` holds several trees of those sizes one after
+        the other."""
+        if counts is None:
+            counts = [len(dst_tree)]
+        self._buffer.append(dst_tree)
+        self._buffer_counts.append(counts)
+        self._buffered_bytes += dst_tree.nbytes
+        self._buffered_galaxies += len(dst_tree)
+        if self._buffer_full():
+            self.flush()
+
+    def _buffer_full(self):
+        if not self.buffer_size and not self.buffer_galaxies:
+            return True
+        if self.buffer_size and self._buffered_bytes >= self.buffer_size:
+            return True
+        if self.buffer_galaxies and \
+           self._buffered_galaxies >= self.buffer_galaxies:
+            return True
+        return False
+
+    def flush(self):
+        """Write all buffered trees to the file."""
+        if not self._buffer:
+            return
+
+        t0 = time.time()
+        counts = np.concatenate(self._buffer_counts).astype(np.uint32)
+        if len(self._buffer) == 1:
+            galaxies = self._buffer[0]
+        else:
+            galaxies = np.concatenate(self._buffer)
+
+        n0, g0 = self.n_trees, self.n_galaxies
+        n1, g1 = n0 + len(counts), g0 + len(galaxies)
+        self._reserve(n1, g1)
+        self.tree_counts[n0:n1] = counts
+        self.tree_displs[n0 + 1:n1 + 1] = g0 + np.cumsum(counts,
+                                                         dtype=np.uint64)
+        self.galaxies[g0:g1] = galaxies
+
+        self.n_trees, self.n_galaxies = n1, g1
+        stats = getattr(self.converter, 'stats', None)
+        if stats is not None:
+            stats.add('flush', time.time() - t0, len(galaxies),
+                      galaxies.nbytes)
+        for tree in self._buffer:
+            self.converter.release_tree(tree)
+        self._buffer = []
+        self._buffer_counts = []
+        self._buffered_bytes = 0
+        self._buffered_galaxies = 0
+        if self.checkpoint_interval and \
+           time.time() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Flush the file and record the trees and galaxies written so
+        far, so that a conversion stopped later on can resume here."""
+        self.file.flush()
+        sidecar.save(self.file.filename + '.checkpoint.npz', [],
+                     {'n_trees': np.array(self.n_trees),
+                      'n_galaxies': np.array(self.n_galaxies)})
+        self._last_checkpoint = time.time()
+
+    def finalise(self):
+        """Trim pre-sized datasets down to what was actually written."""
+        if self.presized and self.expected != (self.n_trees, self.n_galaxies):
+            logger.warning(
+                'Expected %d trees and %d galaxies, but wrote %d trees '
+                'and %d galaxies.', self.expected[0], self.expected[1],
+                self.n_trees, self.n_galaxies)
+        if self.tree_counts.shape[0] != self.n_trees:
+            self.tree_counts.resize((self.n_trees,))
+            self.tree_displs.resize((self.n_trees + 1,))
+        if self.galaxies.shape[0] != self.n_galaxies:
+            self.galaxies.resize((self.n_galaxies,))
+        if self.checkpoint_interval:
+            self.checkpoint()
+
+    def _reserve(self, n_trees, n_galaxies):
+        if self.tree_counts.shape[0] < n_trees:
+            self.tree_counts.resize((n_trees,))
+            self.tree_displs.resize((n_trees + 1,))
+        if self.galaxies.shape[0] < n_galaxies:
+            self.galaxies.resize((n_galaxies,))
 
     def set_cosmology(self, hubble, omega_m, omega_l):
         self.hubble[0] = float(hubble)
@@ -0,0 +1,116 @@
+import numpy as np
+
+
+def _compact(values):
+    # int32 if every value fits, int64 otherwise.
+    values = np.asarray(values)
+    if not len(values) or values.max() <= np.iinfo(np.int32).max:
+        return values.astype(np.int32)
+    return values.astype(np.int64)
+
+
+class ForestIndex(object):
+    """Where the galaxies of each forest lie in a horizontal tree file.
+
+    Horizontal formats store one dataset of galaxies per snapshot, and
+    a forest is usually present at only a fraction of the snapshots.
+    Instead of dense `(forests x snapshots)` tables, the index keeps one
+    entry per forest and snapshot at which the forest has galaxies, in
+    compressed sparse row form: the entries of forest `i` are
+    `indptr[i]` to `indptr[i + 1]`, ordered from the latest snapshot to
+    the earliest. Each entry holds the `snapshots` number, the number of
+    galaxies (`counts`) and the offset of the first one in that
+    snapshot's dataset (`offsets`). Counts and offsets are stored as
+    int32 unless a value does not fit.
+
+    `forests`, `snapshots`, `counts` and `offsets` passed to the
+    constructor describe the entries in any order, with `forests`
+    giving the position of each entry's forest in `forest_ids`. An
+    index saved with `to_arrays` is restored, without sorting again, by
+    `from_arrays`.
+    """
+
+    ARRAYS = ('forest_ids', 'indptr', 'snapshots', 'counts', 'offsets')
+
+    def __init__(self, forest_ids, forests, snapshots, counts, offsets):
+        forests = np.asarray(forests, dtype=np.int64)
+        snapshots = np.asarray(snapshots, dtype=np.int32)
+        order = np.lexsort((-snapshots, forests))
+
+        self.forest_ids = np.asarray(forest_ids)
+        self.n_forests = len(self.forest_ids)
+        self.indptr = np.zeros(self.n_forests + 1, dtype=np.int64)
+        np.cumsum(np.bincount(forests, minlength=self.n_forests),
+                  out=self.indptr[1:])
+        self.snapshots = snapshots[order]
+        self.counts = _compact(np.asarray(counts)[order])
+        self.offsets = _compact(np.asarray(offsets)[order])
+        self._summarize()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild an index from the dict returned by `to_arrays`."""
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, np.asarray(arrays[name]))
+        index.n_forests = len(index.forest_ids)
+        index._summarize()
+        return index
+
+    def to_arrays(self):
+        """The arrays making up the index, keyed by name."""
+        return dict((name, getattr(self, name)) for name in self.ARRAYS)
+
+    def _summarize(self):
+        totals = np.zeros(len(self.counts) + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=totals[1:])
+        self.sizes = totals[self.indptr[1:]] - totals[self.indptr[:-1]]
+        self.n_galaxies = int(totals[-1])
+
+    def __len__(self):
+        return self.n_forests
+
+    def entries(self, forest):
+        """The `(snapshots, counts, offsets)` of forest number `forest`,
+        from the latest snapshot to the earliest."""
+        lo, hi = self.indptr[forest], self.indptr[forest + 1]
+        return self.snapshots[lo:hi], self.counts[lo:hi], self.offsets[lo:hi]
+
+    def offsets_at(self, snapshot):
+        """The offset of every forest in the dataset of `snapshot`, or
+        -1 for forests that have no galaxies there."""
+        result = np.empty(self.n_forests, dtype=np.int64)
+        result.fill(-1)
+        present = np.flatnonzero(self.snapshots == snapshot)
+        forests = np.searchsorted(self.indptr, present, 'right') - 1
+        result[forests] = self.offsets[present]
+        return result
+
+    def read_order(self):
+        """The order in which to read the forests.
+
+        If the forests are stored in the order of their numbers at every
+        snapshot, that is the order. Otherwise the forests are ordered
+        by their offset at the latest snapshot they are present in, so
+        that at least the readers of the latest snapshots move forward.
+        """
+        entry_forests = np.repeat(np.arange(self.n_forests),
+                                  np.diff(self.indptr))
+        order = np.lexsort((entry_forests, self.snapshots))
+        snapshots = self.snapshots[order]
+        offsets = self.offsets[order]
+        if np.all((snapshots[1:] != snapshots[:-1]) |
+                  (offsets[1:] > offsets[:-1])):
+            return np.arange(self.n_forests)
+        first = np.empty(self.n_forests, dtype=np.int64)
+        first.fill(-1)
+        present = self.indptr[:-1] < self.indptr[1:]
+        first[present] = self.offsets[self.indptr[:-1][present]]
+        return np.argsort(first, kind='mergesort')
+
+    def galaxies_per_snapshot(self, n_snapshots):
+        """The number of galaxies in all forests at every snapshot, as
+        an array indexed by snapshot number."""
+        result = np.zeros(n_snapshots, dtype=np.int64)
+        np.add.at(result, self.snapshots, self.counts)
+        return result
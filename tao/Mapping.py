@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class Mapping(object):
 
     def __init__(self, converter, table=None, fields=[]):
@@ -17,3 +20,78 @@ class Mapping(object):
                 return tree[name]
             else:
                 return None
+
+    def compile(self, names):
+        """Work out once how each of `names` is obtained from a source
+        tree, returning a `MappingPlan` that does what `map` does for
+        every name without looking anything up per tree."""
+        return MappingPlan(self, names)
+
+
+class MappingPlan(object):
+    """The mapping of a fixed list of field names, resolved in advance.
+
+    Every name is resolved to a bound `map_*` method of the converter,
+    a renamed field from the mapping table, or a field of the same name.
+    Whether a field of the same name exists depends on the type of the
+    source trees, so that last step is resolved for each new type seen
+    and cached.
+    """
+
+    def __init__(self, mapping, names):
+        self.steps = []
+        for name in names:
+            method = getattr(mapping.converter, 'map_' + name, None)
+            if method is not None:
+                self.steps.append((name, method, None, False))
+                continue
+            mapped_name = mapping.table.get(name, None)
+            if mapped_name:
+                self.steps.append((name, None, mapped_name, False))
+            else:
+                self.steps.append((name, None, name, True))
+        self._resolved = {}
+        self._last_dtype = None
+        self._last_steps = None
+
+    def resolve(self, dtype):
+        """The steps that apply to trees of type `dtype`, as
+        `(name, method, field)` tuples."""
+        if dtype is self._last_dtype:
+            return self._last_steps
+        try:
+            steps = self._resolved[dtype]
+        except KeyError:
+            src_names = dtype.names or ()
+            steps = [(name, method, field)
+                     for name, method, field, optional in self.steps
+                     if not optional or field in src_names]
+            self._resolved[dtype] = steps
+        self._last_dtype = dtype
+        self._last_steps = steps
+        return steps
+
+    def apply(self, tree, fields):
+        """Map the fields of `tree` into `fields`."""
+        for name, method, field in self.resolve(tree.dtype):
+            if method is not None:
+                data = method(tree)
+            else:
+                data = tree[field]
+            if data is not None:
+                fields[name] = data
+
+    def apply_batch(self, trees, batch, fields):
+        """Map the fields of `batch`, the concatenation of `trees`, into
+        `fields`. Fields taken straight from the source are sliced from
+        the batch. `map_*` methods may depend on the extent of a tree,
+        so they are called on every tree and the results concatenated."""
+        for name, method, field in self.resolve(batch.dtype):
+            if method is not None:
+                parts = [method(tree) for tree in trees]
+                if parts[0] is None:
+                    continue
+                data = np.concatenate(parts)
+            else:
+                data = batch[field]
+            fields[name] = data
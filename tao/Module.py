@@ -1,4 +1,5 @@
 from Mapping import Mapping
+from Statistics import timed
 
 def set_module(mod, obj):
     obj.module = mod
@@ -8,6 +9,8 @@ class Module(object):
 
     def __init__(self, arguments=None):
         self.mapping = None
+        self.plan = None
+        self.stats = None
         self.validators = [set_module(self, v) for v in getattr(self, 'validators', [])]
         self.generators = [set_module(self, g) for g in getattr(self, 'generators', [])]
         self.disabled = False
@@ -27,10 +30,27 @@ class Module(object):
         if self.disabled:
             return
 
-        for name in self.fields.iterkeys():
-            data = self.mapping.map(src_tree, name)
-            if data is not None:
-                fields[name] = data
+        if self.plan is None:
+            self.plan = self.mapping.compile(self.fields.keys())
+        self.plan.apply(src_tree, fields)
+
+    def convert_batch(self, src_trees, src_batch, fields):
+        """Map the fields of several trees at once. `src_batch` holds
+        `src_trees` concatenated."""
+        if self.disabled:
+            return
+
+        if self.plan is None:
+            self.plan = self.mapping.compile(self.fields.keys())
+        self.plan.apply_batch(src_trees, src_batch, fields)
+
+    def batchable(self):
+        """Whether all validators and generators can handle a batch of
+        trees converted together."""
+        if self.disabled:
+            return True
+        return all(getattr(obj, 'batchable', False)
+                   for obj in self.validators + self.generators)
 
     def get_numpy_fields(self):
         if self.disabled:
@@ -60,20 +80,36 @@ class Module(object):
         if self.disabled:
             return
         
-        for generator in self.generators:
-            generator.generate_fields(fields)
+        self._run_stage('generate_fields', self.generators, fields)
 
     def validate_fields(self, fields):
         if self.disabled:
             return
 
-        for validator in self.validators:
-            validator.validate_fields(fields)
+        self._run_stage('validate_fields', self.validators, fields)
 
 
-    def post_conversion(self, tree):
+    def post_conversion(self, tree, segments=None):
         if self.disabled:
             return
 
+        if segments is None:
+            self._run_stage('post_conversion', self.generators, tree)
+        else:
+            self._run_stage('post_conversion', self.generators, tree,
+                            segments)
+
+    def _run_stage(self, stage, objs, *args):
+        # Call the `stage` method of each validator or generator in
+        # `objs`, timing each of them if statistics are being collected.
+        for obj in objs:
+            method = getattr(obj, stage)
+            if self.stats is None:
+                method(*args)
+            else:
+                name = '%s/%s/%s' % (stage, self, obj.__class__.__name__)
+                timed(self.stats, name, method, *args)
+
+    def seek(self, n_trees, n_galaxies):
         for generator in self.generators:
-            generator.post_conversion(tree)
+            generator.seek(n_trees, n_galaxies)
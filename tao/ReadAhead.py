@@ -0,0 +1,56 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ReadAhead(object):
+    """Reads items in one order and hands them out in another.
+
+    Iterating over a `ReadAhead` gives the numbers of the items to read,
+    in the order of `read_order` where possible. Every item read is
+    passed to `put`, which returns the items that are now ready, in
+    ascending order of their numbers. Items read before their turn are
+    held until then, but never more than `max_bytes` of them: once that
+    much is held, the item due next is read next instead, out of
+    `read_order`.
+    """
+
+    def __init__(self, read_order, max_bytes):
+        self.read_order = read_order
+        self.max_bytes = max_bytes
+        self.held = {}
+        self.held_bytes = 0
+        self.next = 0
+        self.n_forced = 0
+
+    def __len__(self):
+        return len(self.read_order)
+
+    def __iter__(self):
+        done = set()
+        for index in self.read_order:
+            while self.held_bytes > self.max_bytes and \
+                  self.next not in done:
+                if not self.n_forced:
+                    logger.warning('Holding %d items read ahead; reading '
+                                   'item %d out of order.', len(self.held),
+                                   self.next)
+                self.n_forced += 1
+                done.add(self.next)
+                yield self.next
+            if index not in done:
+                done.add(index)
+                yield index
+
+    def put(self, index, item):
+        """Hand over item `index` once read, returning the items, in
+        order, that can be used now."""
+        self.held[index] = item
+        self.held_bytes += getattr(item, 'nbytes', 0)
+        ready = []
+        while self.next in self.held:
+            item = self.held.pop(self.next)
+            self.held_bytes -= getattr(item, 'nbytes', 0)
+            ready.append(item)
+            self.next += 1
+        return ready
@@ -0,0 +1,119 @@
+import os
+import re
+import numpy as np
+
+
+class SAGEReader(object):
+    """Memory-mapped access to the trees of one group of SAGE output files.
+
+    SAGE writes one `model_z<redshift>_<group>` file per redshift for
+    each group of trees. Every file starts with a header of `n_trees`,
+    `n_gals` and the number of galaxies each tree has in that file, all
+    as `uint32`, followed by the galaxy records of the trees one after
+    the other. The headers are parsed once and the records of every file
+    are mapped into memory, so that the galaxies of a tree are returned
+    as slices of the mapping without any reads of their own. Which pages
+    are actually read, and when, is left to the operating system.
+    """
+
+    @staticmethod
+    def find_files(trees_dir):
+        """Find the SAGE output files in `trees_dir`.
+
+        Returns the group (cpu) strings in ascending order and the
+        redshift strings in descending order of redshift, such that
+        `model_z<redshift>_<group>` names every file.
+        """
+        entries = [e for e in os.listdir(trees_dir)
+                   if os.path.isfile(os.path.join(trees_dir, e))]
+        entries = [e for e in entries if e.startswith('model_z')]
+        redshift_strings = list(set([re.match(r'model_z(\d+\.?\d*)_\d+', e).group(1)
+                                     for e in entries]))
+        group_strings = list(set([re.match(r'model_z\d+\.?\d*_(\d+)', e).group(1)
+                                  for e in entries]))
+
+        group_strings.sort(lambda x, y: -1 if int(x) < int(y) else 1)
+        redshift_strings.sort(lambda x, y: 1 if float(x) < float(y) else -1)
+        return group_strings, redshift_strings
+
+    @classmethod
+    def census(cls, trees_dir):
+        """Count the trees and galaxies in the SAGE output in `trees_dir`.
+
+        Only the `n_trees` and `n_gals` header of every file is read. Every
+        redshift file of a group holds the same trees, so trees are counted
+        once per group while galaxies are summed over all files.
+        """
+        group_strings, redshift_strings = cls.find_files(trees_dir)
+        n_trees = 0
+        n_galaxies = 0
+        for group in group_strings:
+            for jj, redshift in enumerate(redshift_strings):
+                fn = 'model_z%s_%s' % (redshift, group)
+                header = cls.read_header(os.path.join(trees_dir, fn))
+                if jj == 0:
+                    n_trees += header[0]
+                n_galaxies += header[1]
+        return n_trees, n_galaxies
+
+    @staticmethod
+    def read_header(filename):
+        """Returns `(n_trees, n_gals, counts)` from the header of a SAGE
+        output file, where `counts` holds the number of galaxies of each
+        tree."""
+        with open(filename, 'rb') as f:
+            n_trees, n_gals = np.fromfile(f, np.uint32, 2)
+            counts = np.fromfile(f, np.uint32, n_trees)
+        assert len(counts) == n_trees, \
+            "%s is truncated: expected %d tree sizes in the header, found %d"\
+            % (filename, n_trees, len(counts))
+        return int(n_trees), int(n_gals), counts
+
+    def __init__(self, filenames, dtype):
+        self.filenames = list(filenames)
+        self.dtype = np.dtype(dtype)
+        self.counts = []
+        self.offsets = []
+        self.records = []
+        self.n_trees = None
+        for filename in self.filenames:
+            n_trees, n_gals, counts = self.read_header(filename)
+            if self.n_trees is None:
+                self.n_trees = n_trees
+            assert n_trees == self.n_trees, \
+                "%s holds %d trees, but %s holds %d" % (
+                    filename, n_trees, self.filenames[0], self.n_trees)
+            assert counts.sum(dtype=np.int64) == n_gals, \
+                "Tree sizes in the header of %s do not add up to %d "\
+                "galaxies" % (filename, n_gals)
+            start = 4 * (2 + n_trees)
+            size = os.path.getsize(filename)
+            assert size >= start + n_gals * self.dtype.itemsize, \
+                "%s is truncated: %d galaxies of %d bytes need %d bytes, "\
+                "found %d" % (filename, n_gals, self.dtype.itemsize,
+                              start + n_gals * self.dtype.itemsize, size)
+            offsets = np.zeros(n_trees + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            self.counts.append(counts)
+            self.offsets.append(offsets)
+            if n_gals:
+                self.records.append(np.memmap(filename, self.dtype, 'r',
+                                              start, (n_gals,)))
+            else:
+                # Zero-length mappings are not allowed.
+                self.records.append(np.empty(0, self.dtype))
+        if self.n_trees is None:
+            self.n_trees = 0
+        self.tree_sizes = np.zeros(self.n_trees, dtype=np.int64)
+        for counts in self.counts:
+            self.tree_sizes += counts
+
+    def chunks(self, tree):
+        """The galaxies of tree number `tree` in each file, in the order
+        of the files, as read-only views of the mapped records."""
+        return [records[offsets[tree]:offsets[tree + 1]]
+                for records, offsets in zip(self.records, self.offsets)]
+
+    def close(self):
+        """Release the mapped files."""
+        self.records = []
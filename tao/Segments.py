@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class Segments(object):
+    """Layout of consecutive trees concatenated into a single array.
+
+    Tree `i` of the batch occupies rows `offsets[i]` to `offsets[i + 1]`.
+    Per-galaxy arrays, such as the tree each galaxy belongs to, are
+    computed when first needed and cached, so that generators and
+    validators working on the same batch share them.
+    """
+
+    def __init__(self, sizes):
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.offsets = np.zeros(len(self.sizes) + 1, dtype=np.int64)
+        np.cumsum(self.sizes, out=self.offsets[1:])
+        self.n_trees = len(self.sizes)
+        self.n_galaxies = int(self.offsets[-1])
+        self._ids = None
+        self._galaxy_starts = None
+        self._galaxy_sizes = None
+
+    @property
+    def starts(self):
+        return self.offsets[:-1]
+
+    @property
+    def ids(self):
+        """The tree of every galaxy."""
+        if self._ids is None:
+            self._ids = np.repeat(np.arange(self.n_trees), self.sizes)
+        return self._ids
+
+    @property
+    def galaxy_starts(self):
+        """The first row of the tree of every galaxy."""
+        if self._galaxy_starts is None:
+            self._galaxy_starts = np.repeat(self.starts, self.sizes)
+        return self._galaxy_starts
+
+    @property
+    def galaxy_sizes(self):
+        """The size of the tree of every galaxy."""
+        if self._galaxy_sizes is None:
+            self._galaxy_sizes = np.repeat(self.sizes, self.sizes)
+        return self._galaxy_sizes
+
+    def local_index(self):
+        """The index of every galaxy within its own tree."""
+        return np.arange(self.n_galaxies) - self.galaxy_starts
+
+    def batch_index(self, local, rows):
+        """Convert the tree-local indices `local`, held by the galaxies
+        at `rows`, into rows of the batch."""
+        return local + self.galaxy_starts[rows]
+
+    def minmax(self, values):
+        """The minimum and maximum of `values` over every non-empty
+        tree, along with the indices of those trees."""
+        trees = np.flatnonzero(self.sizes)
+        if not len(trees):
+            empty = values[:0]
+            return trees, empty, empty
+        starts = self.offsets[trees]
+        return (trees, np.minimum.reduceat(values, starts),
+                np.maximum.reduceat(values, starts))
+
+    def split(self, array):
+        """The rows of `array` belonging to each tree, as views."""
+        offsets = self.offsets
+        return [array[offsets[i]:offsets[i + 1]]
+                for i in xrange(self.n_trees)]
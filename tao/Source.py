@@ -1,86 +1,156 @@
+import struct
 import numpy as np
 
-# class LazyTreeLoader(object):
-
-#     def __init__(self, tree_sizes_fn, trees_fn):
-#         self.open_npy(open(tree_sizes_fn, 'rb'), 'tree_sizes')
-#         self.open_npy(open(trees_fn, 'rb'), 'trees')
-
-#     def __iter__(self):
-#         while 1:
-#             self.read_next()
-#             yield self.tree
-
-#     def read_next(self):
-#         self.tree_size = self.read_npy('tree_sizes', 1)
-#         self.tree = self.read_npy('trees', self.tree_size)
-
-#     def open_npy(self, fh, attr):
-#         major, minor = np.lib.format.read_magic(fh)
-#         shape, fortran, dtype = np.lib.format.read_array_header_1_0(fh)
-#         assert not fortran, "Fortran order arrays not supported"
-
-#         # Get the number of elements in one 'row' by taking
-#         # a product over all other dimensions.
-#         row_size = numpy.prod(shape[1:])
-#         row_stride = row_size * dtype.itemsize
-
-#         # Store things.
-#         setattr(self, attr + '_fh', fh)
-#         setattr(self, attr + '_row_size', row_size)
-#         setattr(self, attr + '_row_stride', row_stride)
-#         setattr(self, attr + '_dtype', dtype)
-#         setattr(self, attr + '_shape', shape)
-#         setattr(self, attr + '_start_row', 0)
-
-#     def read_npy(self, attr, num_rows):
-#         fh = getattr(self, attr + '_fh')
-#         shape = getattr(self, attr + '_shape')
-#         dtype = getattr(self, attr + '_dtype')
-#         row_size = getattr(self, attr + '_row_size')
-#         start_row = getattr(self, attr + '_start_row')
-#         assert start_row < shape[0], 'start_row is beyond end of file'
-#         assert start_row + num_rows <= shape[0], 'start_row + num_rows > shape[0]'
-#         n_items = row_size*num_rows
-#         flat = numpy.fromfile(fh, count=n_items, dtype=dtype)
-#         return flat.reshape((-1,) + shape[1:])
+
+def _npy_header(dtype, n_rows):
+    """The `.npy` header of a one-dimensional array of `n_rows` rows of
+    `dtype`. The row count is padded to a fixed width, so the header has
+    the same length whatever the number of rows and can be written again
+    in place once that number is known."""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%20d,), }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), n_rows)
+    # The magic string, version and header length precede the header,
+    # and the data must start at a multiple of 64 bytes.
+    version, length_format = (1, 0), '<H'
+    if len(header) + 11 > 0xffff:
+        version, length_format = (2, 0), '<I'
+    prefix = len(np.lib.format.magic(*version)) + \
+        struct.calcsize(length_format)
+    header += ' ' * (-(prefix + len(header) + 1) % 64) + '\n'
+    return (np.lib.format.magic(*version) +
+            struct.pack(length_format, len(header)) + header.encode('latin1'))
+
 
 class LazyLoader(object):
+    """Reads the rows of a `.npy` file in order.
+
+    The file is memory-mapped, so nothing is read until rows are
+    requested, and each call to `read` copies the next `num_rows` rows
+    out of the mapping in one go.
+    """
 
     def __init__(self, filename):
-        self.fh = open(filename, 'rb')
-        major, minor = np.lib.format.read_magic(fh)
-        self.shape, fortran, self.dtype = np.lib.format.read_array_header_1_0(fh)
-        assert not fortran, "Fortran order arrays not supported"
-
-        # Get the number of elements in one 'row' by taking
-        # a product over all other dimensions.
-        self.row_size = numpy.prod(self.shape[1:])
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(fh)
+            elif version == (2, 0):
+                header = np.lib.format.read_array_header_2_0(fh)
+            else:
+                raise ValueError('%s has .npy format version %d.%d, which '
+                                 'is not supported' % ((filename,) + version))
+            offset = fh.tell()
+        self.shape, fortran, self.dtype = header
+        assert not fortran or len(self.shape) < 2, \
+            "Fortran order arrays not supported"
+        self.row_size = int(np.prod(self.shape[1:]))
         self.row_stride = self.row_size*self.dtype.itemsize
+        if self.shape[0] and self.row_size:
+            self.data = np.memmap(filename, self.dtype, 'r', offset,
+                                  tuple(self.shape))
+        else:
+            # Zero-length mappings are not allowed.
+            self.data = np.empty(self.shape, self.dtype)
         self.start_row = 0
 
+    def __len__(self):
+        return self.shape[0]
+
+    def seek(self, row):
+        assert 0 <= row <= self.shape[0], 'row is beyond end of file'
+        self.start_row = row
+
     def read(self, num_rows):
-        assert self.start_row < self.shape[0], 'start_row is beyond end of file'
+        assert num_rows == 0 or self.start_row < self.shape[0], \
+            'start_row is beyond end of file'
         assert self.start_row + num_rows <= self.shape[0], 'start_row + num_rows > shape[0]'
+        rows = np.array(self.data[self.start_row:self.start_row + num_rows])
         self.start_row += num_rows
-        n_items = self.row_size*num_rows
-        flat = numpy.fromfile(self.fh, count=n_items, dtype=self.dtype)
-        return flat.reshape((-1,) + self.shape[1:])
+        return rows
 
     def done(self):
         return self.start_row >= self.shape[0]
 
+
 class Source(object):
+    """Trees pre-staged as a pair of `.npy` files.
 
-    def __init__(self, tree_sizes_fn, trees_fn, mapping=None):
+    `trees_fn` holds the galaxies of every tree, one tree after the
+    other, and `tree_sizes_fn` the number of galaxies in each tree. The
+    galaxies are read in batches of whole trees of up to `buffer_size`
+    bytes, and each tree is yielded as a view of its batch, so iterating
+    a `Source` reads every galaxy once with a small number of large
+    reads. A converter can return it from `iterate_trees`:
+
+        def iterate_trees(self):
+            return iter(tao.Source('sizes.npy', 'trees.npy'))
+
+    Trees produced by any other source can be staged with `Source.save`.
+    """
+
+    def __init__(self, tree_sizes_fn, trees_fn, mapping=None,
+                 buffer_size=256*1024**2):
         self.tree_sizes = LazyLoader(tree_sizes_fn)
         self.trees = LazyLoader(trees_fn)
+        self.buffer_size = buffer_size
         self.load_mapping(mapping)
 
+        if len(self.tree_sizes):
+            sizes = self.tree_sizes.read(len(self.tree_sizes))
+        else:
+            sizes = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.offsets[1:])
+        assert self.offsets[-1] == len(self.trees), \
+            "Tree sizes add up to %d galaxies, but %s holds %d" % (
+                self.offsets[-1], trees_fn, len(self.trees))
+
+    @staticmethod
+    def save(trees, tree_sizes_fn, trees_fn, dtype=None):
+        """Write the trees yielded by `trees` to `tree_sizes_fn` and
+        `trees_fn`, from which a `Source` can read them back. Trees are
+        written as they are produced, so they need not fit in memory
+        together. `dtype` is only needed to save an empty catalogue."""
+        sizes = []
+        with open(trees_fn, 'wb') as fh:
+            for tree in trees:
+                if dtype is None:
+                    dtype = tree.dtype
+                assert tree.dtype == dtype, \
+                    "All trees must have the same type"
+                if fh.tell() == 0:
+                    fh.write(_npy_header(dtype, 0))
+                np.ascontiguousarray(tree).tofile(fh)
+                sizes.append(len(tree))
+            assert dtype is not None, "No trees to save"
+            # The number of galaxies is only known now, so the header is
+            # written again over the first one.
+            fh.seek(0)
+            fh.write(_npy_header(dtype, sum(sizes)))
+        np.save(tree_sizes_fn, np.array(sizes, dtype=np.int64))
+
     def load_mapping(self, mapping):
         self.mapping = mapping
 
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_tree_census(self):
+        return len(self), int(self.offsets[-1])
+
     def __iter__(self):
-        while not self.tree_sizes.done():
-            tree_size = self.tree_sizes.read(1)
-            yield self.trees.read(tree_size)
+        offsets = self.offsets
+        max_rows = max(1, self.buffer_size // self.trees.dtype.itemsize)
+        self.trees.seek(0)
+        first = 0
+        while first < len(self):
+            # As many whole trees as fit in the buffer, and at least one.
+            last = np.searchsorted(offsets, offsets[first] + max_rows,
+                                   'right') - 1
+            last = max(last, first + 1)
+            start = offsets[first]
+            batch = self.trees.read(offsets[last] - start)
+            for ii in xrange(first, last):
+                yield batch[offsets[ii] - start:offsets[ii + 1] - start]
+            first = last
@@ -0,0 +1,225 @@
+import json
+import math
+import time
+
+
+class Stage(object):
+    """Timings of one stage of the conversion.
+
+    Besides the total, every timing is counted in a logarithmic
+    histogram with `Stage.bins_per_decade` bins per decade, from which
+    percentiles are estimated. Histograms of separate runs or worker
+    processes can simply be added together.
+    """
+    bins_per_decade = 20
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.galaxies = 0
+        self.bytes = 0
+        self.histogram = {}
+
+    def add(self, seconds, n_galaxies=0, n_bytes=0):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.galaxies += n_galaxies
+        self.bytes += n_bytes
+        if seconds > 0:
+            b = int(math.floor(math.log10(seconds) * self.bins_per_decade))
+        else:
+            b = None
+        self.histogram[b] = self.histogram.get(b, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (('min', min), ('max', max)):
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            if mine is None or theirs is None:
+                setattr(self, attr, theirs if mine is None else mine)
+            else:
+                setattr(self, attr, pick(mine, theirs))
+        self.galaxies += other.galaxies
+        self.bytes += other.bytes
+        for b, n in other.histogram.iteritems():
+            self.histogram[b] = self.histogram.get(b, 0) + n
+
+    def percentile(self, q):
+        """Estimate the `q`th percentile from the histogram, to within
+        the width of a bin."""
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        # Zero timings sort first.
+        for b in sorted(self.histogram, key=lambda b: (b is not None, b)):
+            seen += self.histogram[b]
+            if seen >= rank:
+                if b is None:
+                    return 0.0
+                # Geometric centre of the bin, clamped to what was seen.
+                value = 10**((b + 0.5) / self.bins_per_decade)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'galaxies': self.galaxies,
+            'bytes': self.bytes,
+        }
+
+
+class Statistics(object):
+    """Collects the time spent in each stage of the conversion.
+
+    Stages are named by a path such as `validate_fields/SAGE/Positive`:
+    the top level stages of `Converter.convert_tree` are broken down by
+    module, and within a module by validator or generator. The `tree`
+    stage covers the whole of `convert_tree` and carries the number of
+    galaxies and bytes produced, from which throughput is derived. The
+    `batch` stage does the same for batches of trees converted together.
+    The report gives the share of every stage in the time spent in
+    those two, except for the stages in `wall_stages`, such as writing
+    the output in `flush`, which happen outside of `convert_tree` and
+    are reported separately as a share of the wall time.
+
+    Besides timings, plain counts of events such as buffer pool hits
+    are kept by `count`.
+
+    If `interval` is given, `tick` prints a report whenever that many
+    seconds have passed since the last one.
+    """
+    wall_stages = ('flush',)
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.stages = {}
+        self.counters = {}
+
+    def add(self, name, seconds, n_galaxies=0, n_bytes=0):
+        try:
+            stage = self.stages[name]
+        except KeyError:
+            stage = self.stages[name] = Stage()
+        stage.add(seconds, n_galaxies, n_bytes)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def clear(self):
+        self.stages = {}
+        self.counters = {}
+
+    def merge(self, other):
+        """Add the timings of another collection, such as the one
+        returned by a worker process."""
+        for name, stage in other.stages.iteritems():
+            try:
+                self.stages[name].merge(stage)
+            except KeyError:
+                self.stages[name] = Stage()
+                self.stages[name].merge(stage)
+        for name, n in other.counters.iteritems():
+            self.count(name, n)
+
+    def tick(self, stream):
+        if not self.interval:
+            return
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            stream.write(self.report() + '\n')
+
+    def to_dict(self):
+        wall = time.time() - self.start
+        # Trees converted in batches are counted by the `batch` stage.
+        tree = self.stages.get('tree', Stage())
+        batch = self.stages.get('batch', Stage())
+        trees = tree.count + self.counters.get('batch/trees', 0)
+        galaxies = tree.galaxies + batch.galaxies
+        nbytes = tree.bytes + batch.bytes
+        return {
+            'wall_time': wall,
+            'trees': trees,
+            'galaxies': galaxies,
+            'bytes': nbytes,
+            'galaxies_per_sec': galaxies / wall if wall else None,
+            'mb_per_sec': nbytes / 1024.0**2 / wall if wall else None,
+            'stages': dict((name, stage.to_dict())
+                           for name, stage in self.stages.iteritems()),
+            'counters': dict(self.counters),
+        }
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def report(self):
+        summary = self.to_dict()
+        lines = [
+            'Converted %d trees, %d galaxies in %.2f s: %.1f galaxies/s, '
+            '%.2f MB/s' % (summary['trees'], summary['galaxies'],
+                           summary['wall_time'],
+                           summary['galaxies_per_sec'] or 0,
+                           summary['mb_per_sec'] or 0),
+            '%-48s %9s %10s %6s %10s %10s %10s %10s' % (
+                'stage', 'calls', 'total [s]', '%', 'p50 [ms]', 'p90 [ms]',
+                'p99 [ms]', 'max [ms]'),
+        ]
+        tree_total = sum(self.stages[name].total for name in ('tree', 'batch')
+                         if name in self.stages)
+        tree_stages = [name for name in sorted(self.stages)
+                       if name not in self.wall_stages]
+        wall_stages = [name for name in sorted(self.stages)
+                       if name in self.wall_stages]
+        for name in tree_stages:
+            lines.append(self._report_stage(name, summary, tree_total))
+        if wall_stages:
+            lines.append('Outside of the conversion of trees, as a share '
+                         'of the wall time:')
+            for name in wall_stages:
+                lines.append(self._report_stage(name, summary,
+                                                summary['wall_time']))
+        hits = self.counters.get('pool/hits', 0)
+        misses = self.counters.get('pool/misses', 0)
+        if hits + misses:
+            lines.append('Buffer pool: %d of %d requests reused a buffer '
+                         '(%.1f%%)' % (hits, hits + misses,
+                                       100.0 * hits / (hits + misses)))
+        for name in sorted(self.counters):
+            lines.append('%-48s %9d' % (name, self.counters[name]))
+        return '\n'.join(lines)
+
+    def _report_stage(self, name, summary, total):
+        stage = summary['stages'][name]
+        frac = 100.0 * stage['total'] / total if total else 0
+        ms = [1e3 * (stage[k] or 0) for k in ('p50', 'p90', 'p99', 'max')]
+        return '%-48s %9d %10.3f %6.1f %10.3f %10.3f %10.3f %10.3f' % tuple(
+            [name, stage['count'], stage['total'], frac] + ms)
+
+
+def timed(stats, name, func, *args):
+    """Call `func(*args)`, adding its run time to `stats` under `name`
+    unless `stats` is None."""
+    if stats is None:
+        return func(*args)
+    t0 = time.time()
+    result = func(*args)
+    stats.add(name, time.time() - t0)
+    return result
@@ -1,4 +1,11 @@
 from Exporter import Exporter
+from BlockReader import BlockReader
+from BufferPool import BufferPool
+from ForestIndex import ForestIndex
+from ReadAhead import ReadAhead
+from SAGEReader import SAGEReader
+from Segments import Segments
+from Source import Source
 from Mapping import Mapping
 from Converter import Converter, ConversionError
 import testing, logging
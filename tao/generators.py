@@ -1,21 +1,24 @@
 from __future__ import print_function
 from collections import OrderedDict
 import numpy as np
+from .kernels import depth_first_order
 import time as time
 import sys
 
 
 class Generator(object):
+    # Whether the generator also gives the right answer for a batch of
+    # trees converted together; see `Segments`.
+    batchable = False
 
     def get_field(self, fields, name, dtype='f'):
         fld = fields.get(name, None)
-        # print("name = {0} fld = {1}".format(name, fld))
         if fld is None:
-            # print("fields.keys() = {0}".format(fields.keys()))
-            # print("fields.keys()[0] = {0}".format(fields.keys()[0]))
-            # print("fields[fields.keys()[0]] = {0}".format(fields[fields.keys()[0]]))
+            allocate = getattr(fields, 'allocate', None)
+            if allocate is not None:
+                # May be a view of the destination tree.
+                return allocate(name, dtype)
             size = len(fields[fields.keys()[0]])
-            # print("name = {0} size = {1}".format(name, size))
             fld = np.empty(size, dtype)
             fields[name] = fld
         return fld
@@ -23,11 +26,17 @@ class Generator(object):
     def generate_fields(self, fields):
         pass
 
-    def post_conversion(self, tree):
+    def post_conversion(self, tree, segments=None):
+        pass
+
+    def seek(self, n_trees, n_galaxies):
+        """Position any running counters as if `n_trees` trees holding
+        `n_galaxies` galaxies had already been generated."""
         pass
 
 class GlobalIndices(Generator):
     fields = [('globalindex', np.int64)]
+    batchable = True
 
     def __init__(self, *args, **kwargs):
         super(GlobalIndices, self).__init__(*args, **kwargs)
@@ -43,9 +52,13 @@ class GlobalIndices(Generator):
         #     gidxs[ii] = self.index + ii
         # self.index += len(gidxs)
 
+    def seek(self, n_trees, n_galaxies):
+        self.index = n_galaxies
+
 
 class TreeIndices(Generator):
     fields = [('treeindex', np.int32)]
+    batchable = True
 
     def __init__(self, *args, **kwargs):
         super(TreeIndices, self).__init__(*args, **kwargs)
@@ -53,16 +66,29 @@ class TreeIndices(Generator):
 
     def generate_fields(self, fields):
         tidxs = self.get_field(fields, 'treeindex', np.int32)
-        tidxs[:] = self.index
-        self.index += 1
+        segments = getattr(fields, 'segments', None)
+        if segments is None:
+            tidxs[:] = self.index
+            self.index += 1
+        else:
+            tidxs[:] = self.index + segments.ids
+            self.index += segments.n_trees
+
+    def seek(self, n_trees, n_galaxies):
+        self.index = n_trees
 
 
 class TreeLocalIndices(Generator):
     fields = [('localindex', np.int32)]
+    batchable = True
 
     def generate_fields(self, fields):
         lidxs = self.get_field(fields, 'localindex', np.int32)
-        lidxs[:] = np.arange(0, len(lidxs), 1, dtype=np.int32)
+        segments = getattr(fields, 'segments', None)
+        if segments is None:
+            lidxs[:] = np.arange(0, len(lidxs), 1, dtype=np.int32)
+        else:
+            lidxs[:] = segments.local_index()
         # print("lidxs = {0} shape = {1}".format(lidxs, lidxs.shape))
         # for ii in range(len(lidxs)):
         #     lidxs[ii] = ii
@@ -70,6 +96,7 @@ class TreeLocalIndices(Generator):
 
 class GlobalDescendants(Generator):
     fields = [('globaldescendant', np.int64)]
+    batchable = True
 
     def generate_fields(self, fields):
         gdescs = self.get_field(fields, 'globaldescendant', np.int64)
@@ -79,93 +106,75 @@ class GlobalDescendants(Generator):
         gdescs[:] = descs
         ind = (np.where(descs != -1))[0]
         if len(ind) > 0:
-            gdescs[ind] = gidxs[descs[ind]]
+            segments = getattr(fields, 'segments', None)
+            if segments is None:
+                gdescs[ind] = gidxs[descs[ind]]
+            else:
+                gdescs[ind] = gidxs[segments.batch_index(descs[ind], ind)]
 
 
 class DepthFirstOrdering(Generator):
     fields = [('subsize', np.int32)]
-
-    def post_conversion(self, tree):
-        tstart = time.time()
-        dfi = [0]
-        parents = {}
-        order = np.empty(len(tree), np.int32)
-
-        def _recurse(idx):
-            order[idx] = dfi[0]
-            dfi[0] += 1
-            tree['subsize'][idx] = 1
-            if idx in parents:
-                for par in parents[idx]:
-                    tree['subsize'][idx] += _recurse(par)
-            return tree['subsize'][idx]
-
-        # Find the roots and parents.
-        t0 = time.time()
-        ind = (np.where(tree['descendant'] == -1))[0]
-        if len(ind) > 0:
-            roots = list(ind)
-
-        ind = (np.where(tree['descendant'] != -1))[0]
-        if len(ind) > 0:
-            for ii, desc in zip(ind, tree['descendant'][ind]):
-                parents.setdefault(desc, []).append(ii)
-
-        roots_time = time.time() - t0
-
-        # used to time the previous recursive chunk.
-        # now here so I don't break the code or file
-        # output columns
-        recurse_time = 0.0
-
-        # find new ordering. avoid (slow) recursion
+    batchable = True
+
+    def post_conversion(self, tree, segments=None):
+        # Descendants are tree-local. For a batch of trees they are
+        # turned into rows of the batch, in which the trees' roots
+        # appear in order, so a single ordering of the whole batch
+        # leaves every tree in place.
+        if segments is None:
+            starts = 0
+            sizes = len(tree)
+            descs = tree['descendant']
+        else:
+            starts = segments.galaxy_starts
+            sizes = segments.galaxy_sizes
+            descs = tree['descendant'] + starts
+            descs[tree['descendant'] == -1] = -1
+
+        # Find the depth-first ordering and the subtree sizes.
         t0 = time.time()
-        start_dfi = [0]
-        tree['subsize'] = 0
-        for ii in roots:
-            stack = [ii]
-            visited = []
-            while len(stack) > 0:
-                idx = stack.pop()
-                visited.append(idx)
-                tree['subsize'][visited] += 1
-                order[idx] = start_dfi[0]
-                start_dfi[0] += 1
-                if idx in parents:
-                    for par in parents[idx]:
-                        stack.append(par)
-
-        new_recurse_time = time.time() - t0
+        order, subsize = depth_first_order(descs)
+        tree['subsize'] = subsize
+        order_time = time.time() - t0
 
         # Remap everything.
         t0 = time.time()
-        tree['localindex'] = order[tree['localindex']]
-        ind = (np.where(tree['descendant'] != -1))[0]
+        local_order = order - starts
+        tree['localindex'] = local_order[tree['localindex'] + starts]
+        ind = (np.where(descs != -1))[0]
         if len(ind) > 0:
-            ind1 = tree['descendant'][ind]
-            tree['descendant'][ind] = order[ind1]
+            ind1 = descs[ind]
+            tree['descendant'][ind] = local_order[ind1]
             tree['globaldescendant'][ind] = tree['globalindex'][ind1]
 
         remapping_time = time.time() - t0
 
-        # Sort the array.
+        # Sort the array. The new local indices are a permutation, so
+        # scattering by them is equivalent to sorting on them.
         t0 = time.time()
-        tree.sort(order=['localindex'])
+        perm = np.empty(len(tree), dtype=np.int64)
+        perm[order] = np.arange(len(tree))
+        tree[:] = tree[perm]
         sort_time = time.time() - t0
 
-        # Run some final checks on the descendants.
+        # Run some final checks on the descendants. Sorting keeps every
+        # galaxy within its own tree, so `starts` still applies.
         t0 = time.time()
-        assert np.max(tree['descendant']) < len(tree), \
+        descs = tree['descendant']
+        assert np.all(descs < sizes), \
             "Invalid descendant index."
-        ind = (np.where(tree['descendant'] != -1))[0]
+        ind = (np.where(descs != -1))[0]
+        if segments is not None:
+            descs = descs + starts
+            descs[tree['descendant'] == -1] = -1
         if len(ind) > 0:
-            diff = set(tree['descendant'][ind] - ind)
-            assert 0 not in diff, "Descendant references same object."
+            assert not np.any(descs[ind] == ind), \
+                "Descendant references same object."
 
-        ind = (np.where((tree['mergeIntoID'] == -1) & (tree['descendant']
-                                                       != -1)))[0]
+        ind = (np.where((tree['mergeIntoID'] == -1) & (descs != -1)))[0]
         if len(ind) > 0:
-            desc_ind = tree['descendant'][ind]
+            desc_ind = descs[ind]
             desc_galidx = tree['GalaxyIndex'][desc_ind]
             prog_galidx = tree['GalaxyIndex'][ind]
             assert len(prog_galidx) == len(desc_galidx),\
@@ -178,28 +187,26 @@ class DepthFirstOrdering(Generator):
         # Validate globaldescendants
         gdescs = tree['globaldescendant']
         gidxs  = tree['globalindex']
-        descs  = tree['descendant']
-        for gdesc, desc in zip(gdescs, descs):
-            msg = "desc = {0} gdesc = {1}".format(desc, gdesc)
-            assert (((desc == -1) and (gdesc == -1)) or
-                    ((desc >= 0) and (gdesc >= 0))), msg
-
-            if desc == -1:
-                continue
-            msg = "gidxs[{0}] = {1} is not equal to gdesc = {2}".\
-                format(desc, gidxs[desc], gdesc)
-            if gidxs[desc] != gdesc:
-                Tracer()()
-            assert gidxs[desc] == gdesc, msg
+        # The messages are only formatted if an assertion fails.
+        bad = np.where(~(((descs == -1) & (gdescs == -1)) |
+                         ((descs >= 0) & (gdescs >= 0))))[0]
+        assert len(bad) == 0, \
+            "{0} galaxies have inconsistent descendants: desc = {1} "\
+            "gdesc = {2}".format(len(bad), descs[bad], gdescs[bad])
+
+        ind = (np.where(descs != -1))[0]
+        bad = ind[gidxs[descs[ind]] != gdescs[ind]]
+        assert len(bad) == 0, \
+            "gidxs[{0}] = {1} is not equal to gdesc = {2}".\
+            format(descs[bad], gidxs[descs[bad]], gdescs[bad])
 
         validation_time = time.time() - t0
-        total_time = time.time() - tstart
-        # print(" {:12d} {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%)  {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%) {:10.6f}({:4.1f}%)  {:10.6f}".format(len(tree),
-        #                                                                                                                                 remapping_time,remapping_time/total_time*100.0,
-        #                                                                                                                                 sort_time,sort_time/total_time*100.0,
-        #                                                                                                                                 validation_time,validation_time/total_time*100.0,
-        #                                                                                                                                 roots_time,roots_time/total_time*100.0,
-        #                                                                                                                                 recurse_time,recurse_time/total_time*100.0,
-        #                                                                                                                                 new_recurse_time,new_recurse_time/total_time*100.0,
-        #                                                                                                                                 total_time, file=sys.stderr))
 
+        stats = getattr(self.module, 'stats', None)
+        if stats is not None:
+            prefix = 'post_conversion/%s/%s/' % (self.module,
+                                                 self.__class__.__name__)
+            stats.add(prefix + 'order', order_time)
+            stats.add(prefix + 'remap', remapping_time)
+            stats.add(prefix + 'sort', sort_time)
+            stats.add(prefix + 'validate', validation_time)
@@ -0,0 +1,156 @@
+"""Array kernels shared by the generators and conversion scripts.
+
+Everything here works on whole NumPy arrays; none of the functions loop
+over galaxies in Python.
+"""
+import numpy as np
+
+
+def progenitor_lists(descendants):
+    """Progenitor lists of every galaxy in compressed sparse row form.
+
+    `descendants` holds the tree-local index of each galaxy's descendant,
+    or -1. Returns `(progenitors, starts)` such that the progenitors of
+    galaxy `i` are `progenitors[starts[i]:starts[i + 1]]`, in ascending
+    index order.
+    """
+    n = len(descendants)
+    progenitors = np.flatnonzero(descendants != -1)
+    descs = descendants[progenitors]
+    progenitors = progenitors[np.argsort(descs, kind='mergesort')]
+    starts = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(descs, minlength=n), out=starts[1:])
+    return progenitors, starts
+
+
+def _gather(starts, nodes):
+    # Positions in the CSR list of the progenitors of `nodes`, grouped
+    # by node, along with the number of progenitors of each node.
+    first = starts[nodes]
+    counts = starts[nodes + 1] - first
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(first - offsets, counts) + np.arange(counts.sum()), counts
+
+
+def depth_first_order(descendants):
+    """Depth-first ordering of a forest of merger trees.
+
+    Returns `(order, subsize)`, where `order[i]` is the position of galaxy
+    `i` in a pre-order walk of the forest and `subsize[i]` is the number
+    of galaxies in the subtree rooted at `i`, itself included. Roots are
+    walked in ascending index order and the progenitors of a galaxy in
+    descending index order. The subtree of galaxy `i` therefore occupies
+    positions `order[i]` to `order[i] + subsize[i] - 1`.
+
+    The forest is swept one level at a time, so the cost is linear in
+    the number of galaxies plus a NumPy call per level of the deepest
+    tree.
+    """
+    n = len(descendants)
+    progenitors, starts = progenitor_lists(descendants)
+    roots = np.flatnonzero(descendants == -1)
+
+    # Split the forest into levels by distance from the roots. Within a
+    # level, the progenitors of any one galaxy are contiguous, and
+    # counts[k] gives the size of each such group for level k + 1.
+    levels = [roots]
+    counts = []
+    n_reached = len(roots)
+    while len(levels[-1]):
+        idx, cnt = _gather(starts, levels[-1])
+        counts.append(cnt)
+        levels.append(progenitors[idx])
+        n_reached += len(idx)
+    levels.pop()
+    assert n_reached == n, \
+        "Descendants contain a cycle: only %d of %d galaxies can be "\
+        "reached from a root." % (n_reached, n)
+
+    # Accumulate subtree sizes from the leaves up.
+    subsize = np.ones(n, dtype=np.int64)
+    for k in range(len(levels) - 2, -1, -1):
+        cnt = counts[k]
+        has = cnt > 0
+        first = (np.cumsum(cnt) - cnt)[has]
+        subsize[levels[k][has]] += np.add.reduceat(subsize[levels[k + 1]],
+                                                   first)
+
+    # Assign positions from the roots down. A progenitor follows its
+    # descendant and the subtrees of all its higher-indexed siblings.
+    order = np.empty(n, dtype=np.int64)
+    sizes = subsize[roots]
+    order[roots] = np.cumsum(sizes) - sizes
+    for k in range(len(levels) - 1):
+        cnt = counts[k]
+        sizes = np.cumsum(subsize[levels[k + 1]])
+        last = np.repeat(np.cumsum(cnt) - 1, cnt)
+        order[levels[k + 1]] = np.repeat(order[levels[k]], cnt) + 1 + \
+            sizes[last] - sizes
+
+    return order, subsize
+
+
+def history_order(ids, snapnums):
+    """Order galaxies by history and then by snapshot.
+
+    Returns `(order, first)`, where `order` sorts the galaxies by `ids`
+    and then by `snapnums`, and `first[k]` is True if `order[k]` is the
+    earliest galaxy of its history.
+    """
+    order = np.lexsort((snapnums, ids))
+    sorted_ids = ids[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    return order, first
+
+
+def history_descendants(ids, snapnums):
+    """Descendants that link each galaxy to the next snapshot of its own
+    history.
+
+    Galaxies sharing a value of `ids` (the SAGE `GalaxyIndex`) form one
+    history, and each is given the index of the next galaxy in that
+    history by `snapnums`. The last galaxy of every history gets -1.
+    """
+    order, first = history_order(ids, snapnums)
+    descs = np.empty(len(ids), dtype=np.int64)
+    descs.fill(-1)
+    linked = ~first[1:]
+    descs[order[:-1][linked]] = order[1:][linked]
+    return descs
+
+
+def segmented_maximum(values, first):
+    """Running maximum of `values` that restarts wherever `first` is True.
+
+    The maxima are built by doubling: after the step with shift `s`,
+    every element holds the maximum of up to `2 * s` elements ending at
+    it, without crossing the start of its segment. The number of steps
+    is the logarithm of the longest segment.
+    """
+    n = len(values)
+    result = np.array(values, copy=True)
+    if n == 0:
+        return result
+    index = np.arange(n)
+    start = np.maximum.accumulate(np.where(first, index, 0))
+    shift = 1
+    while shift < n:
+        ok = index[shift:] - shift >= start[shift:]
+        if not ok.any():
+            break
+        # The right hand side is gathered before any element is updated.
+        dst = index[shift:][ok]
+        result[dst] = np.maximum(result[dst], result[dst - shift])
+        shift *= 2
+    return result
+
+
+def peak_history(ids, snapnums, values):
+    """Peak of `values` over the history of each galaxy up to and
+    including its own snapshot, such as Vpeak from Vmax. Histories are
+    identified by `ids` and ordered by `snapnums`."""
+    order, first = history_order(ids, snapnums)
+    peak = np.empty_like(values)
+    peak[order] = segmented_maximum(values[order], first)
+    return peak
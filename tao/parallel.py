@@ -0,0 +1,163 @@
+"""Parallel tree conversion.
+
+Trees are read and written by the calling process, while `convert_tree`
+runs in a pool of worker processes. Consecutive trees are grouped into
+tasks, and every task carries the number of trees and galaxies that
+precede it so that the stateful generators (`GlobalIndices`,
+`TreeIndices`) produce exactly the values of a serial run. Results are
+handed back in input order.
+
+Alternatively, every worker writes the trees it converts to a shard file
+of its own, and only the position of each task within the shards is
+handed back.
+"""
+import multiprocessing
+import multiprocessing.util
+from collections import deque
+from .Exporter import Exporter
+
+# The converter used by a worker process. Workers are forked, so the
+# converter is inherited rather than pickled.
+_converter = None
+
+# The name of the shard this worker writes, and its exporter once the
+# first task has been written.
+_shard_name = None
+_shard = None
+
+
+def shard_name(output, index):
+    """The name, without extension, of shard `index` of `output`."""
+    return '%s.shard%03d' % (output, index)
+
+
+def _init_worker(converter, output=None, shard_counter=None):
+    global _converter, _shard_name
+    _converter = converter
+    if output is not None:
+        with shard_counter.get_lock():
+            index = shard_counter.value
+            shard_counter.value += 1
+        _shard_name = shard_name(output, index)
+
+
+def _convert_task(task):
+    n_trees, n_galaxies, trees = task
+    _converter.seek(n_trees, n_galaxies)
+    # The trees of the previous task have been sent back by now.
+    if _converter.buffers is not None:
+        _converter.buffers.reclaim()
+    # Timings are collected per task and merged by the calling process.
+    if _converter.stats is not None:
+        _converter.stats.clear()
+    dst_trees = list(_converter.convert_trees(trees))
+    return _converter.stats, dst_trees
+
+
+def _write_task(task):
+    global _shard
+    stats, dst_trees = _convert_task(task)
+    if _shard is None:
+        args = _converter.args
+        _shard = Exporter(
+            _shard_name, _converter,
+            buffer_size=int(getattr(args, 'buffer_size', 0) * 1024**2),
+            buffer_galaxies=getattr(args, 'buffer_galaxies', 0))
+        # Finalisers run when the worker exits after the pool is closed.
+        multiprocessing.util.Finalize(None, _close_shard, exitpriority=10)
+    first_tree, first_galaxy = _shard.n_trees, _shard.n_galaxies
+    for dst_tree, counts in dst_trees:
+        _shard.write_tree(dst_tree, counts)
+    _shard.flush()
+    block = (_shard.file.filename, first_tree, _shard.n_trees - first_tree,
+             first_galaxy, _shard.n_galaxies - first_galaxy)
+    return stats, block
+
+
+def _close_shard():
+    _shard.__exit__(None, None, None)
+
+
+def iterate_tasks(trees, task_galaxies, n_trees=0, n_galaxies=0):
+    """Group consecutive trees into tasks of at least `task_galaxies`
+    galaxies. Yields tuples of `(n_trees, n_galaxies, trees)`, where the
+    counts are those of all trees preceding the task."""
+    task = []
+    size = 0
+    for tree in trees:
+        task.append(tree)
+        size += len(tree)
+        if size >= task_galaxies:
+            yield n_trees, n_galaxies, task
+            n_trees += len(task)
+            n_galaxies += size
+            task = []
+            size = 0
+    if task:
+        yield n_trees, n_galaxies, task
+
+
+class ConversionPool(object):
+    """Converts trees on `jobs` worker processes.
+
+    At most `backlog` tasks are in flight at any time, which bounds the
+    memory held by trees that have been read but not yet written.
+
+    If `shards` is set, every worker can write its trees to a shard file
+    of its own, named by `shard_name(shards, index)`, with
+    `write_shards`. The shards are complete once the pool is closed.
+    """
+
+    def __init__(self, converter, jobs, task_galaxies=10000, backlog=None,
+                 shards=None):
+        self.converter = converter
+        self.jobs = jobs
+        self.task_galaxies = task_galaxies
+        self.backlog = backlog if backlog else 4 * jobs
+        self.shards = shards
+        self.pool = None
+
+    def __enter__(self):
+        initargs = (self.converter,)
+        if self.shards is not None:
+            initargs += (self.shards, multiprocessing.Value('i', 0))
+        self.pool = multiprocessing.Pool(self.jobs, _init_worker, initargs)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.pool.close()
+        else:
+            self.pool.terminate()
+        self.pool.join()
+
+    def convert(self, trees, n_trees=0, n_galaxies=0):
+        """Yields the converted trees in the order they were read, as
+        the `(dst_tree, counts)` pairs of `Converter.convert_trees`."""
+        for dst_trees in self._map(_convert_task, trees, n_trees,
+                                   n_galaxies):
+            for dst_tree in dst_trees:
+                yield dst_tree
+
+    def write_shards(self, trees, n_trees=0, n_galaxies=0):
+        """Has the workers write the converted trees to their shards.
+        Yields, in the order the trees were read, the block of a shard
+        holding each task, as `(filename, first_tree, n_trees,
+        first_galaxy, n_galaxies)`."""
+        return self._map(_write_task, trees, n_trees, n_galaxies)
+
+    def _map(self, func, trees, n_trees, n_galaxies):
+        pending = deque()
+        for task in iterate_tasks(trees, self.task_galaxies,
+                                  n_trees, n_galaxies):
+            pending.append(self.pool.apply_async(func, (task,)))
+            if len(pending) >= self.backlog:
+                yield self._collect(pending.popleft())
+        while pending:
+            yield self._collect(pending.popleft())
+
+    def _collect(self, result):
+        stats, value = result.get()
+        if stats is not None:
+            self.converter.stats.merge(stats)
+        return value
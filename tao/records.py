@@ -0,0 +1,98 @@
+"""Helpers for working with NumPy record arrays."""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def field_block(array, names):
+    """Fields `names` of the record array `array` as one 2-D array.
+
+    Column `i` of the result holds field `names[i]`. If the fields share
+    a type and lie next to each other in every record, as the annulus
+    fields of a SAGE galaxy do, the result is a read-only view of
+    `array` and nothing is copied. Otherwise the fields are gathered into
+    a new array of their common type.
+    """
+    names = list(names)
+    fields = array.dtype.fields
+    dtype = fields[names[0]][0]
+    offset = fields[names[0]][1]
+    contiguous = True
+    for i, name in enumerate(names):
+        field_dtype, field_offset = fields[name][:2]
+        if field_dtype != dtype or field_offset != offset + i * dtype.itemsize:
+            contiguous = False
+            break
+
+    if contiguous and dtype.subdtype is None:
+        first = array[names[0]]
+        return as_strided(first, shape=(len(array), len(names)),
+                          strides=(first.strides[0], dtype.itemsize),
+                          writeable=False)
+
+    dtype = np.result_type(*[fields[name][0] for name in names])
+    block = np.empty((len(array), len(names)), dtype=dtype)
+    for i, name in enumerate(names):
+        block[:, i] = array[name]
+    return block
+
+
+class TransferPlan(object):
+    """Copies the fields shared by two record types.
+
+    Since NumPy 1.13 assigning one record array to another copies by
+    position rather than by name, so records read from disk have been
+    copied into the source tree one field at a time. A `TransferPlan`
+    works out once which fields of `src_dtype` land where in
+    `dst_dtype`. Fields of the same type that are adjacent in both
+    records are merged into runs of bytes, and each run is copied for
+    all rows with a single assignment. Fields whose type differs between
+    the two records are cast one at a time.
+    """
+
+    def __init__(self, src_dtype, dst_dtype, names=None):
+        self.src_dtype = np.dtype(src_dtype)
+        self.dst_dtype = np.dtype(dst_dtype)
+        if names is None:
+            names = [n for n in self.src_dtype.names
+                     if n in self.dst_dtype.fields]
+        src_fields = self.src_dtype.fields
+        dst_fields = self.dst_dtype.fields
+
+        self.runs = []
+        self.casts = []
+        for name in sorted(names, key=lambda n: src_fields[n][1]):
+            src_type, src_off = src_fields[name][:2]
+            dst_type, dst_off = dst_fields[name][:2]
+            if src_type != dst_type:
+                self.casts.append(name)
+                continue
+            size = src_type.itemsize
+            if self.runs:
+                s0, d0, n, run_names = self.runs[-1]
+                if s0 + n == src_off and d0 + n == dst_off:
+                    self.runs[-1] = (s0, d0, n + size, run_names + [name])
+                    continue
+            self.runs.append((src_off, dst_off, size, [name]))
+
+    def copy(self, src, dst):
+        """Copy the planned fields of every row of `src` into `dst`."""
+        if len(src) != len(dst):
+            raise ValueError('Cannot transfer %d records into %d.'
+                             % (len(src), len(dst)))
+        src_bytes = _record_bytes(src)
+        dst_bytes = _record_bytes(dst)
+        for s0, d0, n, names in self.runs:
+            if src_bytes is None or dst_bytes is None:
+                for name in names:
+                    dst[name] = src[name]
+            else:
+                dst_bytes[:, d0:d0 + n] = src_bytes[:, s0:s0 + n]
+        for name in self.casts:
+            dst[name] = src[name]
+
+
+def _record_bytes(array):
+    # A (rows x itemsize) byte view of a contiguous record array, or None.
+    if array.ndim != 1 or not array.flags.c_contiguous:
+        return None
+    return array.view(np.uint8).reshape(len(array), array.dtype.itemsize)
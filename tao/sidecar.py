@@ -0,0 +1,97 @@
+"""Sidecar files caching the layout of input catalogues.
+
+Finding where every tree lies in the input usually means reading a
+header per file or scanning a whole dataset, and that work is the same
+on every run. A sidecar is a small `.npz` file written next to the
+input that holds the arrays describing the layout, along with a
+fingerprint of the input files. The fingerprint combines the size and
+modification time of every file with a hash of its first and last
+`SAMPLE_BYTES` bytes, so a sidecar is ignored as soon as any input file
+changes. Sidecars are written atomically, so a run that is killed
+midway leaves either the old sidecar or the new one.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+SAMPLE_BYTES = 1 << 16
+
+
+def fingerprint(paths):
+    """A hex digest identifying the current contents of `paths`."""
+    digest = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        digest.update(('%s:%d:%r;' % (os.path.basename(path), st.st_size,
+                                      st.st_mtime)).encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read(SAMPLE_BYTES))
+            if st.st_size > SAMPLE_BYTES:
+                f.seek(max(SAMPLE_BYTES, st.st_size - SAMPLE_BYTES))
+                digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def load(filename, paths):
+    """The arrays saved in sidecar `filename` as a dict, or None if
+    there is no sidecar or it does not match the current `paths`."""
+    if not os.path.exists(filename):
+        return None
+    try:
+        with np.load(filename) as data:
+            if int(data['_version']) != VERSION or \
+               str(data['_fingerprint']) != fingerprint(paths):
+                return None
+            return dict((k, data[k]) for k in data.files
+                        if not k.startswith('_'))
+    except (IOError, OSError, ValueError, KeyError) as e:
+        logger.warning('Ignoring unreadable index %s: %s', filename, e)
+        return None
+
+
+def save(filename, paths, arrays):
+    """Write `arrays`, a dict of arrays, to sidecar `filename` for the
+    current contents of `paths`. Failing to write, for example because
+    the input directory is read-only, only logs a warning."""
+    arrays = dict(arrays)
+    arrays['_version'] = np.array(VERSION)
+    arrays['_fingerprint'] = np.array(fingerprint(paths))
+    dirname = os.path.dirname(os.path.abspath(filename))
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=dirname)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write index %s: %s', filename, e)
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write index %s: %s', filename, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+def cached(filename, paths, build, mode='use'):
+    """The arrays of sidecar `filename`, calling `build()` to compute
+    them, and saving the result, if the sidecar is missing or stale.
+
+    `mode` is `'use'` to read and write sidecars, `'rebuild'` to ignore
+    any existing sidecar and write a new one, or `'off'` to always call
+    `build` and write nothing.
+    """
+    if mode == 'use':
+        arrays = load(filename, paths)
+        if arrays is not None:
+            return arrays
+    arrays = build()
+    if mode != 'off':
+        save(filename, paths, arrays)
+    return arrays
@@ -1,8 +1,166 @@
+import numpy as np
+
+
 class ValidationError(Exception):
     pass
 
+
+class FieldSummary(object):
+    """Reductions of a single field, shared by all validators.
+
+    The minimum, the maximum and whether any value is zero are computed
+    together the first time any of them is needed, so that validators
+    checking the same field do not each reduce it again. An empty field
+    has no zero and no range; validators skip their range checks when
+    `size` is 0.
+    """
+
+    def __init__(self, data):
+        self.data = np.asarray(data)
+        self.size = self.data.size
+        self._range = None
+        self._has_zero = None
+
+    @property
+    def min(self):
+        return self.range[0]
+
+    @property
+    def max(self):
+        return self.range[1]
+
+    @property
+    def range(self):
+        if self._has_zero is None:
+            self._reduce()
+        if self._range is None:
+            raise ValueError('An empty field has no range.')
+        return self._range
+
+    @property
+    def has_zero(self):
+        if self._has_zero is None:
+            self._reduce()
+        return self._has_zero
+
+    def _reduce(self):
+        self._has_zero = False
+        if not self.size:
+            return
+        self._range = (np.min(self.data), np.max(self.data))
+        self._has_zero = not np.all(self.data)
+
+
+class Fields(dict):
+    """The fields of a tree being converted.
+
+    Caches a `FieldSummary` per field so that validators checking the
+    same field reduce it only once. Assigning a field drops its
+    summary.
+
+    If `pool` is set to a `BufferPool`, fields added by `allocate` are
+    taken from it, and `release` hands them back once the tree is done.
+
+    When several trees are converted together, `segments` describes
+    where each of them lies in the fields.
+    """
+    pool = None
+    segments = None
+
+    def __init__(self, *args, **kwargs):
+        super(Fields, self).__init__(*args, **kwargs)
+        self._summaries = {}
+        self._allocated = []
+
+    def __setitem__(self, name, value):
+        self._summaries.pop(name, None)
+        super(Fields, self).__setitem__(name, value)
+
+    def __delitem__(self, name):
+        self._summaries.pop(name, None)
+        super(Fields, self).__delitem__(name)
+
+    def summary(self, name):
+        try:
+            return self._summaries[name]
+        except KeyError:
+            summ = FieldSummary(self[name])
+            self._summaries[name] = summ
+            return summ
+
+    def allocate(self, name, dtype):
+        """Add an uninitialised field of the same length as the others."""
+        size = len(self[self.keys()[0]])
+        fld = self._new_array(size, dtype)
+        self[name] = fld
+        return fld
+
+    def release(self):
+        """Return the fields added by `allocate` to the pool."""
+        if self.pool is not None:
+            for fld in self._allocated:
+                self.pool.give(fld)
+        self._allocated = []
+
+    def _new_array(self, size, dtype):
+        if self.pool is None:
+            return np.empty(size, dtype)
+        fld = self.pool.take(size, dtype)
+        self._allocated.append(fld)
+        return fld
+
+
+class TreeFields(Fields):
+    """Fields stored directly in the columns of the destination tree.
+
+    `allocate` hands out the column of `tree` with the same name, so
+    that generators write their results into the tree with no
+    intermediate array. A field assigned from elsewhere, or allocated
+    with a different type than its column, is kept as it is and only
+    copied into its column by `flush`. Validators therefore see the
+    values as computed, before any cast to the type of the column, as
+    they do without `TreeFields`, and generators always compute in the
+    type they ask for.
+    """
+
+    def __init__(self, tree):
+        super(TreeFields, self).__init__()
+        self.tree = tree
+        self._pending = set()
+
+    def __setitem__(self, name, value):
+        self._pending.add(name)
+        super(TreeFields, self).__setitem__(name, value)
+
+    def allocate(self, name, dtype):
+        column = self.tree[name]
+        if column.dtype == np.dtype(dtype):
+            super(TreeFields, self).__setitem__(name, column)
+            self._pending.discard(name)
+            return column
+        fld = self._new_array(len(self.tree), dtype)
+        self[name] = fld
+        return fld
+
+    def flush(self):
+        """Copy fields held outside the tree into their columns."""
+        for name in self._pending:
+            self.tree[name] = self[name]
+        self._pending.clear()
+
+
+def summarize(fields, name):
+    """Returns the summary of a field, cached if `fields` supports it."""
+    if isinstance(fields, Fields):
+        return fields.summary(name)
+    return FieldSummary(fields[name])
+
+
 class Validator(object):
-    pass
+    # Whether the validator also gives the right answer for a batch of
+    # trees converted together. Validators that depend on tree
+    # boundaries must look at `fields.segments` to set this.
+    batchable = False
 
 class FieldValidator(Validator):
 
@@ -15,6 +173,7 @@ class FieldValidator(Validator):
             self.validate_field(fld, fields)
 
 class Required(FieldValidator):
+    batchable = True
 
     def validate_field(self, field, fields):
         if field not in fields:
@@ -23,47 +182,68 @@ class Required(FieldValidator):
             raise ValidationError(msg)
 
 class OverLittleH(FieldValidator):
+    batchable = True
 
     def validate_field(self, field, fields):
         pass
 
 class TreeLocalIndex(FieldValidator):
+    batchable = True
 
     def validate_fields(self, fields):
+        segments = getattr(fields, 'segments', None)
         for fld in self.fields:
             if fld not in fields:
                 continue
 
-            data = fields[fld]
-            if min(data) < -1 or max(data) >= len(data):
+            if segments is not None:
+                self.validate_segments(fld, fields[fld], segments)
+                continue
+
+            data = summarize(fields, fld)
+            if not data.size:
+                continue
+            if data.min < -1 or data.max >= data.size:
                 msg = 'Invalid tree-local index in "%s".'%fld
-                msg += ' Valid index range is [-1, %d), but found value of min,max=[%d,%d].'%(len(data), min(data),max(data))
+                msg += ' Valid index range is [-1, %d), but found value of min,max=[%d,%d].'%(data.size, data.min, data.max)
                 raise ValidationError(msg)
+
+    def validate_segments(self, fld, data, segments):
+        bad = np.flatnonzero((data < -1) | (data >= segments.galaxy_sizes))
+        if len(bad):
+            tree = segments.ids[bad[0]]
+            values = data[segments.offsets[tree]:segments.offsets[tree + 1]]
+            msg = 'Invalid tree-local index in "%s".'%fld
+            msg += ' Valid index range is [-1, %d), but found value of min,max=[%d,%d].'%(len(values), values.min(), values.max())
+            raise ValidationError(msg)
                 
 
 class Positive(FieldValidator):
+    batchable = True
 
     def validate_fields(self, fields):
         for fld in self.fields:
             if fld not in fields:
                 continue
 
-            data = fields[fld]
-            if min(data) < 0:
+            data = summarize(fields, fld)
+            if not data.size:
+                continue
+            if data.min < 0:
                 msg = 'Invalid value in "%s".'%fld
-                msg += ' Should be positive, but found value of %s.'%min(data)
+                msg += ' Should be positive, but found value of %s.'%data.min
                 raise ValidationError(msg)
 
         
 class NonZero(FieldValidator):
+    batchable = True
 
     def validate_fields(self, fields):
         for fld in self.fields:
             if fld not in fields:
                 continue
 
-            data = set(fields[fld])
-            if 0 in data:
+            if summarize(fields, fld).has_zero:
                 msg = 'Invalid value in "%s".'%fld
                 msg += ' Should be non-zero.'
                 raise ValidationError(msg)
@@ -78,6 +258,7 @@ class NonZeroDistribution(FieldValidator):
     but never copied over, resulting in all 0's
     
     """
+    batchable = True
 
     def __init__(self, minwidth, minsize, *fields):
         super(NonZeroDistribution, self).__init__(*fields)
@@ -85,23 +266,44 @@ class NonZeroDistribution(FieldValidator):
         self.minsize = minsize
     
     def validate_fields(self, fields):
+        segments = getattr(fields, 'segments', None)
         for fld in self.fields:
             if fld not in fields:
                 continue
 
-            data = fields[fld]
-            diff = max(data) - min(data)
+            if segments is not None:
+                self.validate_segments(fld, fields[fld], segments)
+                continue
+
+            data = summarize(fields, fld)
+            if not data.size:
+                continue
+            diff = data.max - data.min
             # If there are only 1 or two halos, then a narrow
             # distribution is possible
-            if diff <= self.minwidth and len(data) >= self.minsize:
+            if diff <= self.minwidth and data.size >= self.minsize:
                 msg = 'At least %s values are within min. width = %s for field "%s".'\
                     %(self.minsize, self.minwidth, fld)
                 msg += '. Found values of min,max=[%s,%s]. Size = %s'\
-                    %(min(data),max(data), len(data))
+                    %(data.min, data.max, data.size)
                 raise ValidationError(msg)
+
+    def validate_segments(self, fld, data, segments):
+        trees, lo, hi = segments.minmax(data)
+        sizes = segments.sizes[trees]
+        bad = np.flatnonzero((hi - lo <= self.minwidth) &
+                             (sizes >= self.minsize))
+        if len(bad):
+            k = bad[0]
+            msg = 'At least %s values are within min. width = %s for field "%s".'\
+                %(self.minsize, self.minwidth, fld)
+            msg += '. Found values of min,max=[%s,%s]. Size = %s'\
+                %(lo[k], hi[k], sizes[k])
+            raise ValidationError(msg)
             
         
 class WithinRange(FieldValidator):
+    batchable = True
 
     def __init__(self, lower, upper, *fields):
         super(WithinRange, self).__init__(*fields)
@@ -113,14 +315,17 @@ class WithinRange(FieldValidator):
             if fld not in fields:
                 continue
             
-            data = fields[fld]
-            if min(data) < self.lower or max(data) > self.upper:
+            data = summarize(fields, fld)
+            if not data.size:
+                continue
+            if data.min < self.lower or data.max > self.upper:
                     msg = 'Invalid values in "%s".'%fld
-                    msg += ' Should be within range [%s, %s], but found value of min,max=[%s,%s].'%(self.lower, self.upper, min(data),max(data))
+                    msg += ' Should be within range [%s, %s], but found value of min,max=[%s,%s].'%(self.lower, self.upper, data.min, data.max)
                     raise ValidationError(msg)
                 
 
 class WithinCRange(FieldValidator):
+    batchable = True
 
     def __init__(self, lower, upper, *fields):
         super(WithinCRange, self).__init__(*fields)
@@ -132,28 +337,34 @@ class WithinCRange(FieldValidator):
             if fld not in fields:
                 continue
 
-            data = fields[fld]
-            if min(data) < self.lower or max(data) > (self.upper-1):
+            data = summarize(fields, fld)
+            if not data.size:
+                continue
+            if data.min < self.lower or data.max > (self.upper-1):
                     msg = 'Invalid value in "%s".'%fld
                     msg += ' Should be within range [%s, %s], but found value'\
                         ' of min,max= [%s,%s].'\
-                        %(self.lower, self.upper, min(data), max(data))
+                        %(self.lower, self.upper, data.min, data.max)
                     raise ValidationError(msg)
 
             
 class Choice(FieldValidator):
+    batchable = True
 
     def __init__(self, choices, *fields):
         super(Choice, self).__init__(*fields)
         self.choices = set(choices)
+        self._choices = np.array(sorted(self.choices))
 
     def validate_fields(self, fields):
         for fld in self.fields:
             if fld not in fields:
                 continue
 
-            diff = set(fields[fld]) - self.choices
-            if len(diff) > 0:
+            data = summarize(fields, fld).data
+            bad = ~np.in1d(data, self._choices)
+            if bad.any():
+                diff = set(np.unique(data[bad]))
                 msg = 'Invalid choice in "%s".'%fld
                 msg += ' Valid choices are %s, but found %s.'%(self.choices, diff)
                 raise ValidationError(msg)
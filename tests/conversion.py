@@ -0,0 +1,187 @@
+"""A small synthetic catalogue and converter for the conversion tests.
+
+`make_converter` builds the converter with the options `taoconvert`
+would parse, so that whole conversions run in the test process.
+"""
+import argparse
+import copy
+import h5py
+import numpy as np
+import tao
+from collections import OrderedDict
+from tao.find_modules import find_modules
+from tao.library import library
+
+N_SNAPSHOTS = 10
+
+SRC_TYPE = np.dtype([
+    ('GalaxyIndex', np.int64), ('SnapNum', np.int32), ('mergeIntoID', np.int32),
+    ('Pos_x', np.float32), ('Pos_y', np.float32), ('Pos_z', np.float32),
+    ('Vel_x', np.float32), ('Vel_y', np.float32), ('Vel_z', np.float32),
+    ('dT', np.float32), ('Sfr', np.float32), ('ColdGas', np.float32),
+    ('Vmax', np.float32), ('Type', np.int32),
+])
+
+
+def make_tree(rng, n_histories, first_index):
+    """A tree of `n_histories` galaxy histories, each spanning a random
+    range of snapshots, with the galaxies in random order."""
+    rows = []
+    for k in range(n_histories):
+        first = 0 if k == 0 else rng.randint(0, N_SNAPSHOTS - 1)
+        last = N_SNAPSHOTS - 1 if k == 0 else \
+            rng.randint(first, N_SNAPSHOTS)
+        rows.extend((first_index + k, snap)
+                    for snap in range(first, last + 1))
+    tree = np.empty(len(rows), SRC_TYPE)
+    rows = [rows[i] for i in rng.permutation(len(rows))]
+    tree['GalaxyIndex'] = [row[0] for row in rows]
+    tree['SnapNum'] = [row[1] for row in rows]
+    tree['mergeIntoID'] = -1
+    for name in ('Pos_x', 'Pos_y', 'Pos_z'):
+        tree[name] = rng.rand(len(tree)) * 100
+    for name in ('Vel_x', 'Vel_y', 'Vel_z'):
+        tree[name] = rng.randn(len(tree)) * 100
+    tree['dT'] = 10.0 + rng.rand(len(tree))
+    tree['Sfr'] = rng.rand(len(tree))
+    tree['ColdGas'] = rng.rand(len(tree))
+    tree['Vmax'] = rng.rand(len(tree)) * 300
+    tree['Type'] = rng.randint(0, 3, len(tree))
+    return tree
+
+
+def make_trees(n_trees, seed=0):
+    """`n_trees` trees, mostly small with every seventh one large."""
+    rng = np.random.RandomState(seed)
+    trees = []
+    first_index = 0
+    for ii in range(n_trees):
+        n = rng.randint(1, 20) if ii % 7 else rng.randint(50, 200)
+        trees.append(make_tree(rng, n, first_index))
+        first_index += n
+    return trees
+
+
+class TestConverter(tao.Converter):
+    """Converts the trees in `args.trees`, raising once `args.fail_at`
+    trees have been read if it is set."""
+
+    def __init__(self, *args, **kwargs):
+        self.src_fields_dict = OrderedDict([
+            (name, {'type': SRC_TYPE[name], 'label': name})
+            for name in SRC_TYPE.names
+        ])
+        super(TestConverter, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument('--sim-name', default='test')
+        parser.add_argument('--model-name', default='test')
+
+    def get_simulation_data(self):
+        return {'box_size': 100.0, 'hubble': 70.0, 'omega_m': 0.3,
+                'omega_l': 0.7}
+
+    def get_snapshot_redshifts(self):
+        return list(np.linspace(10, 0, N_SNAPSHOTS))
+
+    def get_mapping_table(self):
+        return {'posx': 'Pos_x', 'posy': 'Pos_y', 'posz': 'Pos_z',
+                'velx': 'Vel_x', 'vely': 'Vel_y', 'velz': 'Vel_z',
+                'snapnum': 'SnapNum', 'dt': 'dT', 'sfrdisk': 'Sfr',
+                'sfrbulge': 'Sfr', 'sfrdiskz': 'Sfr', 'sfrbulgez': 'Sfr',
+                'coldgas': 'ColdGas', 'metalscoldgas': 'ColdGas',
+                'diskscaleradius': 'ColdGas', 'objecttype': 'Type'}
+
+    def get_extra_fields(self):
+        return OrderedDict((name, self.src_fields_dict[name])
+                           for name in ('GalaxyIndex', 'mergeIntoID', 'Vmax'))
+
+    def map_descendant(self, tree):
+        return tao.kernels.history_descendants(
+            tree['GalaxyIndex'], tree['SnapNum']).astype(np.int32)
+
+    def map_mergetype(self, tree):
+        return np.zeros(len(tree), np.int32)
+
+    def get_tree_census(self):
+        if getattr(self.args, 'census', False):
+            trees = self.args.trees
+            return len(trees), sum(len(tree) for tree in trees)
+        return None
+
+    def iterate_trees(self):
+        for ii, tree in enumerate(self.args.trees):
+            if ii == self.args.fail_at:
+                raise RuntimeError('Failing at tree %d.' % ii)
+            yield tree
+
+
+# `Converter.make_datatype` merges the metadata of the fields into the
+# dicts of the modules, and the generators of a module class are shared
+# by its instances, which is harmless in a `taoconvert` process that
+# builds a single converter. Every converter made here starts from the
+# fields as they were imported and from generators reset to the start.
+MODULE_FIELDS = dict((mod, copy.deepcopy(mod.fields))
+                     for mod in find_modules())
+
+
+def make_converter(trees, **options):
+    """A `TestConverter` for `trees`, with the defaults of `taoconvert`
+    for every option not given."""
+    parser = argparse.ArgumentParser()
+    modules = find_modules()
+    for mod in modules:
+        mod.fields = copy.deepcopy(MODULE_FIELDS[mod])
+        mod.add_arguments(parser)
+    TestConverter.add_arguments(parser)
+    args = parser.parse_args([])
+    defaults = {
+        'output': 'output', 'dataset_version': '1', 'jobs': 1,
+        'buffer_size': 0, 'buffer_galaxies': 0, 'batch_galaxies': 0,
+        'pool_size': 0, 'direct_write': False, 'index_cache': 'use',
+        'checkpoint_interval': 0, 'resume': False, 'shards': False,
+        'stats': False, 'stats_interval': None, 'stats_json': None,
+        'trees': trees, 'fail_at': None, 'census': False,
+    }
+    defaults.update(options)
+    for name, value in defaults.items():
+        setattr(args, name, value)
+    converter = TestConverter([mod(args) for mod in modules], args)
+    converter.seek(0, 0)
+    # Set up the library as `Converter.convert` does, so that trees can
+    # also be converted without it.
+    sim = converter.get_simulation_data()
+    redshifts = converter.get_snapshot_redshifts()
+    library['box_size'] = sim['box_size']
+    library['hubble'] = sim['hubble']
+    library['redshifts'] = redshifts
+    library['n_snapshots'] = len(redshifts)
+    library['metadata'] = converter.metadata
+    return converter
+
+
+def convert(trees, output, **options):
+    """Convert `trees` to `output` + '.h5'."""
+    make_converter(trees, output=output, **options).convert()
+
+
+def read_output(filename):
+    """The galaxies and tree layout of an output file, as arrays."""
+    with h5py.File(filename, 'r') as f:
+        return dict((name, f[name][...]) for name in
+                    ('galaxies', 'tree_counts', 'tree_displs'))
+
+
+def assert_same_output(result, expected):
+    """Assert that two outputs read by `read_output` hold the same
+    galaxies, field by field, and the same trees."""
+    assert result['galaxies'].dtype == expected['galaxies'].dtype, \
+        'The galaxies have different fields.'
+    for name in expected['galaxies'].dtype.names:
+        np.testing.assert_array_equal(result['galaxies'][name],
+                                      expected['galaxies'][name],
+                                      'The %s of the galaxies differ.' % name)
+    for name in ('tree_counts', 'tree_displs'):
+        np.testing.assert_array_equal(result[name], expected[name],
+                                      'The %s differ.' % name)
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from conversion import (SRC_TYPE, assert_same_output, convert,
+                        make_converter, make_trees, read_output)
+
+
+class TestBatch(unittest.TestCase):
+    """Converting trees together as one batch must give every tree the
+    same fields as converting them one at a time."""
+
+    def setUp(self):
+        self.trees = make_trees(20)
+        # A tree of a single galaxy and an empty tree.
+        self.trees.insert(3, self.trees[3][:1].copy())
+        self.trees.insert(7, np.empty(0, SRC_TYPE))
+        self.trees.append(np.empty(0, SRC_TYPE))
+
+    def convert_each(self, trees):
+        converter = make_converter(trees)
+        return [converter.convert_tree(tree).copy() for tree in trees]
+
+    def convert_batch(self, trees):
+        converter = make_converter(trees)
+        self.assertTrue(converter.batchable())
+        batch, counts = converter.convert_batch(trees)
+        np.testing.assert_array_equal(counts, [len(tree) for tree in trees])
+        return np.split(batch, np.cumsum(counts)[:-1])
+
+    def check(self, trees):
+        expected = self.convert_each(trees)
+        result = self.convert_batch(trees)
+        self.assertEqual(len(result), len(expected))
+        for ii, (dst, exp) in enumerate(zip(result, expected)):
+            self.assertEqual(len(dst), len(exp))
+            for name in exp.dtype.names:
+                np.testing.assert_array_equal(
+                    dst[name], exp[name],
+                    'Field %s of tree %d differs.' % (name, ii))
+
+    def test_batch(self):
+        self.check(self.trees)
+
+    def test_single_galaxy(self):
+        self.check([self.trees[3], self.trees[3]])
+
+    def test_empty_first_and_last(self):
+        empty = np.empty(0, SRC_TYPE)
+        self.check([empty] + self.trees[:5] + [empty])
+
+    def test_fields(self):
+        # Tree indices run on across the batch, local indices restart at
+        # every tree and global descendants stay within their tree.
+        trees = self.convert_batch(self.trees)
+        n_galaxies = 0
+        for ii, tree in enumerate(trees):
+            np.testing.assert_array_equal(tree['treeindex'], ii)
+            np.testing.assert_array_equal(np.sort(tree['localindex']),
+                                          np.arange(len(tree)))
+            np.testing.assert_array_equal(
+                np.sort(tree['globalindex']),
+                np.arange(n_galaxies, n_galaxies + len(tree)))
+            descs = tree['globaldescendant'][tree['descendant'] != -1]
+            self.assertTrue(np.in1d(descs, tree['globalindex']).all())
+            n_galaxies += len(tree)
+
+
+class TestBatchConversion(unittest.TestCase):
+
+    def test_batch_galaxies(self):
+        directory = tempfile.mkdtemp()
+        try:
+            trees = make_trees(100)
+            trees.insert(10, trees[10][:1].copy())
+            trees.insert(20, np.empty(0, SRC_TYPE))
+            output = os.path.join(directory, '%s')
+            convert(trees, output % 'each')
+            expected = read_output(output % 'each' + '.h5')
+            for n in (1, 50, 1000, 100000):
+                convert(trees, output % n, batch_galaxies=n)
+                assert_same_output(read_output(output % n + '.h5'), expected)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
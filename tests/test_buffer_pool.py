@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+from tao.BufferPool import BufferPool
+from tao.Statistics import Statistics
+
+
+class TestBufferPool(unittest.TestCase):
+
+    def test_capacity(self):
+        for n in range(0, 300):
+            expected = 1
+            while expected < n:
+                expected *= 2
+            self.assertEqual(BufferPool.capacity(n), expected)
+
+    def test_take(self):
+        pool = BufferPool(1 << 20)
+        view = pool.take(100, 'f8')
+        self.assertEqual(view.shape, (100,))
+        self.assertEqual(view.dtype, np.float64)
+        self.assertEqual(len(view.base), 128)
+
+    def test_give_and_reuse(self):
+        stats = Statistics()
+        pool = BufferPool(1 << 20, stats)
+        first = pool.take(100, 'f8')
+        buf = first.base
+        pool.give(first)
+        self.assertEqual(pool.free_bytes, buf.nbytes)
+        # Same size class and type: the buffer is reused.
+        second = pool.take(120, 'f8')
+        self.assertIs(second.base, buf)
+        self.assertEqual(pool.free_bytes, 0)
+        # Another type: a new buffer.
+        third = pool.take(120, 'i4')
+        self.assertIsNot(third.base, buf)
+        self.assertEqual(stats.counters, {'pool/hits': 1, 'pool/misses': 2})
+
+    def test_give_unknown(self):
+        pool = BufferPool(1 << 20)
+        pool.give(np.empty(10))
+        view = pool.take(10, 'f8')
+        pool.give(view)
+        pool.give(view)
+        self.assertEqual(pool.free_bytes, view.base.nbytes)
+
+    def test_max_bytes(self):
+        pool = BufferPool(1024)
+        small, large = pool.take(64, 'f8'), pool.take(1024, 'f8')
+        pool.give(large)
+        pool.give(small)
+        self.assertEqual(pool.free_bytes, 512)
+        self.assertIsNot(pool.take(1024, 'f8').base, large.base)
+
+    def test_reclaim(self):
+        pool = BufferPool(1 << 20)
+        views = [pool.take(n, 'f4') for n in (10, 20, 30)]
+        bufs = [view.base for view in views]
+        pool.reclaim()
+        self.assertEqual(pool.taken, {})
+        self.assertEqual(pool.free_bytes, sum(buf.nbytes for buf in bufs))
+        taken = [pool.take(n, 'f4').base for n in (10, 20, 30)]
+        self.assertEqual(sorted(map(id, taken)), sorted(map(id, bufs)))
+
+
+if __name__ == '__main__':
+    unittest.main()
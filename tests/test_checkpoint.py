@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from tao.Exporter import Exporter
+from conversion import (assert_same_output, convert, make_converter,
+                        make_trees, read_output)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, 'output')
+        self.filename = self.output + '.h5'
+        self.converter = make_converter([])
+        self.trees = [np.zeros(n, self.converter.galaxy_type)
+                      for n in (3, 1, 4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_after_flush(self):
+        with Exporter(self.output, self.converter, buffer_galaxies=100,
+                      checkpoint_interval=1e-9) as exp:
+            for tree in self.trees:
+                exp.write_tree(tree)
+            # Nothing has been written yet.
+            with self.assertRaises(ValueError):
+                Exporter.read_checkpoint(self.filename)
+            exp.flush()
+            self.assertEqual(Exporter.read_checkpoint(self.filename), (3, 8))
+            exp.write_tree(self.trees[0])
+        self.assertEqual(Exporter.read_checkpoint(self.filename), (4, 11))
+
+    def test_every_tree(self):
+        with Exporter(self.output, self.converter,
+                      checkpoint_interval=1e-9) as exp:
+            n_galaxies = 0
+            for ii, tree in enumerate(self.trees):
+                exp.write_tree(tree)
+                n_galaxies += len(tree)
+                self.assertEqual(Exporter.read_checkpoint(self.filename),
+                                 (ii + 1, n_galaxies))
+
+    def test_no_interval(self):
+        with Exporter(self.output, self.converter) as exp:
+            exp.write_tree(self.trees[0])
+        self.assertFalse(os.path.exists(self.filename + '.checkpoint.npz'))
+        with self.assertRaises(ValueError):
+            Exporter.read_checkpoint(self.filename)
+
+    def test_stale_removed(self):
+        with Exporter(self.output, self.converter,
+                      checkpoint_interval=1e-9) as exp:
+            exp.write_tree(self.trees[0])
+        self.assertTrue(os.path.exists(self.filename + '.checkpoint.npz'))
+        # A new conversion to the same file drops the old checkpoint.
+        exp = Exporter(self.output, self.converter)
+        self.assertFalse(os.path.exists(self.filename + '.checkpoint.npz'))
+        exp.file.close()
+
+
+class ResumeTest(unittest.TestCase):
+    """Converts `n_trees` trees in full once, to compare resumed
+    conversions against."""
+
+    n_trees = 300
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.trees = make_trees(cls.n_trees)
+        cls.expected = read_output(cls.convert('expected'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def convert(cls, name, **options):
+        output = os.path.join(cls.dir, name)
+        convert(cls.trees, output, **options)
+        return output + '.h5'
+
+    def resume(self, name, fail_at, **options):
+        """Convert the trees, failing at tree `fail_at`, then resume.
+        Returns the checkpoint the failed run left."""
+        with self.assertRaises(RuntimeError):
+            self.convert(name, fail_at=fail_at, checkpoint_interval=1e-9,
+                         **options)
+        filename = os.path.join(self.dir, name + '.h5')
+        checkpoint = Exporter.read_checkpoint(filename)
+        self.convert(name, resume=True, checkpoint_interval=1e-9, **options)
+        assert_same_output(read_output(filename), self.expected)
+        self.assertEqual(Exporter.read_checkpoint(filename),
+                         (len(self.trees), len(self.expected['galaxies'])))
+        return checkpoint
+
+
+class TestResume(ResumeTest):
+
+    def test_serial(self):
+        checkpoint = self.resume('serial', 100)
+        self.assertEqual(checkpoint,
+                         (100, sum(len(tree) for tree in self.trees[:100])))
+
+    def test_skips_written_trees(self):
+        with self.assertRaises(RuntimeError):
+            self.convert('skip', fail_at=100, checkpoint_interval=1e-9)
+        converter = make_converter(self.trees, resume=True,
+                                   output=os.path.join(self.dir, 'skip'))
+        converted = []
+        convert_tree = converter.convert_tree
+        def count(tree):
+            converted.append(tree)
+            return convert_tree(tree)
+        converter.convert_tree = count
+        converter.convert()
+        self.assertEqual(len(converted), len(self.trees) - 100)
+        self.assertIs(converted[0], self.trees[100])
+        result = read_output(os.path.join(self.dir, 'skip.h5'))
+        assert_same_output(result, self.expected)
+        np.testing.assert_array_equal(
+            np.sort(result['galaxies']['globalindex']),
+            np.arange(len(result['galaxies'])))
+
+    def test_buffered(self):
+        self.resume('buffered', 150, buffer_galaxies=2000)
+
+    def test_presized(self):
+        self.resume('presized', 150, census=True)
+
+    def test_jobs_first_tasks(self):
+        # A failure before the first tasks are back saves no progress.
+        self.assertEqual(self.resume('first', 250, jobs=2), (0, 0))
+
+
+class TestResumeJobs(ResumeTest):
+    """With several jobs, progress is only saved once a task of about
+    10000 galaxies is back, and up to four tasks per job are in flight,
+    so these tests need a larger catalogue."""
+
+    n_trees = 1000
+
+    def test_jobs(self):
+        n_trees, n_galaxies = self.resume('jobs', 900, jobs=2)
+        self.assertGreater(n_trees, 0)
+        self.assertLess(n_trees, 900)
+        self.assertEqual(n_galaxies,
+                         sum(len(tree) for tree in self.trees[:n_trees]))
+
+
+if __name__ == '__main__':
+    unittest.main()
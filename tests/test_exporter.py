@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from tao.Exporter import Exporter
+from conversion import (assert_same_output, convert, make_converter,
+                        make_trees, read_output)
+
+
+class TestExporter(unittest.TestCase):
+    """Buffered and pre-sized output must be identical to writing every
+    tree as soon as it is converted."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.converter = make_converter([])
+        rng = np.random.RandomState(0)
+        cls.trees = []
+        for ii, size in enumerate(rng.randint(0, 50, 200)):
+            tree = np.zeros(size, cls.converter.galaxy_type)
+            tree['globalindex'] = rng.randint(0, 1 << 40, size)
+            tree['posx'] = rng.rand(size)
+            tree['treeindex'] = ii
+            cls.trees.append(tree)
+        cls.n_galaxies = sum(len(tree) for tree in cls.trees)
+        cls.expected = read_output(cls.write('expected'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def write(cls, name, **options):
+        output = os.path.join(cls.dir, name)
+        with Exporter(output, cls.converter, **options) as exp:
+            for tree in cls.trees:
+                exp.write_tree(tree)
+        return output + '.h5'
+
+    def check(self, name, **options):
+        assert_same_output(read_output(self.write(name, **options)),
+                           self.expected)
+
+    def test_unbuffered(self):
+        self.assertEqual(len(self.expected['tree_counts']), len(self.trees))
+        np.testing.assert_array_equal(self.expected['tree_counts'],
+                                      [len(tree) for tree in self.trees])
+        self.assertEqual(self.expected['tree_displs'][-1], self.n_galaxies)
+        np.testing.assert_array_equal(self.expected['galaxies'],
+                                      np.concatenate(self.trees))
+
+    def test_buffer_galaxies(self):
+        for n in (1, 7, 100, 10 * self.n_galaxies):
+            self.check('galaxies%d' % n, buffer_galaxies=n)
+
+    def test_buffer_size(self):
+        itemsize = self.converter.galaxy_type.itemsize
+        for n in (1, 100 * itemsize, 10 * self.n_galaxies * itemsize):
+            self.check('bytes%d' % n, buffer_size=n)
+
+    def test_presized(self):
+        self.check('exact', n_trees=len(self.trees),
+                   n_galaxies=self.n_galaxies, buffer_galaxies=100)
+
+    def test_overestimate(self):
+        # finalise trims the datasets down to what was written.
+        self.check('over', n_trees=2 * len(self.trees),
+                   n_galaxies=2 * self.n_galaxies)
+        self.check('over_buffered', n_trees=len(self.trees) + 1,
+                   n_galaxies=self.n_galaxies + 1, buffer_galaxies=100)
+
+    def test_underestimate(self):
+        # The datasets grow past the expected size.
+        self.check('under', n_trees=len(self.trees) // 2,
+                   n_galaxies=self.n_galaxies // 2)
+        self.check('under_buffered', n_trees=1, n_galaxies=1,
+                   buffer_galaxies=100)
+
+    def test_counts(self):
+        # Trees written together as one array with their counts.
+        output = os.path.join(self.dir, 'counts')
+        with Exporter(output, self.converter, buffer_galaxies=100) as exp:
+            for ii in range(0, len(self.trees), 3):
+                batch = self.trees[ii:ii + 3]
+                exp.write_tree(np.concatenate(batch),
+                               [len(tree) for tree in batch])
+        assert_same_output(read_output(output + '.h5'), self.expected)
+
+
+class TestConversion(unittest.TestCase):
+    """The same through whole conversions."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.trees = make_trees(100)
+        cls.n_galaxies = sum(len(tree) for tree in cls.trees)
+        cls.expected = read_output(cls.convert('expected'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def convert(cls, name, **options):
+        output = os.path.join(cls.dir, name)
+        convert(cls.trees, output, **options)
+        return output + '.h5'
+
+    def check(self, name, **options):
+        assert_same_output(read_output(self.convert(name, **options)),
+                           self.expected)
+
+    def test_buffered(self):
+        self.check('one', buffer_galaxies=1)
+        self.check('many', buffer_galaxies=1000)
+        self.check('all', buffer_galaxies=10 * self.n_galaxies)
+
+    def test_census(self):
+        self.check('census', census=True)
+        self.check('census_buffered', census=True, buffer_galaxies=1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
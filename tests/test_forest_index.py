@@ -0,0 +1,97 @@
+import unittest
+import numpy as np
+from tao.ForestIndex import ForestIndex
+
+
+def random_entries(n_forests, n_snapshots, rng):
+    # Every forest is present at a random subset of the snapshots, and
+    # the entries are shuffled.
+    forests, snapshots, counts, offsets = [], [], [], []
+    for snap in range(n_snapshots):
+        present = np.flatnonzero(rng.rand(n_forests) < 0.5)
+        sizes = rng.randint(1, 20, len(present))
+        forests.extend(present)
+        snapshots.extend([snap] * len(present))
+        counts.extend(sizes)
+        offsets.extend(np.cumsum(sizes) - sizes)
+    shuffle = rng.permutation(len(forests))
+    return [np.asarray(a)[shuffle]
+            for a in (forests, snapshots, counts, offsets)]
+
+
+class TestForestIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.n_snapshots = 8
+        self.forest_ids = rng.permutation(100) * 3 + 1000
+        self.entries = random_entries(len(self.forest_ids),
+                                      self.n_snapshots, rng)
+        self.index = ForestIndex(self.forest_ids, *self.entries)
+
+    def test_entries(self):
+        forests, snapshots, counts, offsets = self.entries
+        for forest in range(len(self.forest_ids)):
+            mine = np.flatnonzero(forests == forest)
+            mine = mine[np.argsort(-snapshots[mine])]
+            snaps, cnts, offs = self.index.entries(forest)
+            np.testing.assert_array_equal(snaps, snapshots[mine])
+            np.testing.assert_array_equal(cnts, counts[mine])
+            np.testing.assert_array_equal(offs, offsets[mine])
+            self.assertEqual(self.index.sizes[forest], counts[mine].sum())
+        self.assertEqual(self.index.n_galaxies, counts.sum())
+
+    def test_offsets_at(self):
+        forests, snapshots, counts, offsets = self.entries
+        for snap in range(self.n_snapshots + 1):
+            expected = np.empty(len(self.forest_ids), dtype=np.int64)
+            expected.fill(-1)
+            for i in np.flatnonzero(snapshots == snap):
+                expected[forests[i]] = offsets[i]
+            np.testing.assert_array_equal(self.index.offsets_at(snap),
+                                          expected)
+
+    def test_galaxies_per_snapshot(self):
+        forests, snapshots, counts, offsets = self.entries
+        expected = [counts[snapshots == snap].sum()
+                    for snap in range(self.n_snapshots)]
+        np.testing.assert_array_equal(
+            self.index.galaxies_per_snapshot(self.n_snapshots), expected)
+
+    def test_round_trip(self):
+        arrays = self.index.to_arrays()
+        self.assertEqual(sorted(arrays), sorted(ForestIndex.ARRAYS))
+        index = ForestIndex.from_arrays(arrays)
+        self.assertEqual(len(index), len(self.index))
+        self.assertEqual(index.n_galaxies, self.index.n_galaxies)
+        np.testing.assert_array_equal(index.sizes, self.index.sizes)
+        for name in ForestIndex.ARRAYS:
+            np.testing.assert_array_equal(getattr(index, name),
+                                          getattr(self.index, name))
+
+    def test_compact(self):
+        self.assertEqual(self.index.counts.dtype, np.int32)
+        index = ForestIndex([0], [0, 0], [1, 0], [1, 1], [0, 1 << 40])
+        self.assertEqual(index.offsets.dtype, np.int64)
+        np.testing.assert_array_equal(index.offsets_at(0), [1 << 40])
+
+    def test_read_order(self):
+        # Forests stored in order at every snapshot are read in order.
+        index = ForestIndex([5, 6, 7], [0, 1, 2, 1, 2], [1, 1, 1, 0, 0],
+                            [2, 2, 2, 3, 3], [0, 2, 4, 0, 3])
+        np.testing.assert_array_equal(index.read_order(), [0, 1, 2])
+        # Otherwise by offset at the latest snapshot each is present in,
+        # with forest 0 absent from snapshot 1.
+        index = ForestIndex([5, 6, 7], [0, 1, 2, 1, 2], [0, 1, 1, 0, 0],
+                            [2, 2, 2, 3, 3], [0, 2, 0, 3, 0])
+        np.testing.assert_array_equal(index.read_order(), [0, 2, 1])
+
+    def test_empty(self):
+        index = ForestIndex([], [], [], [], [])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.n_galaxies, 0)
+        self.assertEqual(len(ForestIndex.from_arrays(index.to_arrays())), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import numpy as np
+from tao.kernels import depth_first_order, history_descendants, peak_history
+
+
+def random_forest(n, rng):
+    # Each galaxy descends from one placed before it in a random
+    # permutation, or is a root.
+    perm = rng.permutation(n)
+    descendants = np.empty(n, dtype=np.int64)
+    for k, i in enumerate(perm):
+        j = rng.randint(-1, k) if k else -1
+        descendants[i] = -1 if j == -1 else perm[j]
+    return descendants
+
+
+def reference_depth_first_order(descendants):
+    # Walk every tree with an explicit stack, as the generator used to:
+    # roots in ascending order, progenitors popped in descending order.
+    n = len(descendants)
+    parents = {}
+    for i, desc in enumerate(descendants):
+        if desc != -1:
+            parents.setdefault(desc, []).append(i)
+    order = np.empty(n, dtype=np.int64)
+    subsize = np.zeros(n, dtype=np.int64)
+    pos = 0
+    for root in range(n):
+        if descendants[root] != -1:
+            continue
+        stack = [root]
+        while stack:
+            idx = stack.pop()
+            order[idx] = pos
+            pos += 1
+            stack.extend(parents.get(idx, []))
+    for i in range(n):
+        desc = i
+        while desc != -1:
+            subsize[desc] += 1
+            desc = descendants[desc]
+    return order, subsize
+
+
+def reference_histories(ids, snapnums, values):
+    # Link every galaxy to the next snapshot of its history and carry
+    # the running peak of `values` along it.
+    descs = np.empty(len(ids), dtype=np.int64)
+    descs.fill(-1)
+    peak = np.empty_like(values)
+    for gid in set(ids.tolist()):
+        members = sorted(np.flatnonzero(ids == gid),
+                         key=lambda i: snapnums[i])
+        best = None
+        for k, i in enumerate(members):
+            if k + 1 < len(members):
+                descs[i] = members[k + 1]
+            best = values[i] if best is None else max(best, values[i])
+            peak[i] = best
+    return descs, peak
+
+
+class TestDepthFirstOrder(unittest.TestCase):
+
+    def check(self, descendants):
+        order, subsize = depth_first_order(descendants)
+        ref_order, ref_subsize = reference_depth_first_order(descendants)
+        np.testing.assert_array_equal(order, ref_order)
+        np.testing.assert_array_equal(subsize, ref_subsize)
+
+    def test_empty(self):
+        self.check(np.array([], dtype=np.int64))
+
+    def test_single(self):
+        self.check(np.array([-1], dtype=np.int64))
+
+    def test_chain(self):
+        self.check(np.array([-1, 0, 1, 2, 3], dtype=np.int64))
+
+    def test_merger(self):
+        self.check(np.array([2, 2, -1], dtype=np.int64))
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        for n in [2, 10, 100, 1000]:
+            self.check(random_forest(n, rng))
+
+    def test_cycle(self):
+        with self.assertRaises(AssertionError):
+            depth_first_order(np.array([-1, 2, 1], dtype=np.int64))
+
+
+class TestHistories(unittest.TestCase):
+
+    def check(self, ids, snapnums, values):
+        ref_descs, ref_peak = reference_histories(ids, snapnums, values)
+        np.testing.assert_array_equal(history_descendants(ids, snapnums),
+                                      ref_descs)
+        np.testing.assert_array_equal(peak_history(ids, snapnums, values),
+                                      ref_peak)
+
+    def test_single(self):
+        self.check(np.array([7]), np.array([3]), np.array([1.5]))
+
+    def test_random(self):
+        rng = np.random.RandomState(1)
+        for n, n_ids in [(10, 3), (200, 20), (2000, 50)]:
+            ids = rng.randint(0, n_ids, n).astype(np.int64)
+            # Snapshots are unique within each history.
+            snapnums = np.empty(n, dtype=np.int32)
+            for gid in range(n_ids):
+                members = np.flatnonzero(ids == gid)
+                snapnums[members] = rng.permutation(len(members) * 2)[
+                    :len(members)]
+            values = rng.rand(n).astype(np.float32)
+            self.check(ids, snapnums, values)
+
+
+if __name__ == '__main__':
+    unittest.main()
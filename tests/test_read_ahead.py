@@ -0,0 +1,136 @@
+import unittest
+import numpy as np
+from tao.BlockReader import BlockReader
+from tao.ForestIndex import ForestIndex
+from tao.ReadAhead import ReadAhead
+
+ROW = np.dtype([('forest', np.int64), ('snapshot', np.int32)])
+
+
+class Dataset(object):
+    # An array that records the rows loaded from it.
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.dtype = rows.dtype
+        self.loads = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, sel):
+        self.loads.append((sel.start, sel.stop))
+        return self.rows[sel]
+
+
+def horizontal_layout(n_forests, n_snapshots, rng, shuffle):
+    """One dataset of galaxies per snapshot, with every forest present
+    at a random subset of the snapshots, including forests that are
+    absent from the latest one. With `shuffle` the forests are stored
+    in a different random order at every snapshot."""
+    datasets = []
+    forests, snapshots, counts, offsets = [], [], [], []
+    for snap in range(n_snapshots):
+        present = np.flatnonzero(rng.rand(n_forests) < 0.6)
+        if shuffle:
+            present = rng.permutation(present)
+        sizes = rng.randint(1, 10, len(present))
+        rows = np.empty(sizes.sum(), ROW)
+        rows['forest'] = np.repeat(present, sizes)
+        rows['snapshot'] = snap
+        datasets.append(Dataset(rows))
+        forests.extend(present)
+        snapshots.extend([snap] * len(present))
+        counts.extend(sizes)
+        offsets.extend(np.cumsum(sizes) - sizes)
+    index = ForestIndex(np.arange(n_forests) + 100, forests, snapshots,
+                        counts, offsets)
+    return index, datasets
+
+
+def read_forests(index, datasets, max_bytes):
+    """Read every forest of `index` the way the MERAXES converter does,
+    returning the forests in the order they are handed out, the
+    `ReadAhead` and the largest number of bytes it held back."""
+    readers = BlockReader.split(max_bytes, datasets)
+    read_ahead = ReadAhead(index.read_order(), max_bytes)
+    result = []
+    held = 0
+    for iforest in read_ahead:
+        snaps, counts, offsets = index.entries(iforest)
+        tree = np.concatenate([readers[snap].read(off, cnt).copy()
+                               for snap, cnt, off in
+                               zip(snaps, counts, offsets)] or
+                              [np.empty(0, ROW)])
+        result.extend(read_ahead.put(iforest, tree))
+        held = max(held, read_ahead.held_bytes)
+    return result, read_ahead, held
+
+
+class TestReadAhead(unittest.TestCase):
+
+    def test_in_order(self):
+        read_ahead = ReadAhead([0, 1, 2], 0)
+        for index in read_ahead:
+            self.assertEqual(read_ahead.put(index, index), [index])
+
+    def test_reorder(self):
+        read_ahead = ReadAhead([2, 0, 3, 1], 1 << 20)
+        ready = []
+        for index in read_ahead:
+            ready.append(read_ahead.put(index, np.zeros(1)))
+        self.assertEqual([len(r) for r in ready], [0, 1, 0, 3])
+        self.assertEqual(read_ahead.held, {})
+
+    def test_bounded(self):
+        # Nothing may be held back, so every item is read in turn.
+        read_ahead = ReadAhead([3, 2, 1, 0], 0)
+        visited = []
+        for index in read_ahead:
+            visited.append(index)
+            read_ahead.put(index, np.zeros(1))
+        self.assertEqual(visited, [3, 0, 1, 2])
+        self.assertEqual(read_ahead.n_forced, 3)
+
+    def check_forests(self, index, datasets, result):
+        self.assertEqual(len(result), len(index))
+        for iforest, tree in enumerate(result):
+            self.assertEqual(len(tree), index.sizes[iforest])
+            np.testing.assert_array_equal(tree['forest'], iforest)
+            snaps = index.entries(iforest)[0]
+            np.testing.assert_array_equal(
+                tree['snapshot'],
+                np.repeat(snaps, index.entries(iforest)[1]))
+
+    def test_sorted_layout(self):
+        rng = np.random.RandomState(0)
+        index, datasets = horizontal_layout(200, 6, rng, False)
+        np.testing.assert_array_equal(index.read_order(),
+                                      np.arange(len(index)))
+        max_bytes = 64 * ROW.itemsize * len(datasets)
+        result, read_ahead, held = read_forests(index, datasets, max_bytes)
+        self.check_forests(index, datasets, result)
+        self.assertEqual(held, 0)
+        self.assertEqual(read_ahead.n_forced, 0)
+        # The readers only ever move forward, so no row of any snapshot
+        # is loaded twice, apart from the start of a forest that
+        # straddles the end of a block.
+        for ds in datasets:
+            starts = [start for start, stop in ds.loads]
+            self.assertEqual(starts, sorted(set(starts)))
+            for (_, stop), (start, _) in zip(ds.loads, ds.loads[1:]):
+                self.assertGreaterEqual(start, stop - 9)
+
+    def test_shuffled_layout(self):
+        rng = np.random.RandomState(1)
+        index, datasets = horizontal_layout(200, 6, rng, True)
+        max_bytes = 64 * ROW.itemsize * len(datasets)
+        result, read_ahead, held = read_forests(index, datasets, max_bytes)
+        self.check_forests(index, datasets, result)
+        self.assertGreater(read_ahead.n_forced, 0)
+        largest = index.sizes.max() * ROW.itemsize
+        self.assertLessEqual(held, max_bytes + largest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from conversion import assert_same_output, convert, make_trees, read_output
+
+
+@unittest.skipUnless(hasattr(h5py, 'VirtualLayout'),
+                     'virtual datasets need h5py 2.9 or later')
+class TestShards(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        # Enough galaxies for several tasks on each worker.
+        cls.trees = make_trees(600)
+        cls.expected = read_output(cls.convert('expected'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def convert(cls, name, **options):
+        output = os.path.join(cls.dir, name)
+        convert(cls.trees, output, **options)
+        return output + '.h5'
+
+    def test_master_file(self):
+        filename = self.convert('sharded', jobs=2, shards=True)
+        shards = glob.glob(os.path.join(self.dir, 'sharded.shard*.h5'))
+        self.assertEqual(len(shards), 2)
+        with h5py.File(filename, 'r') as f:
+            self.assertTrue(f['galaxies'].is_virtual)
+        result = read_output(filename)
+        assert_same_output(result, self.expected)
+
+        # Global indices and descendants refer to the whole catalogue,
+        # not to the shard the galaxy was written to.
+        galaxies = result['galaxies']
+        np.testing.assert_array_equal(np.sort(galaxies['globalindex']),
+                                      np.arange(len(galaxies)))
+        order = np.argsort(galaxies['globalindex'])
+        has_desc = galaxies['globaldescendant'] != -1
+        descs = order[galaxies['globaldescendant'][has_desc]]
+        np.testing.assert_array_equal(galaxies['treeindex'][descs],
+                                      galaxies['treeindex'][has_desc])
+        np.testing.assert_array_equal(galaxies['snapnum'][descs],
+                                      galaxies['snapnum'][has_desc] + 1)
+
+    def test_moved(self):
+        # The shards are found relative to the master file.
+        self.convert('moved', jobs=2, shards=True)
+        moved = os.path.join(self.dir, 'elsewhere')
+        os.mkdir(moved)
+        for path in glob.glob(os.path.join(self.dir, 'moved.*h5')):
+            shutil.move(path, moved)
+        result = read_output(os.path.join(moved, 'moved.h5'))
+        assert_same_output(result, self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
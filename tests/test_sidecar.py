@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from tao import sidecar
+
+
+class TestSidecar(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for k, size in enumerate([10, 3 * sidecar.SAMPLE_BYTES]):
+            path = os.path.join(self.dir, 'input%d.dat' % k)
+            with open(path, 'wb') as f:
+                f.write(np.arange(size, dtype=np.uint8).tostring())
+            self.paths.append(path)
+        self.filename = os.path.join(self.dir, 'input.tao-index.npz')
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self):
+        self.calls += 1
+        return {'offsets': np.arange(5) * self.calls}
+
+    def modify(self, path, pos):
+        # Change one byte, keeping the size and modification time.
+        st = os.stat(path)
+        with open(path, 'r+b') as f:
+            f.seek(pos)
+            byte = f.read(1)
+            f.seek(pos)
+            f.write(chr((ord(byte) + 1) % 256))
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+    def test_fingerprint(self):
+        before = sidecar.fingerprint(self.paths)
+        self.assertEqual(sidecar.fingerprint(self.paths), before)
+        self.assertNotEqual(sidecar.fingerprint(self.paths[:1]), before)
+        self.assertNotEqual(sidecar.fingerprint(self.paths[::-1]), before)
+
+    def test_fingerprint_contents(self):
+        # The first and last SAMPLE_BYTES of a file are hashed.
+        big = self.paths[1]
+        size = os.path.getsize(big)
+        for pos in (0, size - 1):
+            before = sidecar.fingerprint(self.paths)
+            self.modify(big, pos)
+            self.assertNotEqual(sidecar.fingerprint(self.paths), before)
+
+    def test_fingerprint_size_and_mtime(self):
+        before = sidecar.fingerprint(self.paths)
+        with open(self.paths[0], 'ab') as f:
+            f.write(b'x')
+        grown = sidecar.fingerprint(self.paths)
+        self.assertNotEqual(grown, before)
+        st = os.stat(self.paths[0])
+        os.utime(self.paths[0], (st.st_atime, st.st_mtime + 10))
+        self.assertNotEqual(sidecar.fingerprint(self.paths), grown)
+
+    def test_save_and_load(self):
+        arrays = {'a': np.arange(10), 'b': np.array([1.5, 2.5])}
+        self.assertTrue(sidecar.save(self.filename, self.paths, arrays))
+        loaded = sidecar.load(self.filename, self.paths)
+        self.assertEqual(sorted(loaded), ['a', 'b'])
+        for name in arrays:
+            np.testing.assert_array_equal(loaded[name], arrays[name])
+        # Nothing is left behind but the sidecar itself.
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['input.tao-index.npz', 'input0.dat', 'input1.dat'])
+
+    def test_load_missing(self):
+        self.assertIsNone(sidecar.load(self.filename, self.paths))
+
+    def test_load_stale(self):
+        sidecar.save(self.filename, self.paths, self.build())
+        self.modify(self.paths[0], 0)
+        self.assertIsNone(sidecar.load(self.filename, self.paths))
+
+    def test_load_unreadable(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'not an npz file')
+        self.assertIsNone(sidecar.load(self.filename, self.paths))
+
+    def test_cached_use(self):
+        first = sidecar.cached(self.filename, self.paths, self.build)
+        second = sidecar.cached(self.filename, self.paths, self.build)
+        self.assertEqual(self.calls, 1)
+        np.testing.assert_array_equal(first['offsets'], second['offsets'])
+
+    def test_cached_stale(self):
+        sidecar.cached(self.filename, self.paths, self.build)
+        self.modify(self.paths[1], 0)
+        arrays = sidecar.cached(self.filename, self.paths, self.build)
+        self.assertEqual(self.calls, 2)
+        np.testing.assert_array_equal(arrays['offsets'], np.arange(5) * 2)
+        sidecar.cached(self.filename, self.paths, self.build)
+        self.assertEqual(self.calls, 2)
+
+    def test_cached_rebuild(self):
+        sidecar.cached(self.filename, self.paths, self.build)
+        arrays = sidecar.cached(self.filename, self.paths, self.build,
+                                'rebuild')
+        self.assertEqual(self.calls, 2)
+        loaded = sidecar.load(self.filename, self.paths)
+        np.testing.assert_array_equal(loaded['offsets'], arrays['offsets'])
+
+    def test_cached_off(self):
+        sidecar.cached(self.filename, self.paths, self.build, 'off')
+        sidecar.cached(self.filename, self.paths, self.build, 'off')
+        self.assertEqual(self.calls, 2)
+        self.assertFalse(os.path.exists(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
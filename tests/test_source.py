@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from tao.Source import LazyLoader, Source
+
+DTYPE = np.dtype([('id', np.int64), ('mass', np.float32), ('desc', np.int32)])
+
+
+def make_trees(sizes, seed=0):
+    rng = np.random.RandomState(seed)
+    trees = []
+    for size in sizes:
+        tree = np.empty(size, DTYPE)
+        tree['id'] = rng.randint(0, 1 << 40, size)
+        tree['mass'] = rng.rand(size)
+        tree['desc'] = rng.randint(-1, max(size, 1), size)
+        trees.append(tree)
+    return trees
+
+
+class TestSource(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sizes_fn = os.path.join(self.dir, 'sizes.npy')
+        self.trees_fn = os.path.join(self.dir, 'trees.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def round_trip(self, trees, **kwargs):
+        Source.save(iter(trees), self.sizes_fn, self.trees_fn,
+                    dtype=DTYPE)
+        src = Source(self.sizes_fn, self.trees_fn, **kwargs)
+        result = list(src)
+        self.assertEqual(len(src), len(trees))
+        self.assertEqual(src.get_tree_census(),
+                         (len(trees), sum(len(t) for t in trees)))
+        self.assertEqual(len(result), len(trees))
+        for expected, tree in zip(trees, result):
+            self.assertEqual(tree.dtype, DTYPE)
+            self.assertTrue(np.array_equal(expected, tree))
+        return result
+
+    def test_empty_catalogue(self):
+        self.round_trip([])
+        self.assertEqual(len(np.load(self.trees_fn)), 0)
+
+    def test_single_tree(self):
+        self.round_trip(make_trees([17]))
+
+    def test_empty_trees(self):
+        self.round_trip(make_trees([0, 5, 0, 0, 3, 0]))
+
+    def test_many_trees(self):
+        self.round_trip(make_trees(np.arange(1, 200) % 23))
+
+    def test_trees_larger_than_buffer(self):
+        # A buffer of a few rows, so that most trees do not fit and are
+        # read in batches of one.
+        trees = make_trees([3, 50, 1, 120, 2, 2, 64])
+        self.round_trip(trees, buffer_size=4 * DTYPE.itemsize)
+
+    def test_saved_file_is_plain_npy(self):
+        trees = make_trees([4, 9, 1])
+        Source.save(trees, self.sizes_fn, self.trees_fn)
+        self.assertTrue(np.array_equal(np.load(self.trees_fn),
+                                       np.concatenate(trees)))
+        self.assertTrue(np.array_equal(np.load(self.sizes_fn), [4, 9, 1]))
+
+    def test_no_trees_without_dtype(self):
+        self.assertRaises(AssertionError, Source.save, [], self.sizes_fn,
+                          self.trees_fn)
+
+
+class TestLazyLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'data.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, array, version):
+        with open(self.fn, 'wb') as fh:
+            np.lib.format.write_array(fh, array, version)
+
+    def test_read_in_order(self):
+        array = make_trees([30])[0]
+        for version in [(1, 0), (2, 0)]:
+            self.write(array, version)
+            loader = LazyLoader(self.fn)
+            self.assertEqual(len(loader), 30)
+            self.assertTrue(np.array_equal(loader.read(10), array[:10]))
+            self.assertTrue(np.array_equal(loader.read(0), array[:0]))
+            self.assertTrue(np.array_equal(loader.read(20), array[10:]))
+            self.assertTrue(loader.done())
+            loader.seek(5)
+            self.assertTrue(np.array_equal(loader.read(3), array[5:8]))
+
+    def test_unknown_version(self):
+        self.write(np.arange(4), (1, 0))
+        with open(self.fn, 'r+b') as fh:
+            fh.seek(6)
+            fh.write(b'\x09\x00')
+        self.assertRaises(ValueError, LazyLoader, self.fn)
+
+
+if __name__ == '__main__':
+    unittest.main()
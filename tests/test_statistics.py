@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+from tao.Statistics import Statistics
+from conversion import make_converter, make_trees
+
+
+class TestStatistics(unittest.TestCase):
+
+    def test_report(self):
+        stats = Statistics()
+        stats.add('tree', 2.0, 10, 100)
+        stats.add('validate_fields', 1.0)
+        stats.add('flush', 0.5, 10, 100)
+        stats.start -= 10.0
+        lines = stats.report().splitlines()
+        rows = dict((line.split()[0], line.split()) for line in lines[2:])
+        self.assertEqual(float(rows['validate_fields'][3]), 50.0)
+        self.assertEqual(float(rows['tree'][3]), 100.0)
+        # Writing is not part of converting trees, so it is reported
+        # after them, against the wall time.
+        outside = [ii for ii, line in enumerate(lines)
+                   if line.startswith('Outside')][0]
+        self.assertTrue(lines[outside + 1].startswith('flush'))
+        self.assertAlmostEqual(float(rows['flush'][3]), 5.0, places=0)
+
+    def test_merge(self):
+        stats, other = Statistics(), Statistics()
+        stats.add('tree', 1.0, 5, 50)
+        other.add('tree', 3.0, 7, 70)
+        other.count('pool/hits', 2)
+        stats.merge(other)
+        summary = stats.to_dict()
+        self.assertEqual(summary['trees'], 2)
+        self.assertEqual(summary['galaxies'], 12)
+        self.assertEqual(summary['stages']['tree']['total'], 4.0)
+        self.assertEqual(summary['counters'], {'pool/hits': 2})
+
+    def test_conversion(self):
+        directory = tempfile.mkdtemp()
+        try:
+            trees = make_trees(20)
+            converter = make_converter(trees, stats_json=os.path.join(
+                directory, 'stats.json'), output=os.path.join(directory, 'out'))
+            converter.convert()
+            stages = converter.stats.stages
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(stages['tree'].count, len(trees))
+        self.assertEqual(stages['tree'].galaxies,
+                         sum(len(tree) for tree in trees))
+        self.assertIn('flush', stages)
+        for prefix in ('convert_tree/', 'validate_fields/',
+                       'generate_fields/', 'post_conversion/'):
+            self.assertTrue(any(name.startswith(prefix) for name in stages),
+                            'No %s stages.' % prefix)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from tao.validators import (Choice, FieldSummary, Fields, NonZero,
+                            NonZeroDistribution, Positive, Required,
+                            TreeFields, TreeLocalIndex, ValidationError,
+                            WithinCRange, WithinRange)
+from conversion import assert_same_output, convert, make_trees, read_output
+
+
+def validators():
+    return [
+        Required('a'), Positive('a'), NonZero('a'), TreeLocalIndex('a'),
+        NonZeroDistribution(0.1, 2, 'a'), WithinRange(0, 10, 'a'),
+        WithinCRange(0, 10, 'a'), Choice([1, 2], 'a'),
+    ]
+
+
+class TestFieldSummary(unittest.TestCase):
+
+    def test_reductions(self):
+        rng = np.random.RandomState(0)
+        data = rng.randint(-50, 50, 100000).astype(np.float32)
+        summ = FieldSummary(data)
+        self.assertEqual(summ.size, len(data))
+        self.assertEqual(summ.range, (data.min(), data.max()))
+        self.assertEqual(summ.has_zero, 0 in set(data))
+        data[data == 0] = 1
+        self.assertFalse(FieldSummary(data).has_zero)
+
+    def test_empty(self):
+        summ = FieldSummary(np.array([], 'f4'))
+        self.assertEqual(summ.size, 0)
+        self.assertFalse(summ.has_zero)
+        with self.assertRaises(ValueError):
+            summ.range
+
+    def test_cached(self):
+        fields = Fields({'a': np.array([1, 2, 3])})
+        summ = fields.summary('a')
+        self.assertIs(fields.summary('a'), summ)
+        fields['a'] = np.array([0, 5])
+        self.assertEqual(fields.summary('a').range, (0, 5))
+        self.assertTrue(fields.summary('a').has_zero)
+
+
+class TestValidators(unittest.TestCase):
+
+    def test_empty(self):
+        # Empty trees pass every validator, as they always have.
+        for val in validators():
+            val.validate_fields(Fields({'a': np.array([], 'f4')}))
+
+    def test_valid(self):
+        for val in validators():
+            val.validate_fields(Fields({'a': np.array([1, 2, 1, 2], 'i4')}))
+
+    def test_invalid(self):
+        bad = {
+            Positive: [1, -1],
+            NonZero: [1, 0],
+            TreeLocalIndex: [0, 2],
+            NonZeroDistribution: [1, 1],
+            WithinRange: [1, 11],
+            WithinCRange: [1, 10],
+            Choice: [1, 3],
+        }
+        for val in validators():
+            if type(val) is Required:
+                with self.assertRaises(ValidationError):
+                    val.validate_fields(Fields({'b': np.array([1])}))
+                continue
+            fields = Fields({'a': np.array(bad[type(val)], 'i4')})
+            with self.assertRaises(ValidationError):
+                val.validate_fields(fields)
+
+
+class TestTreeFields(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = np.zeros(3, [('u', np.uint32), ('f', np.float32),
+                                 ('g', np.float64)])
+
+    def test_validated_as_computed(self):
+        # Validators see the values before they are cast to the type of
+        # their column.
+        fields = TreeFields(self.tree)
+        fields['u'] = np.array([1, -1, 2], np.int64)
+        with self.assertRaises(ValidationError):
+            Positive('u').validate_fields(fields)
+        fields['f'] = np.array([1e-300, 1.0, 2.0])
+        NonZero('f').validate_fields(fields)
+        np.testing.assert_array_equal(self.tree['u'], 0)
+        fields.flush()
+        np.testing.assert_array_equal(self.tree['u'], [1, 2**32 - 1, 2])
+        np.testing.assert_array_equal(self.tree['f'], [0, 1, 2])
+
+    def test_allocate(self):
+        fields = TreeFields(self.tree)
+        column = fields.allocate('g', np.float64)
+        column[:] = [1, 2, 3]
+        np.testing.assert_array_equal(self.tree['g'], [1, 2, 3])
+        # A different type than the column is computed separately.
+        fld = fields.allocate('f', np.float64)
+        self.assertEqual(fld.dtype, np.float64)
+        fld[:] = [4, 5, 6]
+        np.testing.assert_array_equal(self.tree['f'], 0)
+        fields.flush()
+        np.testing.assert_array_equal(self.tree['f'], [4, 5, 6])
+        np.testing.assert_array_equal(self.tree['g'], [1, 2, 3])
+
+    def test_conversion(self):
+        directory = tempfile.mkdtemp()
+        try:
+            trees = make_trees(50)
+            output = os.path.join(directory, '%s')
+            convert(trees, output % 'default')
+            convert(trees, output % 'direct', direct_write=True)
+            assert_same_output(read_output(output % 'direct' + '.h5'),
+                               read_output(output % 'default' + '.h5'))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()